@@ -1,19 +1,45 @@
-from util import scrubbed_equals
+from util import fingerprint
+
 
 class Anomaly:
-    def __init__(self, sent, recv, dst, message, score):
+    # A distinct anomaly and how often it was seen. Conversations with the same scrubbed
+    # fingerprint are the same anomaly, see DetectionAnalyzer.check_result.
+    def __init__(self, sent, recv, dst, message, score, key=None):
         self.recv = recv
         self.sent = sent
         self.message = message
         self.score = score
         self.dst = dst
+        self.key = key or fingerprint(str(dst).encode(), sent, recv)
+        self.count = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.sources = set()
+
+    def seen(self, source=None, first=None, last=None):
+        self.count += 1
+        if source:
+            self.sources.add(source)
+        if first is not None and (self.first_seen is None or first < self.first_seen):
+            self.first_seen = first
+        last = first if last is None else last
+        if last is not None and (self.last_seen is None or last > self.last_seen):
+            self.last_seen = last
 
+    def release(self):
+        # the payloads are only needed until the anomaly has been written
+        self.sent = self.recv = None
 
+    def id(self):
+        return self.key.hex()[:12]
 
     def __eq__(self, other):
         if type(other) != Anomaly:
             return False
-        return scrubbed_equals(other.sent, self.sent) and scrubbed_equals(other.recv, self.recv)
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __lt__(self, other):
         return self.score < other.score
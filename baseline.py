@@ -1,8 +1,13 @@
-from template import ConvoTemplate
+from template import ConvoTemplate, TurnTemplate, Turns, load_template, stats
+from binary import BinaryReader, BinaryWriter, BinaryFormatError, MAGIC, is_binary_name
 import logging
 import yaml
 from util import ConfigMixin
 
+# baselines only hold plain data, the C loader is much faster when libyaml is available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class Baseline(ConfigMixin):
     TRAINING_TRESHOLD = 0.4
     DETECTION_TRESHOLD = 0.1
@@ -32,13 +37,51 @@ class Baseline(ConfigMixin):
         self.ports[port].addConvo(convo)
 
     def checkConvo(self, port, convo):
+        return self.match(port, convo)[:2]
+
+    def match(self, port, convo):
+        # checkConvo plus the index of the template that matched, None for anomalies
         if port not in self.ports:
-            return ('Conversation on port {} was not recognized.'.format(port), self.get_config('unrecognized_port'))
-        score = max(0, 1-self.ports[port].checkConvo(convo))
+            return ('Conversation on port {} was not recognized.'.format(port), self.get_config('unrecognized_port'), None)
+        best_score, index = self.ports[port].match(convo)
+        score = max(0, 1-best_score)
         logging.debug("Convo matching score {}".format(score))
         if score > self.get_config('detection_treshold', 0.5):
-            return ('Conversation on port {} did not match conversations in the baseline. Best matching score was {:.2f}'.format(port, 1-score), score)
-        return ('No anomalies detected', 0.0)
+            return ('Conversation on port {} did not match conversations in the baseline. Best matching score was {:.2f}'.format(port, 1-score), score, None)
+        return ('No anomalies detected', 0.0, index)
+
+    def record_hit(self, port, index):
+        self.ports[port].templates[index].hits += 1
+
+    def unused_report(self):
+        # templates that no conversation matched during detection, candidates for pruning
+        result = ""
+        for port, portbl in self.ports.items():
+            unused = [(i, t) for i, t in enumerate(portbl.templates) if t.hits == 0]
+            result += "Port {:<5}: {} of {} templates were never hit\n".format(port, len(unused), len(portbl.templates))
+            for i, t in unused:
+                result += "template {} (trained on {} conversations)\n".format(i + 1, t.trained)
+                result += t.show()
+        return result
+
+    def compact(self, treshold=None, max_templates=None):
+        # re-clusters the templates of every port, see PortBaseline.compact
+        for port, portbl in sorted(self.ports.items()):
+            before = len(portbl.templates)
+            portbl.compact(treshold, max_templates)
+            logging.info("Port {:<5}: {} -> {} templates".format(port, before, len(portbl.templates)))
+
+    def template_count(self):
+        return sum(len(portbl.templates) for portbl in self.ports.values())
+
+    def merge(self, other):
+        # Combines a baseline trained on other traffic into this one. Our config wins.
+        if other.config != self.config:
+            logging.warning("Merging baselines with different configs, keeping the first one")
+        for port, portbl in other.ports.items():
+            if port not in self.ports:
+                self.ports[port] = PortBaseline(port, self.config)
+            self.ports[port].merge(portbl)
 
     def show(self):
         logging.info("***** BASELINE *****")
@@ -54,27 +97,42 @@ class Baseline(ConfigMixin):
         result['ports'] = port_dict
         return result
 
-    def write(self, outfilname):
+    def write(self, outfilname, fmt=None):
+        # fmt is 'yaml' or 'binary', by default the .dbl extension selects binary
         if not outfilname:
             logging.error("Please specify a baseline file with --baseline")
             return
+        if fmt is None:
+            fmt = 'binary' if is_binary_name(outfilname) else 'yaml'
         try:
             logging.info("Writing to " + outfilname)
-            with open(outfilname, 'w') as f:
-                yaml.dump(self.dict(), f)
+            if fmt == 'binary':
+                w = BinaryWriter()
+                self.pack(w)
+                with open(outfilname, 'wb') as f:
+                    f.write(w.getvalue())
+            else:
+                with open(outfilname, 'w') as f:
+                    yaml.dump(self.dict(), f)
         except IOError:
             logging.error("Can't write to file " + outfilname)
 
     def read(infilname):
+        # the format is recognized by the magic, whatever the file is called
         if not infilname:
             logging.error("Please specify a baseline file with --baseline")
             return None
         try:
             logging.info("Reading from " + infilname)
-            with open(infilname) as f:
-                return Baseline.load(yaml.load(f))
+            with open(infilname, 'rb') as f:
+                data = f.read()
+            if data.startswith(MAGIC):
+                return Baseline.unpack(BinaryReader(data))
+            return Baseline.load(yaml.load(data, Loader=YAML_LOADER))
         except IOError:
             logging.error("Can't read from file " + infilname)
+        except BinaryFormatError as e:
+            logging.error("Can't read baseline {}: {}".format(infilname, e))
 
     def load(i):
         result = Baseline()
@@ -83,6 +141,20 @@ class Baseline(ConfigMixin):
             result.ports[p] = PortBaseline.load(port, result.config)
         return result
 
+    def pack(self, w):
+        w.value(self.config)
+        w.u32(len(self.ports))
+        for portbl in self.ports.values():
+            portbl.pack(w)
+
+    def unpack(r):
+        result = Baseline()
+        result.config = r.value()
+        for _ in range(r.u32()):
+            portbl = PortBaseline.unpack(r, result.config)
+            result.ports[portbl.port] = portbl
+        return result
+
 
 class PortBaseline(ConfigMixin):
     def __init__(self, port, config=None):
@@ -93,35 +165,185 @@ class PortBaseline(ConfigMixin):
     def __str__(self):
         result = "***************\nPort: {:<5}: {} templates\n".format(self.port, len(self.templates))
         for i, temp in enumerate(self.templates):
-            result += 'template {}\n'.format(i + 1)
+            result += 'template {} ({} trained, {} hits)\n'.format(i + 1, temp.trained, temp.hits)
             result += temp.show()
         result += "***************"
         return result
 
     def dict(self):
         result = {'port': self.port}
-        result['templates'] = [t.dict() for t in self.templates]
+        result['templates'] = [dict(t.dict(), trained=t.trained, hits=t.hits) for t in self.templates]
         return result
 
     def load(i, conf=None):
         result = PortBaseline(i['port'], conf)
-        result.templates = [ConvoTemplate.load(c, conf) for c in i['templates']]
+        for c in i['templates']:
+            t = load_template(c, conf)
+            t.trained = c.get('trained', 0)
+            t.hits = c.get('hits', 0)
+            result.templates.append(t)
+        return result
+
+    def pack(self, w):
+        w.value(self.port)
+        w.u32(len(self.templates))
+        for t in self.templates:
+            w.u16(1 if isinstance(t, TurnTemplate) else 0)
+            w.u32(t.trained)
+            w.u32(t.hits)
+            t.pack(w)
+
+    def unpack(r, conf=None):
+        result = PortBaseline(r.value(), conf)
+        for _ in range(r.u32()):
+            # version 1 only had plain conversation templates, version 2 no counters
+            turns = r.version >= 2 and r.u16() == 1
+            trained, hits = (r.u32(), r.u32()) if r.version >= 3 else (0, 0)
+            t = TurnTemplate.unpack(r, conf) if turns else ConvoTemplate.unpack(r, conf)
+            t.trained, t.hits = trained, hits
+            result.templates.append(t)
         return result
 
+    def new_template(self, convo):
+        if isinstance(convo, Turns):
+            return TurnTemplate(convo, self.config)
+        return ConvoTemplate(*convo, self.config)
+
+    def candidates(self, convo):
+        # Templates with a cheap upper bound on their similarity, most promising first. Of
+        # the ones that could fit, the templates that matched most conversations go first.
+        # turn templates only match conversations that were split in turns and vice versa
+        turns = isinstance(convo, Turns)
+        bounds = [(t.upper_bound(*convo, floor=1.0), i, t) for i, t in enumerate(self.templates)
+                  if isinstance(t, TurnTemplate) == turns]
+        bounds.sort(key=lambda b: (-b[0], -b[2].trained - b[2].hits, b[1]))
+        return bounds
+
     def checkConvo(self, convo):
-        score = max([t.similarity(*convo) for t in self.templates] + [0])
-        return score
+        return self.match(convo)[0]
 
-    def addConvo(self, convo):
-        # if convo matches existing template, update it. else add a new template
+    def match(self, convo):
+        # best similarity and the index of that template, stops at the first perfect fit
+        score = 0.0
+        best_index = None
+        for bound, i, temp in self.candidates(convo):
+            if bound <= score or score >= 1.0:
+                break
+            if temp.upper_bound(*convo, floor=score) <= score:
+                stats['templates_pruned'] += 1
+                continue
+            stats['template_comparisons'] += 1
+            temp_score = temp.similarity(*convo, floor=score)
+            if temp_score > score:
+                score = temp_score
+                best_index = i
+        return score, best_index
+
+    def best_template(self, convo):
+        # Same outcome as comparing against every template: the best scoring one wins and
+        # ties go to the hottest, then the oldest template. Templates that can't reach that
+        # are skipped, and nothing beats a perfect fit.
         best_score = 0
+        best_index = None
         best_temp = None
-        for temp in self.templates:
-            temp_score = temp.similarity(*convo)
-            if temp_score > best_score:
+        floor = self.get_config('training_treshold')
+        for bound, i, temp in self.candidates(convo):
+            if bound < best_score or bound <= floor:
+                break
+            refined = temp.upper_bound(*convo, floor=max(best_score, floor))
+            if refined < best_score or refined <= floor:
+                stats['templates_pruned'] += 1
+                continue
+            stats['template_comparisons'] += 1
+            temp_score = temp.similarity(*convo, floor=max(best_score, floor))
+            if temp_score > best_score or (temp_score == best_score and best_temp and
+                                           (-temp.trained - temp.hits, i) < (-best_temp.trained - best_temp.hits, best_index)):
                 best_score = temp_score
+                best_index = i
                 best_temp = temp
-        if best_score > self.get_config('training_treshold'):
-            best_temp.update(*convo)
+            if best_score >= 1.0:
+                break
+        if best_score > floor:
+            return best_temp
+        return None
+
+    def addConvo(self, convo):
+        # if convo matches existing template, update it. else add a new template
+        best_temp = self.best_template(convo)
+        if not best_temp:
+            best_temp = self.new_template(convo)
+            self.templates.append(best_temp)
         else:
-            self.templates.append(ConvoTemplate(*convo, self.config))
+            best_temp.update(*convo)
+        best_temp.trained += 1
+
+    def usage(temp):
+        return temp.trained + temp.hits
+
+    def closest(self, temp, others, floor):
+        # the template in others that fits temp best both ways, if that is above floor
+        best_score = floor
+        best_temp = None
+        convo = temp.convo()
+        for other in others:
+            if isinstance(other, TurnTemplate) != isinstance(temp, TurnTemplate):
+                continue
+            # merging turn templates pairs up their turns, so they need as many
+            if isinstance(temp, TurnTemplate) and len(other.turns) != len(temp.turns):
+                continue
+            if other.upper_bound(*convo, floor=best_score) <= best_score:
+                continue
+            score = other.similarity(*convo, floor=best_score)
+            if score > best_score:
+                score = min(score, temp.similarity(*other.convo(), floor=best_score))
+            if score > best_score:
+                best_score = score
+                best_temp = other
+        return best_temp
+
+    def absorb(self, temp, other):
+        temp.merge(other)
+        temp.trained += other.trained
+        temp.hits += other.hits
+
+    def compact(self, treshold=None, max_templates=None):
+        # Offline re-clustering. Templates that fit each other better than treshold (the
+        # training treshold by default) are merged, the most used ones take in the others.
+        # That repeats until nothing changes, merged templates can come to fit each other.
+        # Then, with max_templates, the least used templates are merged into their closest
+        # one until the port is under the cap.
+        if treshold is None:
+            treshold = self.get_config('training_treshold')
+        order = {id(t): i for i, t in enumerate(self.templates)}
+        hottest = lambda t: (-PortBaseline.usage(t), order[id(t)])
+        count = None
+        while count != len(self.templates):
+            count = len(self.templates)
+            kept = []
+            for temp in sorted(self.templates, key=hottest):
+                target = self.closest(temp, kept, treshold)
+                if target:
+                    self.absorb(target, temp)
+                else:
+                    kept.append(temp)
+            self.templates = sorted(kept, key=lambda t: order[id(t)])
+        while max_templates and len(self.templates) > max_templates:
+            coldest = max(self.templates, key=hottest)
+            self.templates.remove(coldest)
+            target = self.closest(coldest, self.templates, -1.0)
+            if target:
+                self.absorb(target, coldest)
+            else:
+                logging.warning("Dropped a template of port {}, no template to merge it with".format(self.port))
+
+    def merge(self, other):
+        # templates of other are matched like conversations, by their text
+        for temp in other.templates:
+            best_temp = self.best_template(temp.convo())
+            if best_temp:
+                best_temp.merge(temp)
+            else:
+                best_temp = load_template(temp.dict(), self.config)
+                self.templates.append(best_temp)
+            best_temp.trained += temp.trained
+            best_temp.hits += temp.hits
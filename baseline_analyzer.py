@@ -4,8 +4,7 @@ from packet_analyzer import PacketAnalyzer
 
 class BaselineAnalyzer(PacketAnalyzer):
     def analyze_session(self, packets, proto='TCP'):
-        tcp = packets[0][proto]
-        dst = tcp.dport
+        dst = self.local_end(packets)[1]
         logging.debug("{} packets to destination port {}".format(len(packets),dst))
         convo = self.packets_to_convo(packets)
         if not convo:
@@ -0,0 +1,98 @@
+# Compares loading and size of YAML and binary (.dbl) baselines:
+#   python3 -m benchmarks.bench_baseline --ports 20 --templates 200
+#   python3 -m benchmarks.bench_baseline baseline.yml
+from argparse import ArgumentParser
+from baseline import Baseline, PortBaseline
+from template import ConvoTemplate, Template, TemplateVariable
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def random_template(rng, config):
+    # an http-ish request/response pair with a few variables, like training produces
+    path = '/' + '/'.join(rng.choice(['api', 'cgi-bin', 'static', 'user', 'item']) for _ in range(3))
+    sent = 'GET {}?id={} HTTP/1.1\r\nHost: srv\r\nCookie: s={:032x}\r\n\r\n'.format(
+        path, rng.randint(1, 99999), rng.getrandbits(128)).encode()
+    recv = ('HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n'.format(rng.randint(10, 999)) +
+            path * rng.randint(1, 20)).encode()
+    result = ConvoTemplate(b'', b'', config)
+    for attr, text in (('sent', sent), ('recv', recv)):
+        vars = []
+        pos = 0
+        for _ in range(rng.randint(0, 4)):
+            pos = rng.randint(pos, len(text) - 1)
+            length = rng.randint(1, min(32, len(text) - pos))
+            specials = set(rng.sample([b'?', b'/', b'%', b';'], rng.randint(0, 2)))
+            vars.append(TemplateVariable(pos, length, length // 2, length * 2, specials))
+            pos += length
+            if pos >= len(text):
+                break
+        setattr(result, attr, Template(text, vars, config))
+    return result
+
+
+def synthetic_baseline(ports, templates, seed=1):
+    rng = random.Random(seed)
+    baseline = Baseline()
+    for port in range(ports):
+        portbl = PortBaseline(8000 + port, baseline.config)
+        portbl.templates = [random_template(rng, baseline.config) for _ in range(templates)]
+        baseline.ports[portbl.port] = portbl
+    return baseline
+
+
+def timed_read(path, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        baseline = Baseline.read(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, baseline
+
+
+def main(argv):
+    parser = ArgumentParser(description='Benchmark loading YAML and binary baselines')
+    parser.add_argument('baseline', nargs='?', help='baseline to convert, a synthetic one if omitted')
+    parser.add_argument('--ports', type=int, default=20, help='Ports in the synthetic baseline')
+    parser.add_argument('--templates', type=int, default=200, help='Templates per port in the synthetic baseline')
+    parser.add_argument('--rounds', type=int, default=3, help='Loads per format, the fastest is reported')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.baseline:
+        baseline = Baseline.read(args.baseline)
+    else:
+        baseline = synthetic_baseline(args.ports, args.templates)
+    directory = tempfile.mkdtemp()
+    yml = os.path.join(directory, 'baseline.yml')
+    dbl = os.path.join(directory, 'baseline.dbl')
+    try:
+        baseline.write(yml)
+        baseline.write(dbl)
+        yaml_time, from_yaml = timed_read(yml, args.rounds)
+        binary_time, from_binary = timed_read(dbl, args.rounds)
+        yaml_size = os.path.getsize(yml)
+        binary_size = os.path.getsize(dbl)
+    finally:
+        for path in (yml, dbl):
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rmdir(directory)
+
+    templates = sum(len(p.templates) for p in baseline.ports.values())
+    same = from_yaml.dict() == from_binary.dict()
+    print("templates: {}".format(templates))
+    print("yaml:      {:.3f}s  {:>10} bytes".format(yaml_time, yaml_size))
+    print("binary:    {:.3f}s  {:>10} bytes".format(binary_time, binary_size))
+    print("speedup:   {:.1f}x, {:.0%} of the size".format(yaml_time / binary_time, binary_size / yaml_size))
+    print("identical: {}".format(same))
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
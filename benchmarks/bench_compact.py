@@ -0,0 +1,75 @@
+# Trains a baseline, compacts it and compares detection on held-out traffic:
+#   python3 -m benchmarks.bench_compact
+#   python3 -m benchmarks.bench_compact --max-templates 8 --treshold 0.3
+#   python3 -m benchmarks.bench_compact --train day1/ --held-out day2/ --mymac 02:42:ad:00:00:11
+from argparse import ArgumentParser
+from baseline import Baseline
+from baseline_analyzer import BaselineAnalyzer
+from detection_analyzer import DetectionAnalyzer
+from ingest import read_pcaps
+from report import ReportSink
+from benchmarks.synth import MYMAC, noisy_traffic, write_pcap
+import logging
+import os
+import sys
+import tempfile
+import time
+
+
+def detect(baseline, records, mymac):
+    # the verdict cache is off, every conversation is matched against the templates
+    analyzer = DetectionAnalyzer()
+    analyzer.sink = ReportSink()
+    analyzer.verdicts.size = 0
+    analyzer.baseline = baseline
+    start = time.perf_counter()
+    analyzer.run(iter(records), mymac)
+    return time.perf_counter() - start, analyzer.anomaly_count
+
+
+def main(argv):
+    parser = ArgumentParser(description='Benchmark detection with a compacted baseline')
+    parser.add_argument('--train', nargs='+', help='pcaps to train on, synthetic noisy traffic if omitted')
+    parser.add_argument('--held-out', nargs='+', help='pcaps to detect on, synthetic noisy traffic if omitted')
+    parser.add_argument('--mymac', default=MYMAC)
+    parser.add_argument('--rounds', type=int, default=600, help='Rounds of synthetic training traffic, half for held-out')
+    parser.add_argument('--treshold', type=float, help='Similarity above which templates are merged')
+    parser.add_argument('--max-templates', type=int, default=16, help='Cap on the templates per port, 0 for none')
+    args = parser.parse_args(argv)
+    # detection warns about every anomaly, only the counts are of interest here
+    logging.basicConfig(level=logging.ERROR)
+
+    directory = tempfile.mkdtemp()
+    try:
+        train, held_out = args.train, args.held_out
+        if not train:
+            train = [os.path.join(directory, 'train.pcap')]
+            write_pcap(train[0], noisy_traffic(args.rounds))
+        if not held_out:
+            held_out = [os.path.join(directory, 'held_out.pcap')]
+            write_pcap(held_out[0], noisy_traffic(args.rounds // 2, seed=2))
+        analyzer = BaselineAnalyzer()
+        baseline = analyzer.run(read_pcaps(train), args.mymac)
+        records = list(read_pcaps(held_out))
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    compacted = Baseline.load(baseline.dict())
+    start = time.perf_counter()
+    compacted.compact(args.treshold, args.max_templates)
+    compact_time = time.perf_counter() - start
+
+    full_time, full_anomalies = detect(baseline, records, args.mymac)
+    compact_detect_time, compact_anomalies = detect(compacted, records, args.mymac)
+    print("{:<10} {:>9} {:>10} {:>9}".format('', 'templates', 'detection', 'anomalies'))
+    print("{:<10} {:>9} {:>9.2f}s {:>9}".format('trained', baseline.template_count(), full_time, full_anomalies))
+    print("{:<10} {:>9} {:>9.2f}s {:>9}".format('compacted', compacted.template_count(), compact_detect_time,
+                                                 compact_anomalies))
+    print("compacting took {:.2f}s, detection speedup {:.1f}x".format(compact_time, full_time / compact_detect_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,69 @@
+# Compares the scapy decoder with --fast-decode:
+#   python3 -m benchmarks.bench_decode --rounds 2000
+#   python3 -m benchmarks.bench_decode --scale 200 droids_demo/example_data/live
+from argparse import ArgumentParser
+from scapy.all import RawPcapReader, PcapWriter
+from ingest import read_pcap, list_pcaps
+from benchmarks.synth import demo_traffic, write_pcap
+import logging
+import os
+import sys
+import tempfile
+import time
+
+
+def scale_pcaps(pcaps, scale, out):
+    # repeats the frames of the given pcaps, shifted in time, to get a big capture
+    frames = []
+    for pcap in list_pcaps(pcaps):
+        with RawPcapReader(pcap) as reader:
+            frames += [(data, meta.sec + meta.usec / 1e6) for data, meta in reader]
+    if not frames:
+        return 0
+    span = frames[-1][1] - frames[0][1] + 1
+    writer = PcapWriter(out, linktype=1, sync=False)
+    writer.write_header(None)
+    for i in range(scale):
+        for data, t in frames:
+            writer.write_packet(data, sec=int(t + i * span), usec=int((t % 1) * 1e6))
+    writer.close()
+    return len(frames) * scale
+
+
+def timed(pcap, fast):
+    start = time.perf_counter()
+    records = list(read_pcap(pcap, fast))
+    return time.perf_counter() - start, records
+
+
+def main(argv):
+    parser = ArgumentParser(description='Benchmark the scapy and fast packet decoders')
+    parser.add_argument('pcap', nargs='*', help='pcaps to scale up, synthetic demo traffic if omitted')
+    parser.add_argument('--scale', type=int, default=50, help='How often the given pcaps are repeated')
+    parser.add_argument('--rounds', type=int, default=1000, help='Rounds of synthetic demo traffic')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    fd, path = tempfile.mkstemp(suffix='.pcap')
+    os.close(fd)
+    try:
+        if args.pcap:
+            count = scale_pcaps(args.pcap, args.scale, path)
+        else:
+            count = write_pcap(path, demo_traffic(args.rounds, attacks=args.rounds // 100))
+        scapy_time, scapy_records = timed(path, False)
+        fast_time, fast_records = timed(path, True)
+    finally:
+        os.unlink(path)
+
+    mismatches = sum(1 for a, b in zip(scapy_records, fast_records) if a != b)
+    print("packets:   {}".format(count))
+    print("scapy:     {:.3f}s  {:>10.0f} packets/s".format(scapy_time, count / scapy_time))
+    print("fast:      {:.3f}s  {:>10.0f} packets/s".format(fast_time, count / fast_time))
+    print("speedup:   {:.1f}x".format(scapy_time / fast_time))
+    print("mismatches: {}".format(mismatches))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,65 @@
+# Compares the diff engines of diff.py on inputs of growing size:
+#   python3 -m benchmarks.bench_diff
+#   python3 -m benchmarks.bench_diff --sizes 256 1024 --pairs 50
+#   python3 -m benchmarks.bench_diff --sizes 16384 65536 262144 --engines anchored myers
+from argparse import ArgumentParser
+from diff import AnchoredMatcher, BACKENDS, make_matcher
+import random
+import sys
+import time
+
+
+# (name, edits per 100 bytes) from a changed cookie to an unrelated conversation
+EDIT_RATES = [('similar', 0.3), ('changed', 2), ('diverse', 12)]
+ALPHABET = b'GET /abcdefghijk HTTP/1.1\r\nHost: '
+
+
+def mutate(rng, text, edits):
+    text = bytearray(text)
+    for _ in range(edits):
+        pos = rng.randrange(len(text))
+        text[pos:pos + rng.randint(0, 5)] = bytes(rng.randint(97, 122) for _ in range(rng.randint(0, 8)))
+    return bytes(text)
+
+
+def new_matcher(engine, b):
+    if engine == 'anchored':
+        return AnchoredMatcher(b, 'myers')
+    return make_matcher(engine, b)
+
+
+def timed(engine, pairs):
+    start = time.perf_counter()
+    ratios = []
+    for a, b in pairs:
+        matcher = new_matcher(engine, b)
+        matcher.set_seq1(a)
+        matcher.get_opcodes()
+        ratios.append(matcher.ratio())
+    return (time.perf_counter() - start) / len(pairs), sum(ratios) / len(ratios)
+
+
+def main(argv):
+    parser = ArgumentParser(description='Benchmark the diff engines used for template matching')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256, 1024, 4096])
+    parser.add_argument('--pairs', type=int, default=10, help='Diffs per size and edit rate')
+    parser.add_argument('--engines', nargs='+', default=sorted(BACKENDS) + ['anchored'],
+                        choices=sorted(BACKENDS) + ['anchored'], help='anchored is used for long texts')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(1)
+    backends = args.engines
+    print("{:>6} {:>8} ".format('size', 'edits') + ' '.join('{:>16}'.format(b) for b in backends))
+    for size in args.sizes:
+        for name, rate in EDIT_RATES:
+            template = bytes(rng.choice(ALPHABET) for _ in range(size))
+            edits = max(1, int(size * rate / 100))
+            pairs = [(template, mutate(rng, template, edits)) for _ in range(args.pairs)]
+            results = [timed(backend, pairs) for backend in backends]
+            print("{:>6} {:>8} ".format(size, name) +
+                  ' '.join('{:>9.2f}ms {:.2f}'.format(t * 1000, ratio) for t, ratio in results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
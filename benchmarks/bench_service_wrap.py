@@ -0,0 +1,185 @@
+# Compares the epoll based service_wrap with the old select one (legacy_service_wrap.py)
+# and with no wrapper, around droids_demo/service_echo.py and a service that prompts without
+# a newline. Like under inetd the wrapper gets one end of a socket as stdin, stdout and stderr:
+#   python3 -m benchmarks.bench_service_wrap
+#   python3 -m benchmarks.bench_service_wrap --rounds 2000 --megabytes 8
+from argparse import ArgumentParser
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ECHO = os.path.join(ROOT, 'droids_demo', 'service_echo.py')
+WRAPPERS = {
+    'direct': None,
+    'legacy': os.path.join(ROOT, 'benchmarks', 'legacy_service_wrap.py'),
+    'epoll': os.path.join(ROOT, 'droids_demo', 'service_wrap.py'),
+}
+# asks for a name and greets, the prompt has no newline
+PROMPT = """
+while True:
+    print('name? ', end='', flush=True)
+    try:
+        name = input()
+    except EOFError:
+        break
+    print('hello', name, flush=True)
+"""
+TIMEOUT = 20
+
+
+def start(wrapper, service):
+    ours, theirs = socket.socketpair()
+    command = service if wrapper is None else [sys.executable, wrapper] + service
+    process = subprocess.Popen(command, stdin=theirs, stdout=theirs, stderr=theirs)
+    theirs.close()
+    ours.settimeout(TIMEOUT)
+    return process, ours
+
+
+def receive(sock, size):
+    data = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            break
+        data.append(chunk)
+        size -= len(chunk)
+    return b''.join(data)
+
+
+def send(sock, data, end=False):
+    # runs in a thread, the reader notices when a wrapper dies halfway
+    try:
+        sock.sendall(data)
+        if end:
+            sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def stop(process, sock):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+    sock.close()
+    try:
+        process.wait(TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def latency(wrapper, rounds):
+    # round trips of a short line, the echo service answers each line right away
+    process, sock = start(wrapper, [sys.executable, '-u', ECHO])
+    times = []
+    try:
+        for i in range(rounds):
+            line = 'ping {}\n'.format(i).encode()
+            begin = time.perf_counter()
+            sock.sendall(line)
+            if receive(sock, len(line)) != line:
+                return None
+            times.append(time.perf_counter() - begin)
+    except OSError:
+        return None
+    finally:
+        stop(process, sock)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99)]
+
+
+def prompt_latency(wrapper, rounds):
+    # time from sending a name until the greeting and the next prompt are in
+    process, sock = start(wrapper, [sys.executable, '-c', PROMPT])
+    times = []
+    try:
+        if receive(sock, 6) != b'name? ':
+            return None
+        for i in range(rounds):
+            name = 'bob{}'.format(i).encode()
+            answer = b'hello ' + name + b'\nname? '
+            begin = time.perf_counter()
+            sock.sendall(name + b'\n')
+            if receive(sock, len(answer)) != answer:
+                return None
+            times.append(time.perf_counter() - begin)
+    except OSError:
+        return None
+    finally:
+        stop(process, sock)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.99)]
+
+
+def throughput(wrapper, megabytes):
+    # lines are sent while the echoes are read, megabytes per second through the service
+    lines = [b'line %d of the throughput test\n' % i for i in range(megabytes * 1024 * 1024 // 32)]
+    data = b''.join(lines)
+    process, sock = start(wrapper, [sys.executable, '-u', ECHO])
+    sender = threading.Thread(target=send, args=(sock, data), daemon=True)
+    begin = time.perf_counter()
+    try:
+        sender.start()
+        result = receive(sock, len(data))
+    except OSError:
+        result = None
+    elapsed = time.perf_counter() - begin
+    stop(process, sock)
+    if result != data:
+        return None
+    return len(data) / elapsed / 1e6
+
+
+def binary_intact(wrapper, size=1 << 20):
+    # random bytes through cat have to come back unchanged, lines stay below the input
+    # rules' length limit
+    data = random.Random(1).randbytes(size).replace(b'fido', b'fid0').replace(b'FLAG', b'FLAX')
+    process, sock = start(wrapper, ['cat'])
+    threading.Thread(target=send, args=(sock, data, True), daemon=True).start()
+    try:
+        result = receive(sock, size)
+    except OSError:
+        result = None
+    stop(process, sock)
+    return result == data
+
+
+def main(argv):
+    parser = ArgumentParser(description='Benchmark the service wrappers around the echo and a prompt service')
+    parser.add_argument('--rounds', type=int, default=500, help='Round trips for the latency tests')
+    parser.add_argument('--megabytes', type=int, default=2, help='Data sent in the throughput test')
+    parser.add_argument('--wrappers', nargs='+', default=list(WRAPPERS), choices=list(WRAPPERS))
+    args = parser.parse_args(argv)
+
+    print("{:<8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>8}".format(
+        'wrapper', 'median rtt', 'p99 rtt', 'prompt rtt', 'prompt p99', 'throughput', 'binary'))
+    ms = lambda t: '{:.3f}ms'.format(t * 1000)
+    for name in args.wrappers:
+        wrapper = WRAPPERS[name]
+        rtt = latency(wrapper, args.rounds)
+        prompt = prompt_latency(wrapper, args.rounds)
+        rate = throughput(wrapper, args.megabytes)
+        intact = binary_intact(wrapper)
+        print("{:<8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>8}".format(
+            name,
+            ms(rtt[0]) if rtt else 'failed',
+            ms(rtt[1]) if rtt else 'failed',
+            ms(prompt[0]) if prompt else 'failed',
+            ms(prompt[1]) if prompt else 'failed',
+            '{:.1f}MB/s'.format(rate) if rate else 'failed',
+            'intact' if intact else 'mangled'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,127 @@
+# Times every stage of a training and a detection run on synthetic traffic and writes
+# the results as json, so runs can be compared to catch regressions:
+#   python3 -m benchmarks.bench_suite --output before.json
+#   python3 -m benchmarks.bench_suite --sessions 20000 --ports 8 --payload-size 256 --compare before.json
+#   python3 -m benchmarks.bench_suite --attack-rate 0.05 --attacks injection flag --fast-decode
+from argparse import ArgumentParser
+from baseline import Baseline
+from baseline_analyzer import BaselineAnalyzer
+from detection_analyzer import DetectionAnalyzer
+from flow import FlowTable
+from ingest import read_pcaps
+from report import ReportSink
+from benchmarks.synth import ATTACKS, MYMAC, synthetic_traffic, write_pcap
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+
+class Stages:
+    # seconds and processed items per stage, in the order they ran
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, items, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        count = items(result) if callable(items) else items
+        self.results[name] = {'seconds': elapsed, 'items': count,
+                              'per_second': count / elapsed if elapsed else None}
+        return result
+
+
+def sessionize(records):
+    # only the flow table, every closed flow is dropped
+    flows = FlowTable(lambda flow: None)
+    for record in records:
+        flows.add(record)
+    flows.flush()
+    return flows.flow_count
+
+
+def detect(baseline, records, workers):
+    analyzer = DetectionAnalyzer()
+    analyzer.sink = ReportSink()
+    analyzer.workers = workers
+    analyzer.baseline = baseline
+    analyzer.run(iter(records), MYMAC)
+    return analyzer.anomaly_count
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)['stages']
+    print("{:<16} {:>10} {:>10} {:>8}".format('stage', 'before', 'after', 'change'))
+    for name, stage in results.items():
+        if name in old:
+            before, after = old[name]['seconds'], stage['seconds']
+            print("{:<16} {:>9.3f}s {:>9.3f}s {:>+7.0%}".format(name, before, after, after / before - 1 if before else 0))
+
+
+def main(argv):
+    parser = ArgumentParser(description='Time every stage of droids on synthetic traffic')
+    parser.add_argument('--sessions', type=int, default=2000, help='Training sessions, detection gets half as many')
+    parser.add_argument('--ports', type=int, default=2, help='Number of cgi and echo services')
+    parser.add_argument('--payload-size', type=int, default=16, help='Average size of echo lines and cgi listings')
+    parser.add_argument('--attack-rate', type=float, default=0.01, help='Fraction of detection sessions that attack')
+    parser.add_argument('--attacks', nargs='+', choices=sorted(ATTACKS), help='Kinds of attacks, all by default')
+    parser.add_argument('--fast-decode', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='Detection processes')
+    parser.add_argument('--output', help='Write the results to this json file')
+    parser.add_argument('--compare', help='json file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    # detection warns about every anomaly
+    logging.basicConfig(level=logging.ERROR)
+
+    stages = Stages()
+    directory = tempfile.mkdtemp()
+    train_pcap = os.path.join(directory, 'train.pcap')
+    live_pcap = os.path.join(directory, 'live.pcap')
+    yml = os.path.join(directory, 'baseline.yml')
+    dbl = os.path.join(directory, 'baseline.dbl')
+    try:
+        stages.run('synthesize', lambda packets: packets, write_pcap, train_pcap,
+                   synthetic_traffic(args.sessions, args.ports, args.payload_size))
+        write_pcap(live_pcap, synthetic_traffic(args.sessions // 2, args.ports, args.payload_size,
+                                                args.attack_rate, args.attacks, seed=2))
+        train = stages.run('ingest', len, lambda: list(read_pcaps([train_pcap], args.fast_decode)))
+        live = list(read_pcaps([live_pcap], args.fast_decode))
+        stages.run('sessionize', len(train), sessionize, train)
+        baseline = stages.run('baseline', len(train), BaselineAnalyzer().run, iter(train), MYMAC)
+        templates = baseline.template_count()
+        stages.run('save_yaml', templates, baseline.write, yml)
+        stages.run('save_binary', templates, baseline.write, dbl)
+        stages.run('load_yaml', templates, Baseline.read, yml)
+        baseline = stages.run('load_binary', templates, Baseline.read, dbl)
+        anomalies = stages.run('detection', len(live), detect, baseline, live, args.workers)
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    results = {
+        'parameters': vars(args),
+        'python': platform.python_version(),
+        'templates': templates,
+        'anomalies': anomalies,
+        'stages': stages.results,
+    }
+    print("{:<16} {:>10} {:>10} {:>12}".format('stage', 'seconds', 'items', 'items/s'))
+    for name, stage in stages.results.items():
+        print("{:<16} {:>10.3f} {:>10} {:>12.0f}".format(name, stage['seconds'], stage['items'], stage['per_second'] or 0))
+    print("{} templates, {} distinct anomalies".format(templates, anomalies))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(stages.results, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
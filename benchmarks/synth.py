@@ -0,0 +1,172 @@
+# Offline generator for traffic that looks like the droids_demo services, so benchmarks
+# don't need docker. Run benchmarks as modules from the repository root:
+#   python3 -m benchmarks.bench_decode
+#   python3 -m benchmarks.bench_suite --sessions 20000 --ports 8
+import random
+from scapy.all import Ether, IP, TCP, Raw, PcapWriter
+
+MYMAC = '02:42:ad:00:00:11'
+GATEWAY_MAC = '02:42:3e:00:00:01'
+MYIP = '172.17.0.2'
+GATEWAY_IP = '172.17.0.1'
+
+USERS = {'accounting': b'alice\njohn\n', 'purchase': b'bob\n'}
+
+
+def tcp_session(port, request, response, sport, start):
+    # handshake, one request, one response and a teardown, like curl and nc do
+    packets = []
+    ends = {
+        'client': (Ether(src=GATEWAY_MAC, dst=MYMAC) / IP(src=GATEWAY_IP, dst=MYIP), sport, port),
+        'server': (Ether(src=MYMAC, dst=GATEWAY_MAC) / IP(src=MYIP, dst=GATEWAY_IP), port, sport),
+    }
+    seq = {'client': random.randint(0, 2**31), 'server': random.randint(0, 2**31)}
+
+    def add(side, flags, load=b''):
+        other = 'server' if side == 'client' else 'client'
+        base, src_port, dst_port = ends[side]
+        p = base / TCP(sport=src_port, dport=dst_port, flags=flags, seq=seq[side], ack=seq[other])
+        if load:
+            p = p / Raw(load)
+        p.time = start + len(packets) * 0.0005
+        seq[side] += len(load) + (1 if 'S' in flags or 'F' in flags else 0)
+        packets.append(p)
+
+    add('client', 'S')
+    add('server', 'SA')
+    add('client', 'A')
+    add('client', 'PA', request)
+    add('server', 'PA', response)
+    add('server', 'FA')
+    add('client', 'FA')
+    add('server', 'A')
+    return packets
+
+
+def echo_session(sport, start, line=b'hallo', port=7):
+    return tcp_session(port, line + b'\n', line + b'\n', sport, start)
+
+
+def cgi_session(sport, start, query=None, listing=None, port=80):
+    if query is None:
+        query = random.choice(list(USERS))
+    if listing is None:
+        listing = USERS.get(query, b'')
+    request = ('GET /cgi-bin/service_cgi.py?{} HTTP/1.1\r\nHost: localhost:8881\r\n'
+               'User-Agent: curl/7.58.0\r\nAccept: */*\r\n\r\n').format(query).encode()
+    response = b'HTTP/1.0 200 Found\r\nContent-Type: text/plain\r\n\r\n' + listing
+    return tcp_session(port, request, response, sport, start)
+
+
+def attack_sessions(sport, start):
+    return cgi_session(sport, start, ';cat%20/etc/passwd', b'root:x:0:0:root:/root:/bin/ash\n') + \
+        tcp_session(7, b'give-me-flag!\n', b'FLAG{ABCCIDIEIEJEEJEJJJBJGJIEJIEJBIJ}\n', sport + 1, start + 0.5)
+
+
+def demo_traffic(rounds, attacks=0, start=1546888826.0, seed=1):
+    # the jury loop of generate_pcaps.sh: an echo and a cgi request per round
+    random.seed(seed)
+    sport = 32768
+    attack_rounds = set(random.sample(range(rounds), min(attacks, rounds)))
+    for i in range(rounds):
+        t = start + i
+        yield from echo_session(sport, t)
+        yield from cgi_session(sport + 1, t + 0.2)
+        if i in attack_rounds:
+            yield from attack_sessions(sport + 2, t + 0.4)
+        sport = 32768 + (sport + 4 - 32768) % 28000
+
+
+# (service, request, response) of the attacks synthetic_traffic can mix in
+ATTACKS = {
+    'injection': ('cgi', ';cat%20/etc/passwd', b'root:x:0:0:root:/root:/bin/ash\n'),
+    'traversal': ('cgi', '../../../etc/shadow', b'root:!::0:::::\n'),
+    'flag': ('echo', b'give-me-flag!', b'FLAG{ABCCIDIEIEJEEJEJJJBJGJIEJIEJBIJ}'),
+    'overflow': ('echo', b'A' * 2048, b'A' * 2048),
+}
+
+
+def service_ports(ports):
+    # the demo's http and echo service first, more of both on higher ports
+    services = [('cgi', 80), ('echo', 7)]
+    for i in range(2, ports):
+        services.append(('cgi', 8000 + i) if i % 2 == 0 else ('echo', 7000 + i))
+    return services[:ports]
+
+
+def random_text(rng, size, alphabet=b'abcdefghijklmnopqrstuvwxyz'):
+    # about size bytes, give or take half
+    return bytes(rng.choice(alphabet) for _ in range(rng.randint(max(1, size // 2), max(1, size * 3 // 2))))
+
+
+def synthetic_traffic(sessions, ports=2, payload_size=16, attack_rate=0.0, attacks=None, start=1546888826.0, seed=1):
+    # Sessions spread evenly over the services of service_ports. Echo lines and cgi
+    # listings are about payload_size bytes, attack_rate of the sessions are attacks of a
+    # kind picked from attacks (all of ATTACKS by default). Yields the packets in order.
+    random.seed(seed)
+    rng = random.Random(seed)
+    services = service_ports(ports)
+    attacks = sorted(attacks or ATTACKS)
+    sport = 32768
+    for i in range(sessions):
+        t = start + i * 0.01
+        if rng.random() < attack_rate:
+            kind, request, response = ATTACKS[rng.choice(attacks)]
+            port = rng.choice([p for service, p in services if service == kind] or [7 if kind == 'echo' else 80])
+        else:
+            kind, port = rng.choice(services)
+            request = response = None
+        if kind == 'cgi':
+            if request is None:
+                request = rng.choice(list(USERS))
+                response = b''.join(random_text(rng, 8) + b'\n' for _ in range(max(1, payload_size // 8)))
+            yield from cgi_session(sport, t, request, response, port)
+        else:
+            line = request or random_text(rng, payload_size)
+            yield from tcp_session(port, line + b'\n', (response or line) + b'\n', sport, t)
+        sport = 32768 + (sport + 1 - 32768) % 28000
+
+
+KV_PORT = 6379
+KV_WORDS = [b'user', b'session', b'cart', b'item', b'price', b'stock', b'token', b'order']
+
+
+def kv_session(sport, start, rng):
+    # A chatty key value store with keys and values of any length, every command type
+    # grows its own handful of templates during training.
+    key = b':'.join(rng.choice(KV_WORDS) for _ in range(rng.randint(1, 4))) + str(rng.randint(0, 10 ** rng.randint(1, 8))).encode()
+    value = bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(rng.choice([2, 8, 40, 200])))
+    command = rng.choice(['get', 'set', 'del', 'keys'])
+    if command == 'get':
+        request, response = b'GET ' + key, b'$' + str(len(value)).encode() + b'\r\n' + value
+    elif command == 'set':
+        request, response = b'SET ' + key + b' ' + value, b'+OK'
+    elif command == 'del':
+        request, response = b'DEL ' + key, b':' + str(rng.randint(0, 1)).encode()
+    else:
+        keys = [key + b':' + rng.choice(KV_WORDS) for _ in range(rng.randint(0, 6))]
+        request, response = b'KEYS ' + key + b'*', b'*' + str(len(keys)).encode() + b'\r\n' + b'\r\n'.join(keys)
+    return tcp_session(KV_PORT, request + b'\r\n', response + b'\r\n', sport, start)
+
+
+def noisy_traffic(rounds, start=1546888826.0, seed=1):
+    # demo traffic plus a kv session per round, for benchmarks that need many templates
+    random.seed(seed)
+    rng = random.Random(seed)
+    sport = 32768
+    for i in range(rounds):
+        t = start + i
+        yield from echo_session(sport, t)
+        yield from cgi_session(sport + 1, t + 0.2)
+        yield from kv_session(sport + 2, t + 0.4, rng)
+        sport = 32768 + (sport + 4 - 32768) % 28000
+
+
+def write_pcap(path, packets):
+    writer = PcapWriter(path, linktype=1, sync=False)
+    count = 0
+    for p in packets:
+        writer.write(p)
+        count += 1
+    writer.close()
+    return count
@@ -0,0 +1,137 @@
+import struct
+
+
+# Compact baseline files: a magic, a format version and then the baseline, written field
+# by field by the pack() methods of the baseline classes. Integers are unsigned and big
+# endian, byte strings are length prefixed. The config is stored as tagged values since
+# it is a free form dict.
+MAGIC = b'DROIDSBL'
+VERSION = 3
+EXTENSIONS = ('.dbl',)
+
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_FLOAT, TAG_BYTES, TAG_STR, TAG_LIST, TAG_DICT, TAG_SET = range(10)
+
+
+class BinaryFormatError(Exception):
+    pass
+
+
+def is_binary_name(filename):
+    return filename.lower().endswith(EXTENSIONS)
+
+
+class BinaryWriter:
+    def __init__(self):
+        self.parts = [MAGIC, U16.pack(VERSION)]
+
+    def u16(self, i):
+        self.parts.append(U16.pack(i))
+
+    def u32(self, i):
+        self.parts.append(U32.pack(i))
+
+    def bytes(self, b):
+        self.parts.append(U32.pack(len(b)))
+        self.parts.append(b)
+
+    def value(self, v):
+        if v is None:
+            self.parts.append(bytes((TAG_NONE,)))
+        elif v is True or v is False:
+            self.parts.append(bytes((TAG_TRUE if v else TAG_FALSE,)))
+        elif isinstance(v, int):
+            self.parts.append(bytes((TAG_INT,)) + I64.pack(v))
+        elif isinstance(v, float):
+            self.parts.append(bytes((TAG_FLOAT,)) + F64.pack(v))
+        elif isinstance(v, bytes):
+            self.parts.append(bytes((TAG_BYTES,)))
+            self.bytes(v)
+        elif isinstance(v, str):
+            self.parts.append(bytes((TAG_STR,)))
+            self.bytes(v.encode())
+        elif isinstance(v, (list, tuple, set)):
+            self.parts.append(bytes((TAG_SET if isinstance(v, set) else TAG_LIST,)))
+            self.u32(len(v))
+            for i in v:
+                self.value(i)
+        elif isinstance(v, dict):
+            self.parts.append(bytes((TAG_DICT,)))
+            self.u32(len(v))
+            for k, i in v.items():
+                self.value(k)
+                self.value(i)
+        else:
+            raise BinaryFormatError("Can't store {!r} in a binary baseline".format(v))
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class BinaryReader:
+    def __init__(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise BinaryFormatError("Not a binary baseline")
+        self.data = memoryview(data)
+        self.pos = len(MAGIC)
+        self.version = self.u16()
+        if self.version > VERSION:
+            raise BinaryFormatError("Binary baseline version {} is newer than this droids ({})".format(self.version, VERSION))
+
+    def unpack(self, s):
+        # a truncated file is a format error, Baseline.read reports it
+        try:
+            i, = s.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise BinaryFormatError("Binary baseline is truncated")
+        self.pos += s.size
+        return i
+
+    def u16(self):
+        return self.unpack(U16)
+
+    def u32(self):
+        return self.unpack(U32)
+
+    def bytes(self):
+        n = self.u32()
+        b = self.data[self.pos:self.pos + n].tobytes()
+        if len(b) != n:
+            raise BinaryFormatError("Binary baseline is truncated")
+        self.pos += n
+        return b
+
+    def value(self):
+        if self.pos >= len(self.data):
+            raise BinaryFormatError("Binary baseline is truncated")
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_FALSE:
+            return False
+        if tag == TAG_TRUE:
+            return True
+        if tag == TAG_INT:
+            return self.unpack(I64)
+        if tag == TAG_FLOAT:
+            return self.unpack(F64)
+        if tag == TAG_BYTES:
+            return self.bytes()
+        if tag == TAG_STR:
+            return self.bytes().decode()
+        if tag == TAG_LIST:
+            return [self.value() for _ in range(self.u32())]
+        if tag == TAG_SET:
+            return {self.value() for _ in range(self.u32())}
+        if tag == TAG_DICT:
+            result = {}
+            for _ in range(self.u32()):
+                k = self.value()
+                result[k] = self.value()
+            return result
+        raise BinaryFormatError("Unknown value tag {} in binary baseline".format(tag))
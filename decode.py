@@ -0,0 +1,103 @@
+from collections import namedtuple
+from socket import inet_ntoa
+import struct
+from scapy.all import conf, Raw
+
+
+# The only parts of a packet the analyzers look at. Both decoders below produce these, so
+# everything downstream is independent of how a pcap was read.
+PacketRecord = namedtuple('PacketRecord', ['time', 'src_mac', 'dst_mac', 'proto', 'src', 'sport',
+                                           'dst', 'dport', 'flags', 'seq', 'payload'])
+
+ETHERTYPE_IPV4 = 0x0800
+VLAN_ETHERTYPES = (0x8100, 0x88a8, 0x9100)
+LINKTYPE_ETHERNET = 1
+TCP_HEADER = struct.Struct('!HHIIH')
+UDP_HEADER = struct.Struct('!HH')
+
+
+def flow_key(record):
+    # normalized so both directions of a conversation get the same key
+    if record.proto is None:
+        return None
+    a = (record.src, record.sport)
+    b = (record.dst, record.dport)
+    if b < a:
+        a, b = b, a
+    return (record.proto, a, b)
+
+
+def from_scapy(packet, time=None):
+    if time is None:
+        time = float(packet.time)
+    src_mac = dst_mac = None
+    if 'Ether' in packet:
+        src_mac = packet['Ether'].src
+        dst_mac = packet['Ether'].dst
+    if 'IP' not in packet or ('TCP' not in packet and 'UDP' not in packet):
+        return PacketRecord(time, src_mac, dst_mac, None, None, None, None, None, None, None, b'')
+    ip = packet['IP']
+    payload = packet[Raw].load if Raw in packet else b''
+    if 'TCP' in packet:
+        tcp = packet['TCP']
+        return PacketRecord(time, src_mac, dst_mac, 'TCP', ip.src, tcp.sport, ip.dst, tcp.dport,
+                            int(tcp.flags), tcp.seq, payload)
+    udp = packet['UDP']
+    return PacketRecord(time, src_mac, dst_mac, 'UDP', ip.src, udp.sport, ip.dst, udp.dport,
+                        None, None, payload)
+
+
+def decode_ether(data, time):
+    # Parses Ethernet/IPv4/TCP/UDP straight from the frame. Returns None for anything it
+    # does not understand (VLAN tags, fragments, truncated headers), the caller should hand
+    # those to scapy.
+    if len(data) < 14:
+        return None
+    src_mac = data[6:12].hex(':')
+    dst_mac = data[0:6].hex(':')
+    ethertype = (data[12] << 8) | data[13]
+    if ethertype in VLAN_ETHERTYPES:
+        return None
+    if ethertype != ETHERTYPE_IPV4:
+        return PacketRecord(time, src_mac, dst_mac, None, None, None, None, None, None, None, b'')
+    if len(data) < 34 or data[14] >> 4 != 4:
+        return None
+    ihl = (data[14] & 0x0f) * 4
+    total_len = (data[16] << 8) | data[17]
+    frag = ((data[20] << 8) | data[21]) & 0x3fff
+    if ihl < 20 or frag:
+        return None
+    end = 14 + total_len if total_len else len(data)
+    start = 14 + ihl
+    proto = data[23]
+    if proto == 6:
+        if len(data) < start + 20:
+            return None
+        sport, dport, seq, _, off_flags = TCP_HEADER.unpack_from(data, start)
+        payload_start = start + (off_flags >> 12) * 4
+        if payload_start > end:
+            return None
+        return PacketRecord(time, src_mac, dst_mac, 'TCP', inet_ntoa(data[26:30]), sport,
+                            inet_ntoa(data[30:34]), dport, off_flags & 0x1ff, seq, data[payload_start:end])
+    if proto == 17:
+        if len(data) < start + 8:
+            return None
+        sport, dport = UDP_HEADER.unpack_from(data, start)
+        return PacketRecord(time, src_mac, dst_mac, 'UDP', inet_ntoa(data[26:30]), sport,
+                            inet_ntoa(data[30:34]), dport, None, None, data[start + 8:end])
+    return PacketRecord(time, src_mac, dst_mac, None, None, None, None, None, None, None, b'')
+
+
+def decode_scapy(data, time, linktype):
+    cls = conf.l2types.num2layer.get(linktype, conf.raw_layer)
+    return from_scapy(cls(data), time)
+
+
+def decode_raw(data, time, linktype):
+    # fast path with a scapy fallback for frames decode_ether can't handle
+    record = None
+    if linktype == LINKTYPE_ETHERNET:
+        record = decode_ether(data, time)
+    if record is None:
+        record = decode_scapy(data, time, linktype)
+    return record
@@ -1,56 +1,146 @@
 import logging
+import signal
+from collections import deque
+from multiprocessing import Pool
 from packet_analyzer import PacketAnalyzer
 from anomaly import Anomaly
-from util import printable
+from report import TextSink
+from template import convo_texts, flat_convo
+from util import fingerprint, LRUCache
+
+
+worker_baseline = None
+
+
+def init_worker(baseline):
+    # every worker process gets its own copy of the baseline once, at startup. Ctrl-C is
+    # for the main process, it still collects the results of the queued conversations.
+    global worker_baseline
+    worker_baseline = baseline
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def check_convo(dst, convo):
+    return worker_baseline.match(dst, convo)
 
 
 class DetectionAnalyzer(PacketAnalyzer):
+    # conversations queued per worker before the analyzer waits for results
+    MAX_PENDING = 16
+    VERDICT_CACHE_SIZE = 4096
+
     def __init__(self):
         super().__init__()
-        self.trunc_messages = 1024
-        self.anomalies = []
+        # Anomalies are written to the sink when they are first found, after that only
+        # their counts are kept, by fingerprint.
+        self.sink = TextSink()
+        self.anomaly_count = 0
+        self.seen = {}
+        self.workers = 1
+        self.pool = None
+        self.pending = deque()
+        self.verdicts = LRUCache(DetectionAnalyzer.VERDICT_CACHE_SIZE)
+        self.verdicts_baseline = None
+        # A run reports every distinct anomaly once. Live runs go on for days, they only
+        # keep recent ones to skip repeats.
+        self.live = False
+        self.reported = LRUCache(DetectionAnalyzer.VERDICT_CACHE_SIZE)
+
+    def cached_verdict(self, key):
+        # verdicts are only valid for the baseline that produced them
+        if self.verdicts_baseline is not self.baseline:
+            self.verdicts.clear()
+            self.verdicts_baseline = self.baseline
+        return self.verdicts.get(key)
 
     def analyze_session(self, packets, proto='TCP'):
-        tcp = packets[0][proto]
-        dst = tcp.dport
+        dst = self.local_end(packets)[1]
         logging.debug("{} packets to destination port {}".format(len(packets),dst))
         convo = self.packets_to_convo(packets)
         if not convo:
             return
-        message, score = self.baseline.checkConvo(dst, convo)
-        if score > 0.1:
-            self.anomalies.append(Anomaly(*convo, dst, message, score))
-            logging.warning(message)
+        key = fingerprint(str(dst).encode(), *convo_texts(convo))
+        # who sent it and when, for the report
+        origin = (self.first_packet(packets).src, packets[0].time, packets[-1].time)
+        verdict = self.cached_verdict(key)
+        if verdict is not None:
+            self.check_result(dst, convo, *verdict, key=key, origin=origin)
+        elif self.pool:
+            self.pending.append((dst, convo, key, origin, self.pool.apply_async(check_convo, (dst, convo))))
+            self.collect(block=len(self.pending) > self.workers * self.MAX_PENDING)
         else:
+            verdict = self.baseline.match(dst, convo)
+            self.verdicts.put(key, verdict)
+            self.check_result(dst, convo, *verdict, key=key, origin=origin)
+
+    def collect(self, block=False):
+        # results are merged in submission order, so the outcome equals a sequential run
+        while self.pending and (block or self.pending[0][-1].ready()):
+            dst, convo, key, origin, result = self.pending.popleft()
+            verdict = result.get()
+            self.verdicts.put(key, verdict)
+            self.check_result(dst, convo, *verdict, key=key, origin=origin)
+            block = False
+
+    def check_result(self, dst, convo, message, score, index=None, key=None, origin=None):
+        # hits are counted here and not in the workers, they have their own baseline copy
+        if index is not None:
+            self.baseline.record_hit(dst, index)
+        if score <= 0.1:
             logging.debug("Session matches the baseline.")
+            return
+        logging.warning(message)
+        if key is None:
+            key = fingerprint(str(dst).encode(), *convo_texts(convo))
+        anomaly = self.reported.get(key) if self.live else self.seen.get(key)
+        if anomaly is None:
+            anomaly = Anomaly(*flat_convo(convo), dst, message, score, key)
+            anomaly.seen(*origin or ())
+            if self.live:
+                self.reported.put(key, anomaly)
+            else:
+                self.seen[key] = anomaly
+            self.anomaly_count += 1
+            self.sink.write(anomaly)
+            anomaly.release()
+        else:
+            anomaly.seen(*origin or ())
 
-    def post_analysis(self):
-        anom = []
-        for a in self.anomalies:
-            if a not in anom:
-                anom.append(a)
+    def anomalies(self):
+        # the distinct anomalies of the run, without their payloads. Live runs only keep
+        # the recent ones, anomaly_count has the total.
+        if self.live:
+            return list(self.reported.items.values())
+        return list(self.seen.values())
+
+    def start(self, mymac=None):
+        super().start(mymac)
+        self.sink.start()
 
-        self.anomalies = sorted(anom, reverse=True)
+    def run(self, packets, mymac=None):
+        if self.workers <= 1:
+            return super().run(packets, mymac)
+        with Pool(self.workers, init_worker, (self.baseline,)) as pool:
+            self.pool = pool
+            try:
+                return super().run(packets, mymac)
+            finally:
+                self.pool = None
+                self.pending.clear()
+
+    def idle(self):
+        # results of the pool are reported while the capture is quiet, not at the next flow
+        super().idle()
+        self.collect()
+
+    def post_analysis(self):
+        while self.pending:
+            self.collect(block=True)
+        logging.info('Verdict cache: {} hits, {} misses'.format(self.verdicts.hits, self.verdicts.misses))
+        if self.stats is not None:
+            self.stats.counts['verdict_cache_hits'] = self.verdicts.hits
+            self.stats.counts['verdict_cache_misses'] = self.verdicts.misses
+        self.sink.finish(self.anomalies(), self.anomaly_count)
 
     def banner(self):
         return "==== IDS Anomaly detection ===="
-
-    def render_report(self):
-        result = "====  IDS Anomaly report  ====\n"
-        result+= "Found {} anomalies\n".format(len(self.anomalies))
-        for a in self.anomalies:
-            recv = a.recv
-            sent = a.sent
-            if self.trunc_messages and len(recv) > self.trunc_messages:
-                recv = recv[:self.trunc_messages] + b'\n...[snip]\n'
-            if self.trunc_messages and len(sent) > self.trunc_messages:
-                sent = sent[:self.trunc_messages]+ b'\n...[snip]\n'
-            result += "=== Anomaly on port: {:>5} ===\n".format(a.dst)
-            result += "Problem: {}\n".format(a.message)
-            result += "Score: {:.2}\n".format(a.score)
-            result += "<<< recv\n"
-            result += printable(recv)
-            result += "\n>>> sent\n"
-            result += printable(sent)
-            result += "\n===------------------------===\n"
-        return result
\ No newline at end of file
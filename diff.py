@@ -0,0 +1,302 @@
+from bisect import bisect_left
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+
+# Diff engines behind Template.get_matcher. A matcher is created for the input (b) and
+# then gets the template text (a) with set_seq1, like difflib.SequenceMatcher. Engines only
+# have to provide get_opcodes and ratio in difflib's format, the templates never look at
+# anything else.
+Match = namedtuple('Match', ['a', 'b', 'size'])
+
+
+class DiffError(Exception):
+    pass
+
+
+class DifflibMatcher(SequenceMatcher):
+    def __init__(self, b):
+        super().__init__(None, b'', b, autojunk=False)
+
+
+def opcodes_from_blocks(blocks):
+    # same as SequenceMatcher.get_opcodes, blocks end with the (len(a), len(b), 0) sentinel
+    i = j = 0
+    result = []
+    for ai, bj, size in blocks:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            result.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            result.append(('equal', ai, i, bj, j))
+    return result
+
+
+def join_blocks(blocks, a_len, b_len):
+    # adjacent blocks are joined and the sentinel is added, like difflib does
+    joined = []
+    for block in blocks:
+        if joined and joined[-1].a + joined[-1].size == block.a and joined[-1].b + joined[-1].size == block.b:
+            joined[-1] = Match(joined[-1].a, joined[-1].b, joined[-1].size + block.size)
+        else:
+            joined.append(block)
+    joined.append(Match(a_len, b_len, 0))
+    return joined
+
+
+def equal_run(a, i, b, j, limit, back=False):
+    # Number of equal bytes from a[i] and b[j] on (or before them with back), at most
+    # limit. Compares growing slices, so long runs don't cost a python loop per byte.
+    size = 0
+    step = 16
+    while size < limit:
+        step = min(step, limit - size)
+        if back:
+            same = a[i - size - step:i - size] == b[j - size - step:j - size]
+        else:
+            same = a[i + size:i + size + step] == b[j + size:j + size + step]
+        if same:
+            size += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step //= 2
+    return size
+
+
+def myers_blocks(a, b, max_cost=None):
+    # Matching blocks of a shortest edit script (Myers, "An O(ND) difference algorithm").
+    # Common prefix and suffix are taken off first, they are free. Returns None when more
+    # than max_cost edits are needed.
+    prefix = equal_run(a, 0, b, 0, min(len(a), len(b)))
+    suffix = equal_run(a, len(a), b, len(b), min(len(a), len(b)) - prefix, back=True)
+    a_mid = a[prefix:len(a) - suffix]
+    b_mid = b[prefix:len(b) - suffix]
+    n, m = len(a_mid), len(b_mid)
+
+    blocks = []
+    if prefix:
+        blocks.append(Match(0, 0, prefix))
+    if n and m:
+        snakes = myers_snakes(a_mid, b_mid, max_cost)
+        if snakes is None:
+            return None
+        blocks += [Match(x + prefix, y + prefix, size) for x, y, size in snakes]
+    elif max_cost is not None and n + m > max_cost:
+        return None
+    if suffix:
+        blocks.append(Match(len(a) - suffix, len(b) - suffix, suffix))
+
+    return join_blocks(blocks, len(a), len(b))
+
+
+def myers_snakes(a, b, max_cost=None):
+    n, m = len(a), len(b)
+    limit = n + m if max_cost is None else min(n + m, max_cost)
+    offset = limit + 1
+    v = [0] * (2 * limit + 3)
+    # v[offset + k] is the furthest x on diagonal k. trace keeps the part of v that step d
+    # started from, k = -d-1 .. d+1, to walk the path back.
+    trace = []
+    for d in range(limit + 1):
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(offset - d, offset + d + 1, 2):
+            if k == offset - d or (k != offset + d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k + offset
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return backtrack(trace, n, m)
+    return None
+
+
+def backtrack(trace, x, y):
+    snakes = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        # v[i] is diagonal i - d - 1
+        if k == -d or (k != d and v[k + d] < v[k + d + 2]):
+            prev_k = k + 1
+            prev_x = v[k + d + 2]
+            start = prev_x
+        else:
+            prev_k = k - 1
+            prev_x = v[k + d]
+            start = prev_x + 1
+        if x > start:
+            snakes.append((start, start - k, x - start))
+        x, y = prev_x, prev_x - prev_k
+    snakes.reverse()
+    return snakes
+
+
+class BlockMatcher:
+    # opcodes and ratio for engines that only compute matching blocks
+    def get_opcodes(self):
+        return opcodes_from_blocks(self.get_matching_blocks())
+
+    def ratio(self):
+        matches = sum(block.size for block in self.get_matching_blocks())
+        total = len(self.a) + len(self.b)
+        return 2.0 * matches / total if total else 1.0
+
+
+class MyersMatcher(BlockMatcher):
+    # Minimal diffs, fast when the template and the input are alike, which is the common
+    # case. Very different texts cost O(N*D), after MIN_COST edits or COST_FRACTION of their
+    # length those are handed to difflib, so the attempt costs a fraction of that diff.
+    MIN_COST = 16
+    COST_FRACTION = 0.1
+
+    def __init__(self, b, max_cost=None):
+        self.a = b''
+        self.b = b
+        self.max_cost = max_cost
+        self.blocks = None
+        self.fallback = None
+
+    def set_seq1(self, a):
+        self.a = a
+        self.blocks = None
+
+    def get_matching_blocks(self):
+        if self.blocks is None:
+            max_cost = self.max_cost
+            if max_cost is None:
+                max_cost = max(self.MIN_COST, int((len(self.a) + len(self.b)) * self.COST_FRACTION))
+            self.blocks = myers_blocks(self.a, self.b, max_cost)
+            if self.blocks is None:
+                if self.fallback is None:
+                    self.fallback = DifflibMatcher(self.b)
+                self.fallback.set_seq1(self.a)
+                self.blocks = self.fallback.get_matching_blocks()
+        return self.blocks
+
+
+def unique_grams(text, k):
+    # position of every k byte run that occurs exactly once in text
+    positions = {}
+    for i in range(len(text) - k + 1):
+        gram = text[i:i + k]
+        positions[gram] = -1 if gram in positions else i
+    return {gram: i for gram, i in positions.items() if i >= 0}
+
+
+def anchor_chain(b_grams, a, k):
+    # (i, j) of runs of a that occur once in b, the longest chain that is in order in both.
+    # a is only sampled every k/2 bytes, any equal run of 1.5k bytes still gets an anchor.
+    pairs = []
+    for i in range(0, len(a) - k + 1, max(1, k // 2)):
+        j = b_grams.get(a[i:i + k])
+        if j is not None:
+            pairs.append((i, j))
+    # longest increasing subsequence on j (patience sorting)
+    tails = []
+    tail_index = []
+    previous = [None] * len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_index.append(n)
+        else:
+            tails[pos] = j
+            tail_index[pos] = n
+        previous[n] = tail_index[pos - 1] if pos else None
+    chain = []
+    n = tail_index[-1] if tail_index else None
+    while n is not None:
+        chain.append(pairs[n])
+        n = previous[n]
+    chain.reverse()
+    return chain
+
+
+class AnchoredMatcher(BlockMatcher):
+    # For long conversations. Runs of ANCHOR_LEN bytes that occur once in the input are
+    # aligned first, extended to the full equal run around them, and only the windows in
+    # between are diffed by the backend. Windows that are still bigger than MAX_WINDOW are
+    # anchored again with shorter runs, down to MIN_ANCHOR_LEN, after that they count as
+    # replaced. The work grows about linearly with the length for texts that are alike.
+    ANCHOR_LEN = 32
+    MIN_ANCHOR_LEN = 8
+    MAX_WINDOW = 2048
+
+    def __init__(self, b, backend=None):
+        self.a = b''
+        self.b = b
+        self.backend = backend or DEFAULT_BACKEND
+        self.b_grams = {}
+        self.blocks = None
+
+    def set_seq1(self, a):
+        self.a = a
+        self.blocks = None
+
+    def grams(self, b, k, offset):
+        # the input is indexed once for the whole text, windows are indexed when needed
+        if offset == 0 and len(b) == len(self.b):
+            if k not in self.b_grams:
+                self.b_grams[k] = unique_grams(self.b, k)
+            return self.b_grams[k]
+        return unique_grams(b, k)
+
+    def window_blocks(self, a1, a2, b1, b2, k):
+        a, b = self.a[a1:a2], self.b[b1:b2]
+        if not a or not b:
+            return []
+        if len(a) <= self.MAX_WINDOW and len(b) <= self.MAX_WINDOW:
+            matcher = make_matcher(self.backend, b)
+            matcher.set_seq1(a)
+            return [Match(i + a1, j + b1, size) for i, j, size in matcher.get_matching_blocks() if size]
+        if k < self.MIN_ANCHOR_LEN:
+            return []
+        chain = anchor_chain(self.grams(b, k, b1), a, k)
+        if not chain:
+            return self.window_blocks(a1, a2, b1, b2, k // 2)
+        blocks = []
+        ai, bj = 0, 0
+        for i, j in chain:
+            if i < ai or j < bj:
+                continue # covered by the run of an earlier anchor
+            back = equal_run(a, i, b, j, min(i - ai, j - bj), back=True)
+            i, j = i - back, j - back
+            size = back + k + equal_run(a, i + back + k, b, j + back + k, min(len(a) - i, len(b) - j) - back - k)
+            blocks += self.window_blocks(a1 + ai, a1 + i, b1 + bj, b1 + j, k)
+            blocks.append(Match(a1 + i, b1 + j, size))
+            ai, bj = i + size, j + size
+        blocks += self.window_blocks(a1 + ai, a2, b1 + bj, b2, k)
+        return blocks
+
+    def get_matching_blocks(self):
+        if self.blocks is None:
+            blocks = self.window_blocks(0, len(self.a), 0, len(self.b), self.ANCHOR_LEN)
+            self.blocks = join_blocks(blocks, len(self.a), len(self.b))
+        return self.blocks
+
+
+DEFAULT_BACKEND = 'difflib'
+BACKENDS = {
+    'difflib': DifflibMatcher,
+    'myers': MyersMatcher,
+}
+
+
+def make_matcher(backend, b):
+    if backend not in BACKENDS:
+        raise DiffError("Unknown diff backend {}, choose from {}".format(backend, ', '.join(BACKENDS)))
+    return BACKENDS[backend](b)
@@ -1,40 +1,26 @@
 from argparse import ArgumentParser, ArgumentTypeError
-from scapy.all import rdpcap, reduce, Scapy_Exception, PacketList
-from os.path import isfile
 import os
 import sys
 import logging
+from baseline import Baseline
 from baseline_analyzer import BaselineAnalyzer
 from detection_analyzer import DetectionAnalyzer
+from packet_analyzer import PacketAnalyzer
+from ingest import read_pcaps, capture
+from diff import BACKENDS
+from watch import DirectoryWatcher
+from runstats import RunStats
+from local import LocalHosts, LocalError
+from report import SINKS, make_sink
+from scapy.all import get_if_hwaddr
+from contextlib import nullcontext
+import cProfile
 import re
 
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
 
-def read_pcap(pcap):
-    logging.info("Loading pcap {}".format(pcap))
-    if not isfile(pcap):
-        logging.error("Could not find pcap file {}".format(pcap))
-    try:
-        packets = rdpcap(pcap)
-    except Scapy_Exception as e:
-        logging.error("Could not load pcap {}: {}".format(pcap,str(e)))
-        return PacketList()
-    logging.debug("Pcap {} succesfuly loaded with {} packets".format(pcap, len(packets)))
-    return packets
-
-
-def read_pcaps(pcap):
-    if type(pcap) == list and len(pcap) > 1:
-        packets = reduce((lambda l, p: l+p), [read_pcap(p) for p in pcap])
-    elif os.path.isdir(pcap[0]):
-        packets = reduce((lambda l, p: l+p), [read_pcap(os.path.join(pcap[0],p)) for p in os.listdir(pcap[0])])
-    else:
-        packets = read_pcap(pcap[0])
-    return packets
-
-
 def error(message):
     logging.error(message)
     sys.exit(1)
@@ -47,33 +33,223 @@ def argparse_mac_type(s, pat=r"([a-f0-9A-F]{2}.?){5}[a-f0-9A-F]{2}"):
     return s.lower()
 
 
+def configure(baseline, args):
+    # command line overrides of the baseline config, they are saved with a trained baseline
+    if baseline is None:
+        return
+    if args.diff_backend:
+        baseline.config['diff_backend'] = args.diff_backend
+    if args.max_text_len:
+        baseline.config['max_text_len'] = args.max_text_len
+    if args.turns:
+        baseline.config['turn_based'] = True
+
+
+def local_hosts(args):
+    try:
+        return LocalHosts(args.local or [])
+    except LocalError as e:
+        error(str(e))
+
+
+def load_baseline(analyzer, args):
+    # Baseline.read has logged why the file couldn't be read
+    analyzer.load_baseline(args.baseline)
+    if analyzer.baseline is None:
+        sys.exit(1)
+    # the config as it was read, for --save-hits
+    config = dict(analyzer.baseline.config)
+    configure(analyzer.baseline, args)
+    return config
+
+
+def save(baseline, args, stats=None):
+    with stats.stage('write_baseline') if stats else nullcontext():
+        baseline.write(args.baseline, args.format)
+
+
+def save_hits(baseline, config, args, stats=None):
+    # only the hit counters of the run are kept, not its command line overrides. The ports
+    # share the config dict, so it is restored in place.
+    baseline.config.clear()
+    baseline.config.update(config)
+    save(baseline, args, stats)
+
+
 def main(argv):
     parser = ArgumentParser(description='Process some integers.')
-    parser.add_argument('cmd', type=str, choices=['baseline', 'detection', 'show'])
+    parser.add_argument('cmd', type=str, choices=['baseline', 'detection', 'live', 'show', 'convert', 'merge', 'unused', 'compact'])
     parser.add_argument('pcap',  nargs='*',help='Read a pcap for analysis')
     parser.add_argument('--baseline', type=str, help='baseline .yml file')
+    parser.add_argument('--format', choices=['yaml', 'binary'],
+                        help='Baseline file format, by default binary for .dbl files and yaml otherwise')
+    parser.add_argument('--update', action='store_true',
+                        help='Continue training from the existing --baseline file instead of starting empty')
+    parser.add_argument('--diff-backend', choices=sorted(BACKENDS),
+                        help='Diff engine for template matching, stored in the baseline config (default difflib)')
+    parser.add_argument('--max-text-len', type=int,
+                        help='Bytes of each side of a conversation that are compared, stored in the baseline config (default 1024)')
+    parser.add_argument('--turns', action='store_true',
+                        help='Match conversations turn by turn instead of as one blob per direction, stored in the baseline config')
+    parser.add_argument('--save-hits', action='store_true',
+                        help='Write the template hit counters of a detection run back to the --baseline file')
+    parser.add_argument('--max-templates', type=int, help='Cap on the templates per port for compact')
+    parser.add_argument('--compact-treshold', type=float,
+                        help='Similarity above which compact merges two templates (default the training treshold)')
+    parser.add_argument('--report', choices=sorted(SINKS), default='text',
+                        help='Format anomalies are written in as they are found, jsonl has one json object per line')
+    parser.add_argument('--report-file', type=str, help='Write anomalies to this file instead of stdout')
+    parser.add_argument('--stats', type=str, help='Write timings and counters of the run to this json file')
+    parser.add_argument('--profile', type=str, help='Run under cProfile and write the pstats to this file')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--mymac', type=argparse_mac_type, help='Override the mymac detection')
+    parser.add_argument('--local', action='append',
+                        help='Mac address, ip address or network (cidr) of our host, can be given more than once. '
+                             'Overrides the detection like --mymac')
+    parser.add_argument('--idle-timeout', type=float, default=PacketAnalyzer.IDLE_TIMEOUT,
+                        help='Seconds without traffic after which a conversation is analyzed, 0 to disable')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for detection')
+    parser.add_argument('--parse-workers', type=int, default=1, help='Number of processes used to read pcap files, '
+                        'every file being read is held in memory in full')
+    parser.add_argument('--verdict-cache', type=int, default=DetectionAnalyzer.VERDICT_CACHE_SIZE,
+                        help='Number of conversation verdicts remembered during detection, 0 to disable')
+    parser.add_argument('--iface', type=str, help='Interface to capture from in live mode')
+    parser.add_argument('--filter', type=str, help='BPF filter for live mode')
+    parser.add_argument('--watch', action='store_true', help='Keep following a directory of rotated pcaps')
+    parser.add_argument('--watch-interval', type=float, default=5, help='Seconds between polls of the watched directory')
+    parser.add_argument('--checkpoint', type=str, help='Checkpoint file for --watch, defaults to .droids_checkpoint in the directory')
+    parser.add_argument('--fast-decode', action='store_true', help='Parse packet headers directly instead of using scapy')
     args = parser.parse_args(argv)
 
     if args.debug or 'DEBUG' in os.environ:
         logging.getLogger().setLevel(logging.DEBUG)
+    stats = RunStats() if args.stats else None
+    try:
+        if args.profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run, args, stats)
+            finally:
+                profiler.dump_stats(args.profile)
+                logging.info("Wrote profile to {}, read it with python3 -m pstats".format(args.profile))
+        else:
+            run(args, stats)
+    finally:
+        if stats:
+            stats.write(args.stats)
+
+
+def run(args, stats=None):
     if args.cmd == 'baseline':
         analyzer = BaselineAnalyzer()
-        packets = read_pcaps(args.pcap)
+        analyzer.stats = stats
+        analyzer.local = local_hosts(args)
+        analyzer.idle_timeout = args.idle_timeout
+        if args.update:
+            analyzer.load_baseline(args.baseline)
+            if analyzer.baseline is None:
+                sys.exit(1)
+        configure(analyzer.baseline, args)
+        packets = read_pcaps(args.pcap, args.fast_decode, args.parse_workers)
         baseline = analyzer.run(packets, args.mymac)
         baseline.show()
-        baseline.write(args.baseline)
+        save(baseline, args, stats)
     if args.cmd == 'detection':
         analyzer = DetectionAnalyzer()
-        packets = read_pcaps(args.pcap)
-        analyzer.load_baseline(args.baseline)
+        analyzer.stats = stats
+        analyzer.local = local_hosts(args)
+        analyzer.sink = make_sink(args.report, args.report_file)
+        analyzer.idle_timeout = args.idle_timeout
+        analyzer.workers = args.workers
+        analyzer.verdicts.size = args.verdict_cache
+        if args.watch:
+            if len(args.pcap) != 1 or not os.path.isdir(args.pcap[0]):
+                error("--watch needs a single directory")
+            analyzer.live = True
+            analyzer.finish_on_interrupt = True
+            watcher = DirectoryWatcher(args.pcap[0], args.checkpoint, args.fast_decode)
+            watcher.held = analyzer.held_packets
+            config = load_baseline(analyzer, args)
+            # only returns on Ctrl-C, after the open sessions were analyzed too, so the
+            # checkpoint covers everything that was read
+            analyzer.run(watcher.watch(args.watch_interval), args.mymac)
+            watcher.save()
+            logging.info("Stopped watching {}".format(args.pcap[0]))
+            analyzer.sink.close()
+            if args.save_hits:
+                save_hits(analyzer.baseline, config, args, stats)
+            return
+        packets = read_pcaps(args.pcap, args.fast_decode, args.parse_workers)
+        config = load_baseline(analyzer, args)
         analyzer.run(packets, args.mymac)
-        print(analyzer.render_report())
+        analyzer.sink.close()
+        if args.save_hits:
+            save_hits(analyzer.baseline, config, args, stats)
+    if args.cmd == 'live':
+        if not args.iface and len(args.pcap) != 1:
+            error("Live mode needs an --iface or a single pcap to replay")
+        analyzer = DetectionAnalyzer()
+        analyzer.stats = stats
+        analyzer.local = local_hosts(args)
+        analyzer.sink = make_sink(args.report, args.report_file)
+        analyzer.idle_timeout = args.idle_timeout
+        analyzer.workers = args.workers
+        analyzer.verdicts.size = args.verdict_cache
+        analyzer.live = True
+        analyzer.clock_expiry = True
+        analyzer.finish_on_interrupt = True
+        load_baseline(analyzer, args)
+        mymac = args.mymac
+        if args.iface and not mymac:
+            mymac = get_if_hwaddr(args.iface).lower()
+        packets = capture(args.iface, None if args.iface else args.pcap[0], args.filter)
+        # Ctrl-C ends the capture after the open sessions and pending results were reported
+        analyzer.run(packets, mymac)
+        analyzer.sink.close()
     if args.cmd == 'show':
         analyzer = DetectionAnalyzer()
         analyzer.load_baseline(args.baseline)
+        if analyzer.baseline is None:
+            sys.exit(1)
         analyzer.baseline.show()
+    if args.cmd == 'convert':
+        # droids.py convert in.yml --baseline out.dbl
+        if len(args.pcap) != 1:
+            error("Convert needs a single input baseline")
+        baseline = Baseline.read(args.pcap[0])
+        if baseline is None:
+            sys.exit(1)
+        baseline.write(args.baseline, args.format)
+    if args.cmd == 'merge':
+        # droids.py merge a.yml b.yml --baseline combined.yml
+        if len(args.pcap) < 2:
+            error("Merge needs at least two input baselines")
+        baseline = None
+        for infile in args.pcap:
+            other = Baseline.read(infile)
+            if other is None:
+                sys.exit(1)
+            if baseline is None:
+                baseline = other
+            else:
+                baseline.merge(other)
+        baseline.write(args.baseline, args.format)
+    if args.cmd == 'compact':
+        # droids.py compact [in.yml] --baseline out.yml, compacts --baseline in place without input
+        if len(args.pcap) > 1:
+            error("Compact needs at most one input baseline")
+        baseline = Baseline.read(args.pcap[0] if args.pcap else args.baseline)
+        if baseline is None:
+            sys.exit(1)
+        before = baseline.template_count()
+        baseline.compact(args.compact_treshold, args.max_templates)
+        logging.info("Compacted {} templates into {}".format(before, baseline.template_count()))
+        baseline.write(args.baseline, args.format)
+    if args.cmd == 'unused':
+        baseline = Baseline.read(args.baseline)
+        if baseline is None:
+            sys.exit(1)
+        print(baseline.unused_report(), end='')
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -1,55 +1,351 @@
 #!/usr/bin/env python3
-import subprocess
-import sys
-from select import select
+# Sits between inetd and a service and filters what goes in and out:
+#   /service_wrap.py wrap /service_echo.py
+# All streams are pumped by one epoll loop, whatever is ready is passed on at once, as
+# raw bytes. Adapt input_rules and output_rules to stop the attacks you see.
 from fcntl import fcntl, F_GETFL, F_SETFL
-from os import O_NONBLOCK
+import os
 import re
+import selectors
+import subprocess
+import sys
+import time
+
+CHUNK_SIZE = 65536
+# Bytes waiting for a slow reader before the side that feeds it is paused
+HIGH_WATER = 1 << 18
+# Seconds to wait for the rest of a possible match before held back data is passed on
+# anyway, so a request that ends halfway a line isn't stuck.
+HOLD_TIMEOUT = 0.1
+
+
+def partial_start(data, text):
+    # start of the longest end of data that text starts with, len(data) if there is none
+    first = text[:1]
+    start = data.find(first, max(0, len(data) - len(text) + 1))
+    while start >= 0:
+        if text.startswith(data[start:]):
+            return start
+        start = data.find(first, start + 1)
+    return len(data)
 
 
-def filter_traffic(is_input, message):
-    check_message = message.strip()
-    if check_message == 'give-me-flag!':
-        return "NO FLAG FOR YOUU\n"
-    message = message.replace("fido", 'fidodido')
-    return message
-
-
-args = sys.argv[1:]
-
-process = subprocess.Popen(args, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-inputs = [process.stderr, sys.stdin, process.stdout]
-
-flags = fcntl(sys.stdin, F_GETFL)
-fcntl(sys.stdin, F_SETFL, flags | O_NONBLOCK)
-flags = fcntl(process.stdin, F_GETFL)
-fcntl(process.stdin, F_SETFL, flags | O_NONBLOCK)
-flags = fcntl(process.stdout, F_GETFL)
-fcntl(process.stdout, F_SETFL, flags | O_NONBLOCK)
-flags = fcntl(process.stderr, F_GETFL)
-fcntl(process.stderr, F_SETFL, flags | O_NONBLOCK)
-
-while process.poll() is None:
-    readable, _, _ = select(inputs, (), ())
-    if process.stdout in readable:
-        message = process.stdout.read().decode()
-        message = filter_traffic(False, message)
-        sys.stdout.write(message)
-        sys.stdout.flush()
-    elif process.stderr in readable:
-        message = process.stderr.read().decode()
-        message = filter_traffic(False, message)
-        sys.stderr.write(message)
-        sys.stderr.flush()
-    elif sys.stdin in readable:
-        message = sys.stdin.read()
-        if message == '':
-            process.stdin.close()
-            inputs.remove(sys.stdin)
+class Replace:
+    # Replaces every match of a regex in the stream. A match may be split over chunks, so
+    # the bytes that could still become one are held back until more data arrives. With a
+    # prefix (the literal text every match starts with) that is a started match or an end
+    # that starts like the prefix, in the unfinished line (matches stop at the end of a
+    # line) and at most window - 1 bytes. Without one, all of the unfinished line is held,
+    # which delays prompts by HOLD_TIMEOUT. Literal rules hold back an end that starts like
+    # the text.
+    def __init__(self, pattern, replacement, window=256, prefix=None, text=None):
+        self.pattern = re.compile(pattern)
+        self.replacement = replacement
+        self.window = window
+        self.prefix = prefix
+        self.text = text
+        self.pending = b''
+        # the last byte passed on, so ^ and lookbehinds see what came before the held data
+        self.context = b''
+
+    def literal(text, replacement):
+        return Replace(re.escape(text), replacement, len(text), text=text)
+
+    def hold_from(self, data):
+        if self.text is not None:
+            return partial_start(data, self.text)
+        start = max(data.rfind(b'\n') + 1, len(data) - self.window + 1)
+        if self.prefix is None:
+            return start
+        pos = data.find(self.prefix, start)
+        while pos >= 0:
+            match = self.pattern.match(data, pos)
+            if match is None or match.end() == len(data):
+                # not complete yet, or it might still grow
+                return pos
+            pos = data.find(self.prefix, match.end())
+        return max(start, partial_start(data, self.prefix))
+
+    def feed(self, data, final=False):
+        if self.pending or self.context:
+            data = self.context + self.pending + data
+        begin = len(self.context)
+        # matches that start before safe are complete
+        safe = len(data) if final else max(begin, self.hold_from(data))
+        match = self.pattern.search(data, begin)
+        if match is None or match.start() >= safe:
+            # nothing to replace, the common case
+            keep = safe
+            result = data[begin:safe] if begin or safe < len(data) else data
         else:
-            message = filter_traffic(False, message).encode()
-            process.stdin.write(message)
-            process.stdin.flush()
+            parts = []
+            pos = begin
+            for match in self.pattern.finditer(data, begin):
+                if match.start() >= safe:
+                    break
+                parts.append(data[pos:match.start()])
+                parts.append(match.expand(self.replacement))
+                pos = match.end()
+            keep = max(pos, safe)
+            parts.append(data[pos:keep])
+            result = b''.join(parts)
+        self.pending = data[keep:]
+        if self.text is None:
+            self.context = data[keep - 1:keep] if keep else b''
+        return result
+
+    def held(self):
+        return bool(self.pending)
+
+    def flush(self):
+        return self.feed(b'', final=True)
+
+
+class MaxLineLength:
+    # Cuts lines after limit bytes, the rest of the line is dropped
+    def __init__(self, limit):
+        self.limit = limit
+        self.line_len = 0
+
+    def feed(self, data):
+        if self.line_len + len(data) <= self.limit:
+            # no line can be too long
+            end = data.rfind(b'\n')
+            self.line_len = self.line_len + len(data) if end < 0 else len(data) - end - 1
+            return data
+        # only \n ends a line, splitlines would also split binary data on \r
+        lines = data.split(b'\n')
+        result = []
+        for i, line in enumerate(lines):
+            ended = i < len(lines) - 1
+            room = max(0, self.limit - self.line_len)
+            self.line_len = 0 if ended else self.line_len + len(line)
+            result.append(line[:room] + b'\n' if ended else line[:room])
+        return b''.join(result)
+
+    def held(self):
+        return False
+
+    def flush(self):
+        return b''
+
+
+class MaxBytes:
+    # Passes on the first limit bytes of the stream and drops the rest
+    def __init__(self, limit):
+        self.limit = limit
+        self.passed = 0
+
+    def feed(self, data):
+        data = data[:max(0, self.limit - self.passed)]
+        self.passed += len(data)
+        return data
+
+    def held(self):
+        return False
+
+    def flush(self):
+        return b''
+
+
+class Filter:
+    # Rules are applied in order, each one gets what the previous one let through. Rules
+    # have feed, held (is data held back) and flush (pass on what is held back).
+    def __init__(self, rules):
+        self.rules = rules
+
+    def feed(self, data):
+        for rule in self.rules:
+            data = rule.feed(data)
+        return data
+
+    def held(self):
+        return any(rule.held() for rule in self.rules)
+
+    def flush(self):
+        data = b''
+        for rule in self.rules:
+            data = rule.feed(data) + rule.flush() if data else rule.flush()
+        return data
+
+
+def input_rules():
+    # what the client sends to the service
+    return [
+        # only a line that is just the command, like the old wrapper did
+        Replace(rb'(?m)^give-me-flag!\r?$', b'NO FLAG FOR YOUU', window=64, prefix=b'give-me-flag!'),
+        Replace.literal(b'fido', b'fidodido'),
+        MaxLineLength(4096),
+    ]
+
+
+def output_rules():
+    # what the service sends back, on stdout and stderr
+    return [
+        Replace(rb'FLAG\{[^}\n]+\}', b'NO FLAG FOR YOUU', window=64, prefix=b'FLAG{'),
+        Replace.literal(b'fido', b'fidodido'),
+    ]
+
+
+class Output:
+    # An fd to write to. What it doesn't take at once is kept until it is writable, close
+    # is called once everything is written after end.
+    def __init__(self, fd, close=None):
+        self.fd = fd
+        self.close = close
+        self.buffer = bytearray()
+        self.ended = False
+        self.closed = False
+
+    def write(self, data):
+        if self.closed or not data:
+            return
+        if self.buffer:
+            self.buffer += data
+            return
+        try:
+            written = os.write(self.fd, data)
+        except BlockingIOError:
+            written = 0
+        except (BrokenPipeError, ConnectionResetError):
+            # the reader went away
+            self.lost()
+            return
+        if written < len(data):
+            self.buffer += data[written:]
+
+    def flush(self):
+        try:
+            written = os.write(self.fd, self.buffer)
+        except BlockingIOError:
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            self.lost()
+            return
+        del self.buffer[:written]
+        self.finish()
+
+    def end(self):
+        self.ended = True
+        self.finish()
+
+    def finish(self):
+        if self.ended and not self.buffer and not self.closed:
+            self.closed = True
+            if self.close:
+                self.close()
+
+    def lost(self):
+        self.buffer.clear()
+        self.ended = True
+        self.finish()
+
+    def waiting(self):
+        return len(self.buffer) if not self.closed else 0
+
+
+class Channel:
+    # Reads an fd and passes what comes in on to an Output, filtered
+    def __init__(self, fd, rules, output):
+        self.fd = fd
+        self.filter = Filter(rules)
+        self.output = output
+        self.open = True
+        self.deadline = None
+
+    def read(self):
+        try:
+            data = os.read(self.fd, CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b''
+        if not data:
+            self.open = False
+            self.deadline = None
+            self.output.write(self.filter.flush())
+            self.output.end()
+            return
+        self.output.write(self.filter.feed(data))
+        self.deadline = time.monotonic() + HOLD_TIMEOUT if self.filter.held() else None
+
+    def timeout(self):
+        self.deadline = None
+        self.output.write(self.filter.flush())
+
+
+def set_nonblocking(fd):
+    flags = fcntl(fd, F_GETFL)
+    fcntl(fd, F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Wrapper:
+    # One epoll loop for all streams, every ready fd is handled on each wakeup. A channel
+    # stops reading while its output has more than HIGH_WATER bytes waiting.
+    def __init__(self, args):
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.client = Channel(0, input_rules(), Output(self.process.stdin.fileno(), self.process.stdin.close))
+        self.service = [Channel(self.process.stdout.fileno(), output_rules(), Output(1)),
+                        Channel(self.process.stderr.fileno(), output_rules(), Output(2))]
+        self.selector = selectors.DefaultSelector()
+        self.watched = {}
+        # fds that can't be polled and the handler to call on every pass, see watch
+        self.unpollable = set()
+        self.ready = {}
+
+    def watch(self, fd, events, handler):
+        # events 0 stops watching fd
+        if fd in self.unpollable:
+            if events:
+                self.ready[fd] = handler
+            else:
+                self.ready.pop(fd, None)
+            return
+        if self.watched.get(fd, 0) == events:
+            return
+        if not events:
+            self.selector.unregister(fd)
+        elif fd in self.watched and self.watched[fd]:
+            self.selector.modify(fd, events, handler)
+        else:
+            try:
+                self.selector.register(fd, events, handler)
+            except PermissionError:
+                # epoll refuses regular files, they are always ready
+                self.unpollable.add(fd)
+                self.ready[fd] = handler
+                return
+        self.watched[fd] = events
+
+    def update(self):
+        for channel in [self.client] + self.service:
+            reading = channel.open and channel.output.waiting() < HIGH_WATER
+            self.watch(channel.fd, selectors.EVENT_READ if reading else 0, channel.read)
+            output = channel.output
+            self.watch(output.fd, selectors.EVENT_WRITE if output.waiting() else 0, output.flush)
+
+    def timeout(self):
+        deadlines = [c.deadline for c in [self.client] + self.service if c.deadline]
+        return max(0, min(deadlines) - time.monotonic()) if deadlines else None
+
+    def run(self):
+        for channel in [self.client] + self.service:
+            set_nonblocking(channel.fd)
+            set_nonblocking(channel.output.fd)
+        while any(c.open or c.output.waiting() for c in self.service):
+            self.update()
+            for key, events in self.selector.select(0 if self.ready else self.timeout()):
+                key.data()
+            for handler in list(self.ready.values()):
+                handler()
+            now = time.monotonic()
+            for channel in [self.client] + self.service:
+                if channel.deadline and channel.deadline <= now:
+                    channel.timeout()
+        self.client.output.end()
+        return self.process.wait()
+
 
-sys.exit(process.returncode)
-#print("Proc exit: {}".format(process.returncode))
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(Wrapper(sys.argv[1:]).run())
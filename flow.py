@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from decode import flow_key
+from util import LRUCache
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+
+class Packets(list):
+    # The packets of a flow. first is the packet that opened the connection, which is in an
+    # earlier flow when the connection was split by the idle timeout.
+    def __init__(self, packets, first=None):
+        super().__init__(packets)
+        self.first = first if first is not None else self[0]
+
+
+class Flow:
+    def __init__(self, key, packet, first=None):
+        self.key = key
+        self.packets = Packets([packet], first)
+        self.last_seen = packet.time
+        self.fins = set()
+
+    def add(self, packet):
+        self.packets.append(packet)
+        self.last_seen = max(self.last_seen, packet.time)
+
+
+class FlowTable:
+    # How long the key of a closed flow is remembered, so the last ack of a teardown
+    # does not open a new flow.
+    CLOSED_LINGER = 30
+    # How many flows that went idle keep their first packet, so a connection that continues
+    # after the idle timeout keeps its direction.
+    SPLIT_CACHE_SIZE = 4096
+
+    def __init__(self, on_close, idle_timeout=120):
+        self.on_close = on_close
+        self.idle_timeout = idle_timeout
+        # both dicts are kept in order of last activity, so expiring only looks at the front
+        self.flows = OrderedDict()
+        self.closed = OrderedDict()
+        self.split = LRUCache(FlowTable.SPLIT_CACHE_SIZE)
+        self.flow_count = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def add(self, packet):
+        key = flow_key(packet)
+        if key is None:
+            return
+        self.expire(packet.time)
+        flow = self.flows.get(key)
+        if flow is None:
+            if key in self.closed and not packet.payload and not (packet.flags or 0) & TCP_SYN:
+                return
+            # a SYN starts a new connection, anything else may continue one that went idle
+            first = None if (packet.flags or 0) & TCP_SYN else self.split.get(key)
+            flow = Flow(key, packet, first)
+            self.flows[key] = flow
+            self.flow_count += 1
+        else:
+            flow.add(packet)
+            self.flows.move_to_end(key)
+        if packet.proto == 'TCP':
+            if packet.flags & TCP_RST:
+                self.close(key)
+            elif packet.flags & TCP_FIN:
+                flow.fins.add((packet.src, packet.sport))
+                if len(flow.fins) == 2:
+                    self.close(key)
+
+    def expire(self, now):
+        while self.closed:
+            key, closed_at = next(iter(self.closed.items()))
+            if closed_at > now - self.CLOSED_LINGER:
+                break
+            del self.closed[key]
+        if not self.idle_timeout:
+            return
+        while self.flows:
+            key, flow = next(iter(self.flows.items()))
+            if flow.last_seen > now - self.idle_timeout:
+                break
+            self.split.put(key, flow.packets.first)
+            self.close(key)
+
+    def close(self, key):
+        flow = self.flows.pop(key)
+        self.closed[key] = flow.last_seen
+        self.closed.move_to_end(key)
+        self.on_close(flow)
+
+    def flush(self):
+        # end of input, every open flow is finished
+        for key in list(self.flows):
+            self.close(key)
+        self.closed.clear()
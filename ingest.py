@@ -0,0 +1,140 @@
+from scapy.all import PcapReader, RawPcapReader, Scapy_Exception, AsyncSniffer
+from os.path import isfile
+from decode import from_scapy, decode_raw
+from collections import deque
+from queue import Queue, Empty
+from multiprocessing import Pool
+import heapq
+import os
+import logging
+
+
+def list_pcaps(pcap):
+    if len(pcap) == 1 and os.path.isdir(pcap[0]):
+        return [os.path.join(pcap[0], p) for p in sorted(os.listdir(pcap[0]))]
+    return list(pcap)
+
+
+def raw_time(reader, meta):
+    # pcap and pcapng readers report timestamps differently
+    if hasattr(meta, 'tshigh'):
+        if meta.tshigh is None:
+            return 0.0
+        return ((meta.tshigh << 32) + meta.tslow) / meta.tsresol
+    return meta.sec + meta.usec * (1e-9 if reader.nano else 1e-6)
+
+
+def raw_records(reader):
+    for data, meta in reader:
+        linktype = getattr(meta, 'linktype', None) or reader.linktype
+        yield decode_raw(data, raw_time(reader, meta), linktype)
+
+
+def read_pcap(pcap, fast=False):
+    # yields the packets of a single pcap one at a time, nothing is kept in memory
+    logging.info("Loading pcap {}".format(pcap))
+    if not isfile(pcap):
+        logging.error("Could not find pcap file {}".format(pcap))
+        return
+    count = 0
+    try:
+        if fast:
+            with RawPcapReader(pcap) as reader:
+                for record in raw_records(reader):
+                    count += 1
+                    yield record
+        else:
+            with PcapReader(pcap) as reader:
+                for packet in reader:
+                    count += 1
+                    yield from_scapy(packet)
+    except Scapy_Exception as e:
+        logging.error("Could not load pcap {}: {}".format(pcap, str(e)))
+        return
+    logging.debug("Pcap {} succesfuly loaded with {} packets".format(pcap, count))
+
+
+def read_pcaps(pcap, fast=False, workers=1):
+    # pcap is a list of files or a list containing a single directory
+    files = list_pcaps(pcap)
+    if workers > 1 and len(files) > 1:
+        yield from read_pcaps_parallel(files, fast, workers)
+        return
+    for p in files:
+        yield from read_pcap(p, fast)
+
+
+def first_timestamp(pcap):
+    try:
+        with RawPcapReader(pcap) as reader:
+            for data, meta in reader:
+                return raw_time(reader, meta)
+    except (Scapy_Exception, OSError):
+        pass
+    return float('inf')
+
+
+def parse_pcap(pcap, fast):
+    # Runs in a worker, records are small tuples so they are cheap to send back. The whole
+    # file is kept until it is merged. The merge needs every file in time order, which a
+    # capture edited or merged by other tools may not be.
+    records = list(read_pcap(pcap, fast))
+    if any(records[i].time > records[i + 1].time for i in range(len(records) - 1)):
+        logging.warning("Pcap {} is not sorted by time, sorting it".format(pcap))
+        records.sort(key=record_time)
+    return records
+
+
+def record_time(record):
+    return record.time
+
+
+def read_pcaps_parallel(pcap, fast=False, workers=2):
+    # Files are parsed in a process pool and merged by timestamp. Rotated captures hardly
+    # overlap, so records of a file can be passed on once the next file is known to start
+    # later than they do.
+    files = [(first_timestamp(p), p) for p in list_pcaps(pcap)]
+    files.sort(key=lambda f: f[0])
+    pending = []
+    with Pool(workers) as pool:
+        results = deque()
+        queue = iter(files)
+        for i in range(len(files)):
+            while len(results) < workers * 2:
+                f = next(queue, None)
+                if f is None:
+                    break
+                results.append(pool.apply_async(parse_pcap, (f[1], fast)))
+            pending.append(results.popleft().get())
+            bound = files[i + 1][0] if i + 1 < len(files) else float('inf')
+            rest = []
+            for record in heapq.merge(*pending, key=record_time):
+                if record.time < bound:
+                    yield record
+                else:
+                    rest.append(record)
+            pending = [rest]
+
+
+def capture(iface=None, offline=None, bpf=None):
+    # Yields packets sniffed from an interface, or from a pcap through the same sniffing
+    # code. While a live capture is quiet it yields None about once a second, so idle flows
+    # can be expired.
+    logging.info("Capturing from {}".format(iface or offline))
+    queue = Queue()
+    sniffer = AsyncSniffer(iface=iface, offline=offline, filter=bpf, prn=queue.put, store=False)
+    sniffer.start()
+    try:
+        while True:
+            try:
+                packet = queue.get(timeout=1)
+            except Empty:
+                if not sniffer.thread.is_alive():
+                    break
+                if not offline:
+                    yield None
+                continue
+            yield from_scapy(packet)
+    finally:
+        if sniffer.running:
+            sniffer.stop()
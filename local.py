@@ -0,0 +1,56 @@
+import ipaddress
+import re
+from util import LRUCache
+
+MAC_PATTERN = re.compile(r'^([0-9a-f]{2}[:-]){5}[0-9a-f]{2}$')
+
+
+class LocalError(Exception):
+    pass
+
+
+class LocalHosts:
+    # The hosts Droids watches over, by mac address, ip address or network. Only the first
+    # packet of a flow is looked up, see PacketAnalyzer.local_end.
+    NETWORK_CACHE_SIZE = 4096
+
+    def __init__(self, specs=()):
+        self.macs = set()
+        self.ips = set()
+        self.networks = []
+        # ip -> in one of the networks, remote addresses keep coming back
+        self.in_networks = LRUCache(LocalHosts.NETWORK_CACHE_SIZE)
+        for spec in specs:
+            self.add(spec)
+
+    def add(self, spec):
+        spec = spec.strip().lower()
+        if MAC_PATTERN.match(spec):
+            self.macs.add(spec.replace('-', ':'))
+            return
+        try:
+            if '/' in spec:
+                self.networks.append(ipaddress.ip_network(spec, strict=False))
+                self.in_networks.clear()
+            else:
+                self.ips.add(str(ipaddress.ip_address(spec)))
+        except ValueError:
+            raise LocalError("{} is not a mac address, ip address or network".format(spec))
+
+    def __bool__(self):
+        return bool(self.macs or self.ips or self.networks)
+
+    def __str__(self):
+        return ', '.join(sorted(self.macs) + sorted(self.ips) + [str(n) for n in self.networks])
+
+    def is_local(self, mac, ip):
+        if mac in self.macs or ip in self.ips:
+            return True
+        if not self.networks or ip is None:
+            return False
+        result = self.in_networks.get(ip)
+        if result is None:
+            address = ipaddress.ip_address(ip)
+            result = any(address in network for network in self.networks)
+            self.in_networks.put(ip, result)
+        return result
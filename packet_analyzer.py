@@ -1,8 +1,14 @@
-from util import full_duplex
+from decode import flow_key
+from flow import FlowTable, TCP_SYN, TCP_ACK
+from local import LocalHosts
+import template
+import reassembly
+from reassembly import reassemble, stream_parts
+from template import Turns
 from baseline import Baseline
 import logging
 from collections import Counter
-from scapy.all import Raw
+from time import time, perf_counter
 
 
 class AnalyzerError(Exception):
@@ -10,61 +16,149 @@ class AnalyzerError(Exception):
 
 
 class PacketAnalyzer:
+    IDLE_TIMEOUT = 120
+    MAC_SAMPLE = 10000
+    # addresses that accepted at least this share of the connections the busiest one did
+    # are ours too, a host often has a few
+    LOCAL_SHARE = 0.5
+
     def __init__(self):
         self.baseline = Baseline()
-        self.mymac = None
+        # our hosts, detected from a sample of the capture when empty
+        self.local = LocalHosts()
+        self.idle_timeout = PacketAnalyzer.IDLE_TIMEOUT
+        self.mac_sample = PacketAnalyzer.MAC_SAMPLE
+        # expire flows against the wall clock while the input is idle (live captures)
+        self.clock_expiry = False
+        # a RunStats to record timings in, see --stats
+        self.stats = None
+        # Ctrl-C ends the input but what was read is still analyzed, for runs that never
+        # end by themselves (live and --watch)
+        self.finish_on_interrupt = False
 
     def load_baseline(self, infil):
-        self.baseline = Baseline.read(infil)
+        if self.stats is None:
+            self.baseline = Baseline.read(infil)
+            return
+        with self.stats.stage('load_baseline'):
+            self.baseline = Baseline.read(infil)
 
-    def find_my_mac(self, packets):
-        src_macs = [p['Ether'].src for p in packets if 'Ether' in p]
-        dst_macs = [p['Ether'].dst for p in packets if 'Ether' in p]
-        c = Counter(src_macs + dst_macs)
-        common =  c.most_common(2)
+    def count_macs(self, packet):
+        if packet.src_mac:
+            self.macs[packet.src_mac] += 1
+            self.macs[packet.dst_mac] += 1
+        if packet.flags and packet.flags & (TCP_SYN | TCP_ACK) == TCP_SYN:
+            self.servers[packet.dst] += 1
+
+    def find_my_mac(self, macs):
+        common = macs.most_common(2)
         if len(common) < 2:
             raise Exception("Could not determine my mac address... Try giving me more packets!")
         if common[0][1] < common[1][1]:
             raise Exception("Could not determine my mac address... Try giving me more packets!")
-        self.mymac = common[0][0]
-        logging.debug("Determined my mac: {}, {}/{}".format(self.mymac, common[0][1], common[1][1]))
-        return self.mymac
+        logging.debug("Determined my mac: {}, {}/{}".format(common[0][0], common[0][1], common[1][1]))
+        return common[0][0]
 
-    def my_packet(self, packet):
-        if 'Ether' not in packet:
-            logging.debug("Can not analyze packet that has no ether")
-            return
-        eth = packet['Ether']
-        from_me = False
-        if eth.src == self.mymac:
-            from_me = True
-        return from_me
-
-    def get_payload(self, packet):
-        if 'Raw' in packet:
-            return packet[Raw].load
+    def find_local(self):
+        # The hosts that accepted clearly more connections in the sample than the others are
+        # ours. When that is unclear, the mac address that is in the most packets (that fails
+        # when every packet goes through the same gateway).
+        common = self.servers.most_common()
+        ours = [ip for ip, count in common if count >= common[0][1] * self.LOCAL_SHARE] if common else []
+        if ours and (len(common) == 1 or len(ours) < len(common)):
+            self.local.ips.update(ours)
+            logging.warning("Guessed the local addresses {} from the first packets, use --local if "
+                            "there are others".format(', '.join(ours)))
         else:
-            return b''
+            self.local.macs.add(self.find_my_mac(self.macs))
+        logging.info("Determined local host: {}".format(self.local))
+
+    def my_packet(self, packet):
+        return self.local.is_local(packet.src_mac, packet.src)
+
+    @staticmethod
+    def first_packet(packets):
+        # the packet that started the connection, see flow.Packets
+        return getattr(packets, 'first', None) or packets[0]
+
+    def local_end(self, packets):
+        # (address, port) of our side of the flow: the side that didn't start it
+        first = self.first_packet(packets)
+        return (first.dst, first.dport)
+
+    def split_flow(self, packets):
+        # the packets we sent and the ones we received
+        end = self.local_end(packets)
+        sent = []
+        recv = []
+        for p in packets:
+            if (p.src, p.sport) == end:
+                sent.append(p)
+            else:
+                recv.append(p)
+        return sent, recv
 
     def packets_to_convo(self, packets):
-        sent = b''.join([self.get_payload(p) for p in packets if self.my_packet(p)]).strip()
-        recv = b''.join([self.get_payload(p) for p in packets if not self.my_packet(p)]).strip()
+        if self.stats is None:
+            return self.build_convo(packets)
+        with self.stats.stage('reassembly'):
+            convo = self.build_convo(packets)
+        if convo:
+            self.stats.counts['convos'] += 1
+        return convo
+
+    def build_convo(self, packets):
+        if self.baseline.get_config('turn_based'):
+            return self.packets_to_turns(packets)
+        sent, recv = self.split_flow(packets)
+        sent = reassemble(sent).strip()
+        recv = reassemble(recv).strip()
         logging.debug("Convo consists of {} bytes sent and {} bytes received".format(len(sent), len(recv)))
         if len(sent) ==0 and len(recv) ==0:
             return None
         return (sent, recv)
 
+    def packets_to_turns(self, packets):
+        # Splits the conversation where the direction changes. Every turn is what the other
+        # side sent (recv) and what we answered (sent), a banner we sent first is a turn too.
+        parts = []
+        end = self.local_end(packets)
+        for from_me in (True, False):
+            indexes = [i for i, p in enumerate(packets) if ((p.src, p.sport) == end) == from_me]
+            # A part is placed after the latest packet that contributed to the stream up to
+            # there, so reordered segments keep their place in the stream.
+            latest = -1
+            for i, data in stream_parts([packets[i] for i in indexes]):
+                latest = max(latest, indexes[i])
+                parts.append((latest, from_me, data))
+        parts.sort(key=lambda part: part[0])
+        turns = []
+        sent = recv = b''
+        for _, from_me, data in parts:
+            if not from_me and sent:
+                turns.append((sent.strip(), recv.strip()))
+                sent = recv = b''
+            if from_me:
+                sent += data
+            else:
+                recv += data
+        if sent or recv:
+            turns.append((sent.strip(), recv.strip()))
+        turns = [turn for turn in turns if turn != (b'', b'')]
+        logging.debug("Convo consists of {} turns".format(len(turns)))
+        if not turns:
+            return None
+        return Turns(turns)
+
     def try_analyze_session(self, packets, s):
-        logging.debug('Examining session {} of {}: {} containing {} packets'.format(self.ctr, self.cnt, s, len(packets)))
-        if self.my_packet(packets[0]):
-            logging.debug("First packet is from me, ignoring session")
+        logging.debug('Examining session {}: {} containing {} packets'.format(self.ctr, s, len(packets)))
+        if self.my_packet(self.first_packet(packets)):
+            logging.debug("Session was started by us, ignoring it")
         elif len(packets) < 2:
             logging.debug("Not enough packets in this session")
-        elif 'IP' not in packets[0]:
-            logging.debug("Session is not in ipv4 :-()")
-        elif 'TCP' in packets[0]:
+        elif packets[0].proto == 'TCP':
             self.analyze_session(packets, 'TCP')
-        elif 'UDP' in packets[0]:
+        elif packets[0].proto == 'UDP':
             self.analyze_session(packets, 'UDP')
         else:
             logging.debug("Unrecognized protocol :(")
@@ -72,19 +166,97 @@ class PacketAnalyzer:
     def post_analysis(self):
         pass
 
-    def run(self, packets, mymac=None):
+    def analyze_flow(self, flow):
+        self.ctr += 1
+        if self.stats is None:
+            self.try_analyze_session(flow.packets, flow.key)
+            return
+        start = perf_counter()
+        self.try_analyze_session(flow.packets, flow.key)
+        self.stats.add_session(self.local_end(flow.packets)[1], perf_counter() - start)
+
+    def start(self, mymac=None):
         logging.info(self.banner())
         if mymac:
-            self.mymac = mymac
-        else:
-            self.find_my_mac(packets)
-        sessions = packets.sessions(full_duplex)
-        logging.info('Read {} packets in {} sessions'.format(len(packets), len(sessions)))
+            self.local.macs.add(mymac)
         self.ctr = 0
-        self.cnt = len(sessions)
-        for s in sessions:
-            self.ctr += 1
-            packets = sessions[s]
-            self.try_analyze_session(packets, s)
-        self.post_analysis()
+        self.count = 0
+        self.macs = Counter()
+        self.servers = Counter()
+        # our hosts have to be known before the first flow is analyzed, so guess them from
+        # the start of the capture and replay those packets afterwards
+        self.sample = None if self.local else []
+        self.flows = FlowTable(self.analyze_flow, self.idle_timeout)
+
+    def feed(self, packet):
+        self.count += 1
+        if self.sample is None:
+            self.flows.add(packet)
+            return
+        self.sample.append(packet)
+        self.count_macs(packet)
+        if len(self.sample) >= self.mac_sample:
+            self.end_sample()
+
+    def end_sample(self):
+        sample, self.sample = self.sample, None
+        self.find_local()
+        for p in sample:
+            self.flows.add(p)
+
+    def held_packets(self):
+        # the first packet of every flow that was read but isn't analyzed yet, see
+        # DirectoryWatcher.resume_point
+        held = [flow.packets[0] for flow in self.flows.flows.values()]
+        sampled = {}
+        for p in self.sample or ():
+            sampled.setdefault(flow_key(p), p)
+        sampled.pop(None, None)
+        return held + list(sampled.values())
+
+    def idle(self):
+        # nothing to read for now, don't wait for a full sample to guess our hosts from
+        if self.sample:
+            self.end_sample()
+        if self.sample is None and self.clock_expiry:
+            self.flows.expire(time())
+
+    def finish(self):
+        if self.sample is not None:
+            self.end_sample()
+        self.flows.flush()
+        logging.info('Read {} packets in {} sessions'.format(self.count, self.flows.flow_count))
+        logging.debug('Template matching ran {} diffs'.format(template.stats['matcher_calls']))
+        if reassembly.stats['duplicate_bytes'] or reassembly.stats['out_of_order']:
+            logging.info('Reassembly dropped {} duplicate bytes, {} segments were out of order'.format(
+                reassembly.stats['duplicate_bytes'], reassembly.stats['out_of_order']))
+        if self.stats is None:
+            self.post_analysis()
+            return self.baseline
+        with self.stats.stage('post_analysis'):
+            self.post_analysis()
+        self.stats.counts['packets'] += self.count
+        self.stats.counts['sessions'] += self.flows.flow_count
         return self.baseline
+
+    def run(self, packets, mymac=None):
+        # packets may be any iterable, it is consumed exactly once. None means the input
+        # has been idle for a while.
+        if self.stats is None:
+            return self.consume(packets, mymac)
+        with self.stats.stage('run'):
+            return self.consume(self.stats.timed('ingest', packets), mymac)
+
+    def consume(self, packets, mymac=None):
+        self.start(mymac)
+        try:
+            for p in packets:
+                if p is None:
+                    self.idle()
+                else:
+                    self.feed(p)
+        except KeyboardInterrupt:
+            if not self.finish_on_interrupt:
+                raise
+            logging.info("Interrupted, analyzing the sessions that are still open")
+        return self.finish()
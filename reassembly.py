@@ -0,0 +1,70 @@
+from collections import Counter
+from flow import TCP_SYN
+
+SEQ_MOD = 1 << 32
+
+# Totals over all streams: duplicate_bytes (retransmitted or overlapping data that was
+# dropped), out_of_order (segments that arrived after a later part of the stream) and
+# missing_bytes (holes, the data was never captured).
+stats = Counter()
+
+
+def seq_offset(seq, base):
+    # distance from base, sequence numbers wrap around at 2**32
+    offset = (seq - base) % SEQ_MOD
+    if offset >= SEQ_MOD // 2:
+        offset -= SEQ_MOD
+    return offset
+
+
+def reassemble(packets):
+    # The byte stream one side of a tcp conversation sent, from its packets in capture
+    # order. Segments are put in sequence order and bytes that an earlier part of the stream
+    # already covered are dropped: of overlapping segments the one with the lower sequence
+    # number wins, even if it was captured later, and of segments at the same sequence
+    # number the first captured one. udp has no sequence numbers, its payloads are just joined.
+    return b''.join(data for _, data in stream_parts(packets))
+
+
+def stream_parts(packets):
+    # (index in packets, new data) of the stream in order, see reassemble
+    if not packets or packets[0].seq is None:
+        return [(i, p.payload) for i, p in enumerate(packets) if p.payload]
+    base = None
+    data = []
+    for i, p in enumerate(packets):
+        seq = p.seq
+        if p.flags & TCP_SYN:
+            # the syn takes up one sequence number, data starts after it
+            seq += 1
+            if base is None:
+                base = seq
+        if p.payload:
+            data.append((seq, i, p.payload))
+    if not data:
+        return []
+    if base is None:
+        # the capture started after the handshake
+        first = data[0][0]
+        base = first + min(seq_offset(seq, first) for seq, _, _ in data)
+
+    segments = sorted((seq_offset(seq, base), i, payload) for seq, i, payload in data)
+    parts = []
+    end = 0
+    last_index = -1
+    for offset, i, payload in segments:
+        if i < last_index:
+            stats['out_of_order'] += 1
+        last_index = max(last_index, i)
+        if offset < end:
+            overlap = min(end - offset, len(payload))
+            stats['duplicate_bytes'] += overlap
+            payload = payload[overlap:]
+            offset = end
+            if not payload:
+                continue
+        elif offset > end:
+            stats['missing_bytes'] += offset - end
+        parts.append((i, payload))
+        end = offset + len(payload)
+    return parts
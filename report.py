@@ -0,0 +1,128 @@
+import json
+import sys
+from datetime import datetime, timezone
+from util import printable
+
+
+def format_time(t):
+    if t is None:
+        return '-'
+    return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ReportSink:
+    # Gets every anomaly once, as soon as detection confirms it, so nothing has to stay in
+    # memory until the end of the run. finish gets all of them again without payloads, with
+    # how often and by whom they were seen, and how many were reported in total. Live runs
+    # only keep the recent ones, so the total can be more than were passed.
+    # This one reports nothing.
+    def __init__(self, out=None, trunc_messages=1024):
+        self.out = out or sys.stdout
+        self.trunc_messages = trunc_messages
+
+    def start(self):
+        pass
+
+    def write(self, anomaly):
+        pass
+
+    def finish(self, anomalies, total=None):
+        pass
+
+    def close(self):
+        if self.out not in (sys.stdout, sys.stderr):
+            self.out.close()
+
+
+class TextSink(ReportSink):
+    def start(self):
+        self.out.write("====  IDS Anomaly report  ====\n")
+        self.out.flush()
+
+    def write(self, anomaly):
+        self.out.write(self.render(anomaly))
+        self.out.flush()
+
+    def finish(self, anomalies, total=None):
+        if anomalies:
+            self.out.write("====  Occurrences  ====\n")
+            self.out.write("{:<12} {:>5} {:>7}  {:<19}  {:<19}  {}\n".format(
+                'id', 'port', 'count', 'first seen', 'last seen', 'sources'))
+        for a in sorted(anomalies, key=lambda a: -a.count):
+            self.out.write("{:<12} {:>5} {:>7}  {:<19}  {:<19}  {}\n".format(
+                a.id(), a.dst, a.count, format_time(a.first_seen), format_time(a.last_seen),
+                ', '.join(sorted(a.sources))))
+        total = len(anomalies) if total is None else total
+        if total > len(anomalies):
+            self.out.write("Found {} anomalies, the occurrences are of the {} most recent only\n".format(
+                total, len(anomalies)))
+        else:
+            self.out.write("Found {} anomalies\n".format(total))
+        self.out.flush()
+
+    def truncate(self, text):
+        if self.trunc_messages and len(text) > self.trunc_messages:
+            return text[:self.trunc_messages] + b'\n...[snip]\n'
+        return text
+
+    def render(self, a):
+        return "".join([
+            "=== Anomaly on port: {:>5} ===\n".format(a.dst),
+            "Id: {}\n".format(a.id()),
+            "Seen: {} from {}\n".format(format_time(a.first_seen), ', '.join(sorted(a.sources)) or '-'),
+            "Problem: {}\n".format(a.message),
+            "Score: {:.2}\n".format(a.score),
+            "<<< recv\n", printable(self.truncate(a.recv)),
+            "\n>>> sent\n", printable(self.truncate(a.sent)),
+            "\n===------------------------===\n",
+        ])
+
+
+class JsonLinesSink(ReportSink):
+    # One json object per anomaly, for tooling. Payloads are complete, as latin-1 strings,
+    # so text.encode('latin-1') gives back the bytes. At the end an "occurrences" object
+    # per anomaly has the totals, and a "summary" object how many anomalies were reported
+    # and how many of them have occurrences. Times are unix timestamps.
+    def write(self, a):
+        self.out.write(json.dumps({
+            'type': 'anomaly',
+            'id': a.id(),
+            'time': a.first_seen,
+            'source': min(a.sources) if a.sources else None,
+            'port': a.dst,
+            'score': a.score,
+            'message': a.message,
+            'sent': a.sent.decode('latin-1'),
+            'recv': a.recv.decode('latin-1'),
+        }) + "\n")
+        self.out.flush()
+
+    def finish(self, anomalies, total=None):
+        for a in anomalies:
+            self.out.write(json.dumps({
+                'type': 'occurrences',
+                'id': a.id(),
+                'port': a.dst,
+                'count': a.count,
+                'first_seen': a.first_seen,
+                'last_seen': a.last_seen,
+                'sources': sorted(a.sources),
+            }) + "\n")
+        self.out.write(json.dumps({
+            'type': 'summary',
+            'anomalies': len(anomalies) if total is None else total,
+            'occurrences': len(anomalies),
+        }) + "\n")
+        self.out.flush()
+
+
+SINKS = {
+    'text': TextSink,
+    'jsonl': JsonLinesSink,
+    'none': ReportSink,
+}
+
+
+def make_sink(kind='text', path=None, trunc_messages=1024):
+    out = open(path, 'w') if path else None
+    return SINKS[kind](out, trunc_messages)
@@ -0,0 +1,81 @@
+import json
+import logging
+import platform
+import reassembly
+import template
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class RunStats:
+    # Where the time of a run went, for --stats. Stages are wall time in seconds:
+    #   ingest         reading and decoding packets (waiting for them in live mode)
+    #   analysis       everything done with closed flows, split into
+    #   reassembly     building conversations from the packets and
+    #   matching       the rest, mostly comparing conversations to templates
+    #   post_analysis  waiting for the last results of the worker pool and the report
+    #   sessionize     what remains of the run, mostly the flow table
+    # With --workers the matching happens in other processes, the main process only
+    # waits for it and the template counters miss their diffs.
+    def __init__(self):
+        self.started = perf_counter()
+        self.stages = Counter()
+        self.counts = Counter()
+        self.ports = defaultdict(Counter)
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += perf_counter() - start
+
+    def timed(self, name, iterable):
+        # the items of iterable, the time spent waiting for them is added to stage name
+        items = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.stages[name] += perf_counter() - start
+                return
+            self.stages[name] += perf_counter() - start
+            yield item
+
+    def add_session(self, port, seconds):
+        self.stages['analysis'] += seconds
+        self.ports[port]['sessions'] += 1
+        self.ports[port]['seconds'] += seconds
+
+    def report(self):
+        stages = dict(self.stages)
+        if 'analysis' in stages:
+            stages['matching'] = stages['analysis'] - stages.get('reassembly', 0)
+        if 'run' in stages:
+            stages['sessionize'] = stages['run'] - sum(stages.get(name, 0) for name in ('ingest', 'analysis', 'post_analysis'))
+        run = stages.get('run') or None
+        counters = dict(template.stats)
+        counters.update(reassembly.stats)
+        counters.update((name, count) for name, count in self.counts.items() if name not in ('packets', 'sessions', 'convos'))
+        convos = self.counts['convos']
+        return {
+            'python': platform.python_version(),
+            'wall_seconds': perf_counter() - self.started,
+            'stages': stages,
+            'packets': self.counts['packets'],
+            'sessions': self.counts['sessions'],
+            'convos': convos,
+            'packets_per_second': self.counts['packets'] / run if run else None,
+            'sessions_per_second': self.counts['sessions'] / run if run else None,
+            'counters': counters,
+            'comparisons_per_convo': template.stats['template_comparisons'] / convos if convos else None,
+            'ports': {str(port): dict(totals) for port, totals in sorted(self.ports.items())},
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        logging.info("Wrote run statistics to {}".format(path))
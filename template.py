@@ -1,8 +1,45 @@
+from collections import Counter, namedtuple
 from copy import copy
-from difflib import SequenceMatcher
 from ascii import RED, GREEN, RESET
 from util import dbg, printable, is_printable
-from util import ConfigMixin
+from util import ConfigMixin, LRUCache
+import diff
+
+
+# Result of one diff between a template and an input, shared by fits, find_variables and
+# the ratio penalty. The matcher itself is reused, so only its results are kept.
+Comparison = namedtuple('Comparison', ['opcodes', 'ratio'])
+
+# The same input is compared against every template on a port. SequenceMatcher indexes its
+# b side (the input) once in set_seq2, so matchers are kept per input and only get a new a.
+# See diff.py for the engines.
+matchers = LRUCache(8)
+byte_counts = LRUCache(8)
+stats = Counter()
+
+# upper bounds get a little slack so float rounding can never prune a template that ties
+BOUND_SLACK = 1e-9
+
+
+def count_bytes(text):
+    counts = byte_counts.get(text)
+    if counts is None:
+        counts = Counter(text)
+        byte_counts.put(text, counts)
+    return counts
+
+
+def indexed_matcher(other_text, backend=None, anchored=False):
+    backend = backend or diff.DEFAULT_BACKEND
+    key = (backend, anchored, other_text)
+    matcher = matchers.get(key)
+    if matcher is None:
+        if anchored:
+            matcher = diff.AnchoredMatcher(other_text, backend)
+        else:
+            matcher = diff.make_matcher(backend, other_text)
+        matchers.put(key, matcher)
+    return matcher
 
 
 class TemplateError(Exception):
@@ -14,16 +51,36 @@ class ConvoTemplate(ConfigMixin):
         self.recv = Template(recv, [], config)
         self.sent = Template(sent, [], config)
         self.config = config
+        # conversations folded in during training and matched during detection
+        self.trained = 0
+        self.hits = 0
 
-    def similarity(self, sent, recv):
+    def similarity(self, sent, recv, floor=0.0):
+        # below floor the caller isn't interested, the exact score doesn't matter then
         sim_sent = self.sent.similarity(sent)
+        if sim_sent < floor:
+            return sim_sent
         sim_recv = self.recv.similarity(recv)
         return min(sim_sent, sim_recv)
 
+    def upper_bound(self, sent, recv, floor=0.0):
+        # cheap bound on similarity, anything at or below floor is not refined further
+        bound = min(self.sent.upper_bound(sent, floor), self.recv.upper_bound(recv, floor))
+        if bound <= floor:
+            return bound
+        return min(self.sent.upper_bound(sent, floor, exact=True), self.recv.upper_bound(recv, floor, exact=True))
+
     def update(self, sent, recv):
         self.sent.update(sent)
         self.recv.update(recv)
 
+    def merge(self, other):
+        self.sent.merge(other.sent)
+        self.recv.merge(other.recv)
+
+    def convo(self):
+        return (self.sent.text, self.recv.text)
+
     def show(self):
         result = "<<< recv\n" + self.recv.show() + "\n"
         result += ">>> sent\n" + self.sent.show() + "\n"
@@ -40,6 +97,172 @@ class ConvoTemplate(ConfigMixin):
         result.recv = Template.load(i['recv'], config)
         return result
 
+    def pack(self, w):
+        self.sent.pack(w)
+        self.recv.pack(w)
+
+    def unpack(r, config=None):
+        result = ConvoTemplate("","", config)
+        result.sent = Template.unpack(r, config)
+        result.recv = Template.unpack(r, config)
+        return result
+
+
+class Turns(tuple):
+    # A conversation as a (sent, recv) pair per request and response, see
+    # PacketAnalyzer.packets_to_turns. Plain conversations are a single (sent, recv).
+    def texts(self):
+        return [text for turn in self for text in turn]
+
+    def flatten(self):
+        return (b'\n'.join(sent for sent, _ in self), b'\n'.join(recv for _, recv in self))
+
+
+def convo_texts(convo):
+    return convo.texts() if isinstance(convo, Turns) else list(convo)
+
+
+def flat_convo(convo):
+    return convo.flatten() if isinstance(convo, Turns) else convo
+
+
+def load_template(i, config=None):
+    if 'turns' in i:
+        return TurnTemplate.load(i, config)
+    return ConvoTemplate.load(i, config)
+
+
+class TurnTemplate(ConfigMixin):
+    # A ConvoTemplate per turn. Only conversations with as many turns match, and matching
+    # stops at the first turn that can't reach floor, so a long session costs a diff per
+    # message instead of one big diff.
+    def __init__(self, turns, config={}):
+        self.turns = [ConvoTemplate(sent, recv, config) for sent, recv in turns]
+        self.config = config
+        self.trained = 0
+        self.hits = 0
+
+    def similarity(self, *turns, floor=0.0):
+        if len(turns) != len(self.turns):
+            return 0.0
+        score = 1.0
+        for temp, turn in zip(self.turns, turns):
+            score = min(score, temp.similarity(*turn, floor=floor))
+            if score < floor:
+                break
+        return score
+
+    def upper_bound(self, *turns, floor=0.0):
+        if len(turns) != len(self.turns):
+            return 0.0
+        bound = 1.0 + BOUND_SLACK
+        for temp, turn in zip(self.turns, turns):
+            bound = min(bound, temp.upper_bound(*turn, floor=floor))
+            if bound <= floor:
+                break
+        return bound
+
+    def update(self, *turns):
+        for temp, turn in zip(self.turns, turns):
+            temp.update(*turn)
+
+    def merge(self, other):
+        for temp, other_temp in zip(self.turns, other.turns):
+            temp.merge(other_temp)
+
+    def convo(self):
+        return Turns(temp.convo() for temp in self.turns)
+
+    def show(self):
+        result = ""
+        for i, temp in enumerate(self.turns):
+            result += "turn {}\n".format(i + 1) + temp.show()
+        return result
+
+    def dict(self):
+        return {'turns': [temp.dict() for temp in self.turns]}
+
+    def load(i, config=None):
+        result = TurnTemplate([], config)
+        result.turns = [ConvoTemplate.load(t, config) for t in i['turns']]
+        return result
+
+    def pack(self, w):
+        w.u32(len(self.turns))
+        for temp in self.turns:
+            temp.pack(w)
+
+    def unpack(r, config=None):
+        result = TurnTemplate([], config)
+        result.turns = [ConvoTemplate.unpack(r, config) for _ in range(r.u32())]
+        return result
+
+
+def merge_intervals(intervals):
+    merged = []
+    for a, b in sorted(intervals):
+        if merged and a <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return merged
+
+
+class TemplateScanner:
+    # A template is literal text with holes of bounded length at its variables. This checks
+    # an input against that in a single left to right pass over the literals, keeping the
+    # positions each hole can end at as a list of intervals, without diffing.
+    def __init__(self, compare_text, compare_vars):
+        self.literals = []
+        self.holes = []
+        pos = 0
+        for vpos in sorted(compare_vars):
+            self.literals.append(compare_text[pos:vpos])
+            self.holes.append(compare_vars[vpos])
+            pos = vpos
+        self.literals.append(compare_text[pos:])
+
+    def match(self, text):
+        # returns the value of every hole, or None if the input does not fit
+        head = self.literals[0]
+        if not self.holes:
+            return [] if text == head else None
+        tail = self.literals[-1]
+        if not text.startswith(head) or not text.endswith(tail):
+            return None
+        end = len(text) - len(tail)
+        reach = [[len(head), len(head)]]
+        starts = []
+        for i, hole in enumerate(self.holes):
+            starts.append(reach)
+            ends = merge_intervals((a + hole.min_len, b + hole.max_len) for a, b in reach)
+            if i == len(self.holes) - 1:
+                if not any(a <= end <= b for a, b in ends):
+                    return None
+                break
+            literal = self.literals[i + 1]
+            points = []
+            for a, b in ends:
+                j = text.find(literal, a, min(b, end) + len(literal))
+                while j != -1:
+                    points.append((j + len(literal), j + len(literal)))
+                    j = text.find(literal, j + 1, min(b, end) + len(literal))
+            reach = merge_intervals(points)
+            if not reach:
+                return None
+        values = []
+        for i in range(len(self.holes) - 1, -1, -1):
+            hole = self.holes[i]
+            lo, hi = end - hole.max_len, end - hole.min_len
+            start = None
+            for a, b in starts[i]:
+                if a <= hi and b >= lo:
+                    start = min(b, hi)
+            values.append(text[start:end])
+            end = start - len(self.literals[i])
+        values.reverse()
+        return values
+
 
 class Template(ConfigMixin):
     def __init__(self, text, variables=[], config={}):
@@ -51,14 +274,36 @@ class Template(ConfigMixin):
         self.config = config
         self.variables = variables
         self.special_strings = self.get_config('special_strings', {})
+        self.last_comparison = None
+        self.bound_info = None
+        self.scanner = None
         self.consolidate_vars()
 
-    def fits(self, other):
+    def get_scanner(self):
+        if self.scanner is None:
+            self.scanner = TemplateScanner(self.compare_text, self.compare_vars)
+        return self.scanner
+
+    def quick_fits(self, other):
+        # Linear time check of the whole input against the template. A miss does not mean
+        # the input doesn't fit, the diff based fits may still accept it.
+        values = self.get_scanner().match(other)
+        if values is None:
+            return False
+        for var, value in zip(self.get_scanner().holes, values):
+            if self.get_special_chars(value) - var.special_strings != set():
+                return False
+        return True
+
+    def fits(self, other, comparison=None):
         if type(other) == str:
             other = other.encode()
+        if comparison is None and self.quick_fits(other):
+            return True
         inserts = dict.fromkeys(self.compare_vars.keys(), b'')
-        matcher = self.get_matcher(other)
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if comparison is None:
+            comparison = self.compare(other)
+        for tag, i1, i2, j1, j2 in comparison.opcodes:
             if tag == 'insert':
                 vpos = i1
                 if not i1 in self.compare_vars:
@@ -119,9 +364,10 @@ class Template(ConfigMixin):
         other_ratio = sum(v.len - v.min_len for v in vars) / len(self.text)
         return abs(other_ratio - my_ratio)
 
-    def calculate_ratio_penalty(self, other):
-        matcher =  self.get_matcher(other)
-        return 1.0 - matcher.ratio()
+    def calculate_ratio_penalty(self, other, comparison=None):
+        if comparison is None:
+            comparison = self.compare(other)
+        return 1.0 - comparison.ratio
 
     def calculate_specials_penalty(self, vars):
         my_specials = set()
@@ -133,14 +379,14 @@ class Template(ConfigMixin):
         penalties = sum(v for s,v in self.special_strings.items() if s in other_specials and not s in my_specials)
         return penalties
 
-    def score_difference(self, other_vars, other):
+    def score_difference(self, other_vars, other, comparison=None):
         score = 1.0
         penalties = list()
         penalties.append(self.calculate_length_penalty(other) * self.get_config('score_length_weight',0))
         penalties.append(self.calculate_var_len_penalty(other_vars) *  self.get_config('score_vlen_weight',0))
         penalties.append(self.calculate_growth_penalty(other_vars) *  self.get_config('score_growth_weight',0))
         penalties.append(self.calculate_shrink_penalty(other_vars) *  self.get_config('score_shrink_weight',0))
-        penalties.append(self.calculate_ratio_penalty(other) *  self.get_config('score_ratio_weight',0))
+        penalties.append(self.calculate_ratio_penalty(other, comparison) *  self.get_config('score_ratio_weight',0))
         penalties.append(self.calculate_specials_penalty(other_vars) *  self.get_config('score_specials_weight',0))
         score -= sum(penalties)
         return max(0.0, score)
@@ -159,16 +405,72 @@ class Template(ConfigMixin):
         else:
             my_text = self.compare_text
         if len(my_text) > max_text_len:
+            my_text = my_text[:max_text_len]
+        # long texts only get the windows between aligned identical runs diffed
+        anchored = max(len(my_text), len(other_text)) > self.get_config('anchored_diff_len', diff.AnchoredMatcher.MAX_WINDOW)
+        matcher = indexed_matcher(other_text, self.get_config('diff_backend'), anchored)
+        matcher.set_seq1(my_text)
+        stats['matcher_calls'] += 1
+        return matcher
+
+    def compare(self, other, for_update=False):
+        # fits and the ratio penalty diff against compare_text, find_variables against text.
+        # Without variables those are the same, so one diff serves all three.
+        if self.compare_text == self.text:
+            for_update = False
+        key = (other, for_update)
+        if self.last_comparison and self.last_comparison[0] == key:
+            return self.last_comparison[1]
+        matcher = self.get_matcher(other, for_update)
+        comparison = Comparison(matcher.get_opcodes(), matcher.ratio())
+        self.last_comparison = (key, comparison)
+        return comparison
+
+    def get_bound_info(self):
+        if self.bound_info is None:
+            max_text_len = self.get_config('max_text_len', 1024)
             my_text = self.compare_text[:max_text_len]
-        s = SequenceMatcher(None, my_text, other_text, autojunk=False)
-        return s
+            min_vars = sum(v.min_len for v in self.compare_vars.values())
+            max_vars = sum(v.max_len for v in self.compare_vars.values())
+            self.bound_info = (my_text, min_vars, max_vars, Counter(my_text))
+        return self.bound_info
+
+    def could_fit(self, other):
+        # fits only allows inserts at variables, so the input length must be in range
+        my_text, min_vars, max_vars, _ = self.get_bound_info()
+        max_text_len = self.get_config('max_text_len', 1024)
+        diffed_len = min(len(other), max_text_len)
+        full_len = len(self.compare_text)
+        return len(my_text) + min_vars <= diffed_len <= len(my_text) + max_vars or \
+            full_len + min_vars <= len(other) <= full_len + max_vars
+
+    def upper_bound(self, other, floor=0.0, exact=False):
+        # Bounds similarity without diffing. If the input can't fit, the score is at most 1
+        # minus the length penalty minus the ratio penalty, and the ratio is bounded by
+        # difflib's real_quick_ratio (lengths only) or, with exact, quick_ratio (byte counts).
+        if type(other) == str:
+            other = other.encode()
+        if self.could_fit(other):
+            return 1.0 + BOUND_SLACK
+        my_text, _, _, my_counts = self.get_bound_info()
+        other_text = other[:self.get_config('max_text_len', 1024)]
+        total = len(my_text) + len(other_text)
+        if exact:
+            matches = sum((my_counts & count_bytes(other_text)).values())
+        else:
+            matches = min(len(my_text), len(other_text))
+        max_ratio = 2.0 * matches / total if total else 1.0
+        bound = 1.0 - self.calculate_length_penalty(other) * self.get_config('score_length_weight', 0) - \
+            (1.0 - max_ratio) * self.get_config('score_ratio_weight', 0)
+        return bound + BOUND_SLACK
 
-    def find_variables(self, other):
+    def find_variables(self, other, comparison=None):
         if type(other) == str:
             other = other.encode()
         vars = []
-        matcher = self.get_matcher(other, for_update=True)
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if comparison is None:
+            comparison = self.compare(other, for_update=True)
+        for tag, i1, i2, j1, j2 in comparison.opcodes:
             ln = i2-i1
             ln2 = j2-j1
             s2 = other[j1:j2]
@@ -183,12 +485,16 @@ class Template(ConfigMixin):
         return vars
 
     def similarity(self, other):
-        if self.fits(other):
-            return 1.0
         if type(other) == str:
             other = other.encode()
+        if self.quick_fits(other):
+            stats['quick_fits'] += 1
+            return 1.0
+        comparison = self.compare(other)
+        if self.fits(other, comparison):
+            return 1.0
         vars = self.find_variables(other)
-        score =  self.score_difference(vars, other)
+        score =  self.score_difference(vars, other, comparison)
         return score
 
     def update(self, other):
@@ -200,7 +506,44 @@ class Template(ConfigMixin):
                 self.variables.append(v)
         self.consolidate_vars()
 
+    def merge(self, other):
+        # Folds in a template trained on other traffic: its text like an update, then its
+        # variables, moved to the matching position in our text.
+        opcodes = self.compare(other.text, for_update=True).opcodes
+        self.update(other.text)
+        if not opcodes:
+            return
+
+        def own_pos(j, end=False):
+            # (our position, their position) where j lands. In or next to a changed block
+            # that is the edge of the block, so the variable covers the whole change.
+            for tag, i1, i2, j1, j2 in opcodes:
+                if tag != 'equal' and j1 <= j <= j2:
+                    return (i2, j2) if end else (i1, j1)
+            for tag, i1, i2, j1, j2 in opcodes:
+                if j1 <= j <= j2:
+                    return i1 + j - j1, j
+            # past the diffed part of the text
+            i2, j2 = opcodes[-1][2], opcodes[-1][4]
+            return min(len(self.text), i2 + j - j2), j
+
+        for v in other.variables:
+            i1, j1 = own_pos(v.pos)
+            i2, j2 = own_pos(v.pos + v.len, end=True)
+            ln = max(0, i2 - i1)
+            # their text around the variable can grow and shrink as much as the variable
+            other_len = max(0, j2 - j1)
+            max_len = max(ln, other_len + v.max_len - v.len)
+            min_len = max(0, min(ln, other_len - (v.len - v.min_len)))
+            var = TemplateVariable(i1, ln, min_len, max_len, v.special_strings)
+            if not self.fit_variable(var):
+                self.variables.append(var)
+        self.consolidate_vars()
+
     def consolidate_vars(self):
+        self.last_comparison = None
+        self.bound_info = None
+        self.scanner = None
         if self.variables == []:
             return
         old_vars = sorted(self.variables)
@@ -213,17 +556,20 @@ class Template(ConfigMixin):
                 new_vars[-1].merge(v)
             pos = max(pos, v.pos + v.len)
         self.variables = new_vars
-        self.compare_text = b''
+        # joined once, long texts with many variables would be copied over and over
+        parts = []
+        vpos = 0
         pos = 0
         self.compare_vars = {}
         for var in self.variables:
             if var.pos > pos:
-                self.compare_text += self.text[pos:var.pos]
-            vpos = len(self.compare_text)
+                parts.append(self.text[pos:var.pos])
+                vpos += var.pos - pos
             self.compare_vars[vpos] = var
             pos = var.pos + var.len
         if pos < len(self.text):
-            self.compare_text += self.text[pos:]
+            parts.append(self.text[pos:])
+        self.compare_text = b''.join(parts)
 
     def show(self):
         pos = 0
@@ -251,6 +597,17 @@ class Template(ConfigMixin):
         vars = [TemplateVariable.load(v) for v in i['variables']]
         return Template(i['text'], vars, b)
 
+    def pack(self, w):
+        w.bytes(self.text)
+        w.u32(len(self.variables))
+        for v in self.variables:
+            v.pack(w)
+
+    def unpack(r, b=None):
+        text = r.bytes()
+        vars = [TemplateVariable.unpack(r) for _ in range(r.u32())]
+        return Template(text, vars, b)
+
 
 class TemplateVariable:
     def __init__(self, pos, len, min_len, max_len, special_strings=set()):
@@ -291,6 +648,18 @@ class TemplateVariable:
     def load(i):
         return TemplateVariable(i['pos'], i['len'], i['min_len'], i['max_len'], i['special_strings'])
 
+    def pack(self, w):
+        for i in (self.pos, self.len, self.min_len, self.max_len):
+            w.u32(i)
+        w.u16(len(self.special_strings))
+        for s in sorted(self.special_strings):
+            w.bytes(s)
+
+    def unpack(r):
+        pos, len, min_len, max_len = r.u32(), r.u32(), r.u32(), r.u32()
+        specials = {r.bytes() for _ in range(r.u16())}
+        return TemplateVariable(pos, len, min_len, max_len, specials)
+
     def __repr__(self):
         return "var: {}:{} R{}-{} S[{}]".format(self.pos, self.len, self.min_len, self.max_len, b''.join(self.special_strings).decode())
 
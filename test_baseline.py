@@ -0,0 +1,192 @@
+from base_test import BaseTest
+from baseline import Baseline, PortBaseline
+from template import Turns, TurnTemplate, stats
+from binary import BinaryReader, BinaryWriter, BinaryFormatError, MAGIC
+import os
+import random
+import tempfile
+
+
+class BaselineFileTest(BaseTest):
+    def setUp(self):
+        self.baseline = Baseline()
+        self.baseline.addConvo(80, (b'GET /index.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nhello'))
+        self.baseline.addConvo(80, (b'GET /login.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nlogin'))
+        self.baseline.addConvo(7, (b'hallo\n', b'hallo\n'))
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.unlink(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def roundtrip(self, name, fmt=None):
+        path = os.path.join(self.dir, name)
+        self.baseline.write(path, fmt)
+        return path, Baseline.read(path)
+
+    def test_binary_roundtrip(self):
+        path, result = self.roundtrip('b.dbl')
+        with open(path, 'rb') as f:
+            self.assertTrue(f.read().startswith(MAGIC))
+        self.assertEqual(self.baseline.dict(), result.dict())
+        convo = (b'GET /about.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nabout')
+        self.assertEqual(self.baseline.checkConvo(80, convo), result.checkConvo(80, convo))
+
+    def test_format_flag(self):
+        path, result = self.roundtrip('b.yml', 'binary')
+        self.assertEqual(self.baseline.dict(), result.dict())
+        path, result = self.roundtrip('b.dbl', 'yaml')
+        with open(path, 'rb') as f:
+            self.assertFalse(f.read().startswith(MAGIC))
+        self.assertEqual(self.baseline.dict(), result.dict())
+
+    def test_turns_roundtrip(self):
+        self.baseline.addConvo(25, Turns([(b'220 ready', b''), (b'250 ok', b'HELO a')]))
+        path, result = self.roundtrip('b.dbl')
+        self.assertEqual(self.baseline.dict(), result.dict())
+        self.assertIsInstance(result.ports[25].templates[0], TurnTemplate)
+        self.assertEqual(0.0, result.checkConvo(25, Turns([(b'220 ready', b''), (b'250 ok', b'HELO a')]))[1])
+
+    def test_values(self):
+        value = {'a': [1, -2, 0.5, None, True], b'b': {b'x', b'y'}, 3: 'str'}
+        w = BinaryWriter()
+        w.value(value)
+        self.assertEqual(value, BinaryReader(w.getvalue()).value())
+
+    def test_newer_version(self):
+        with self.assertRaises(BinaryFormatError):
+            BinaryReader(MAGIC + b'\xff\xff')
+        path = os.path.join(self.dir, 'new.dbl')
+        with open(path, 'wb') as f:
+            f.write(MAGIC + b'\xff\xff')
+        self.assertIsNone(Baseline.read(path))
+
+    def test_truncated(self):
+        path, _ = self.roundtrip('b.dbl')
+        with open(path, 'rb') as f:
+            data = f.read()
+        for size in range(len(MAGIC), len(data), 7):
+            with self.assertRaises(BinaryFormatError):
+                Baseline.unpack(BinaryReader(data[:size]))
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        self.assertIsNone(Baseline.read(path))
+
+
+class BaselineMergeTest(BaseTest):
+    def test_merge(self):
+        a = Baseline()
+        a.addConvo(80, (b'GET /index.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nhello'))
+        a.addConvo(80, (b'GET /login.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nlogin'))
+        b = Baseline()
+        b.addConvo(80, (b'GET /about.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nabout'))
+        b.addConvo(80, (b'GET /about.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nmore about'))
+        b.addConvo(7, (b'hallo\n', b'hallo\n'))
+        a.merge(b)
+        self.assertEqual([7, 80], sorted(a.ports))
+        self.assertEqual(1, len(a.ports[80].templates))
+        self.assertIs(a.config, a.ports[7].config)
+        self.assertIs(a.config, a.ports[7].templates[0].sent.config)
+        self.assertEqual(0.0, a.checkConvo(80, (b'GET /about.html HTTP/1.1\r\n\r\n', b'HTTP/1.1 200 OK\r\n\r\nmore about'))[1])
+        self.assertEqual(0.0, a.checkConvo(7, (b'hallo\n', b'hallo\n'))[1])
+
+
+class BaselineHitsTest(BaseTest):
+    def setUp(self):
+        self.baseline = Baseline()
+        self.baseline.addConvo(80, (b'220 smtp.example.org ESMTP ready', b'EHLO mail.example.net'))
+        self.baseline.addConvo(80, (b'SSH-2.0-OpenSSH_7.4', b'SSH-2.0-libssh2_1.8.0'))
+        for page in (b'/a', b'/bb', b'/ccc'):
+            self.baseline.addConvo(80, (b'HTTP/1.1 200 OK\r\n\r\n' + page, b'GET ' + page + b' HTTP/1.1'))
+
+    def test_counters(self):
+        templates = self.baseline.ports[80].templates
+        self.assertEqual([1, 1, 3], [t.trained for t in templates])
+        message, score, index = self.baseline.match(80, (b'HTTP/1.1 200 OK\r\n\r\n/dd', b'GET /dd HTTP/1.1'))
+        self.assertEqual((0.0, 2), (score, index))
+        self.baseline.record_hit(80, index)
+        result = Baseline.load(self.baseline.dict())
+        self.assertEqual([(1, 0), (1, 0), (3, 1)], [(t.trained, t.hits) for t in result.ports[80].templates])
+        report = result.unused_report()
+        self.assertIn('2 of 3 templates were never hit', report)
+
+    def test_hottest_first(self):
+        stats.clear()
+        self.baseline.checkConvo(80, (b'HTTP/1.1 200 OK\r\n\r\n/dd', b'GET /dd HTTP/1.1'))
+        self.assertEqual(1, stats['template_comparisons'])
+
+
+class BaselineCompactTest(BaseTest):
+    def setUp(self):
+        self.baseline = Baseline()
+        self.portbl = PortBaseline(80, self.baseline.config)
+        self.baseline.ports[80] = self.portbl
+        # templates that training kept apart because they came in before the variable did
+        self.convos = [(b'GET /index.html?id=' + n + b' HTTP/1.1', b'HTTP/1.1 200 OK\r\n\r\nid ' + n) for n in
+                       (b'1111', b'22222', b'333333')]
+        self.convos.append((b'EHLO mail.example.net', b'220 smtp.example.org ESMTP ready'))
+        for i, convo in enumerate(self.convos):
+            temp = self.portbl.new_template(convo)
+            temp.trained = i + 1
+            self.portbl.templates.append(temp)
+
+    def test_compact(self):
+        self.portbl.compact(0.2)
+        self.assertEqual(2, len(self.portbl.templates))
+        self.assertEqual([6, 4], [t.trained for t in self.portbl.templates])
+        for convo in self.convos:
+            self.assertEqual(0.0, self.baseline.checkConvo(80, convo)[1])
+
+    def test_cap(self):
+        self.portbl.compact(0.99, max_templates=1)
+        self.assertEqual(1, len(self.portbl.templates))
+        self.assertEqual(10, self.portbl.templates[0].trained)
+
+    def test_cap_turn_counts(self):
+        # a template with another number of turns is dropped, not merged into the kept one
+        self.portbl.templates = []
+        for turns, trained in (([(b'USER a', b'+OK'), (b'PASS b', b'+OK')], 5), ([(b'USER a', b'+OK')], 1)):
+            temp = self.portbl.new_template(Turns(turns))
+            temp.trained = trained
+            self.portbl.templates.append(temp)
+        self.portbl.compact(0.99, max_templates=1)
+        self.assertEqual(1, len(self.portbl.templates))
+        self.assertEqual(5, self.portbl.templates[0].trained)
+        self.assertEqual(2, len(self.portbl.templates[0].turns))
+
+
+class BaselineScanTest(BaseTest):
+    # the pruned search has to give the verdicts of comparing against every template
+    def random_convo(self, rng):
+        word = lambda: bytes(rng.choice(b'abcd;/?') for _ in range(rng.randint(0, 6)))
+        shape = rng.randrange(4)
+        sent = b'GET /' + word() + b' HTTP/1.1' if shape < 2 else b'CMD ' + word() + b';' + word()
+        recv = b'200 ' + word() * rng.randint(1, 3) if shape % 2 else word() + b'\n' + word()
+        if rng.random() < 0.3:
+            return Turns([(sent, recv), (word(), b'ok ' + word())])
+        return sent, recv
+
+    def full_scan(self, portbl, convo):
+        turns = isinstance(convo, Turns)
+        # ties go to the hottest, then the oldest template
+        scores = [(t.similarity(*convo), t.trained + t.hits, -i, i) for i, t in enumerate(portbl.templates)
+                  if isinstance(t, TurnTemplate) == turns]
+        return max(scores, default=(0.0, 0, 0, None))
+
+    def test_random(self):
+        rng = random.Random(7)
+        for run in range(3):
+            baseline = Baseline()
+            for _ in range(40):
+                baseline.addConvo(80, self.random_convo(rng))
+            portbl = baseline.ports[80]
+            for t in portbl.templates:
+                t.hits = rng.randrange(3)
+            floor = portbl.get_config('training_treshold')
+            for _ in range(100):
+                convo = self.random_convo(rng)
+                score, _, _, index = self.full_scan(portbl, convo)
+                self.assertEqual(score, portbl.match(convo)[0])
+                expected = portbl.templates[index] if index is not None and score > floor else None
+                self.assertIs(expected, portbl.best_template(convo))
@@ -0,0 +1,29 @@
+from base_test import BaseTest
+from scapy.all import Ether, Dot1Q, IP, TCP, UDP, ARP, Raw, Padding
+from decode import decode_ether, decode_raw, from_scapy, flow_key
+
+
+class DecodeTest(BaseTest):
+    def check_same(self, packet):
+        data = bytes(packet)
+        self.assertEqual(from_scapy(Ether(data), 1.0), decode_raw(data, 1.0, 1))
+
+    def test_equivalence(self):
+        eth = Ether(src='02:42:ad:00:00:11', dst='02:42:3e:00:00:01')
+        self.check_same(eth / IP(src='1.2.3.4', dst='5.6.7.8') / TCP(sport=1234, dport=80, flags='PA', seq=42) / Raw(b'GET /'))
+        self.check_same(eth / IP(src='1.2.3.4', dst='5.6.7.8') / TCP(sport=1234, dport=80, flags='S'))
+        self.check_same(eth / IP(src='1.2.3.4', dst='5.6.7.8') / UDP(sport=1234, dport=7) / Raw(b'hallo'))
+        self.check_same(eth / IP(src='1.2.3.4', dst='5.6.7.8') / TCP(sport=1, dport=2) / Raw(b'x') / Padding(b'\0' * 5))
+        self.check_same(eth / ARP())
+        self.check_same(eth / Dot1Q() / IP() / TCP() / Raw(b'tagged'))
+
+    def test_fallback(self):
+        self.assertIsNone(decode_ether(bytes(Ether() / Dot1Q() / IP() / TCP()), 1.0))
+        self.assertIsNone(decode_ether(bytes(Ether() / IP(flags='MF') / TCP()), 1.0))
+        self.assertIsNone(decode_ether(b'\0' * 10, 1.0))
+
+    def test_flow_key(self):
+        p = from_scapy(Ether() / IP(src='1.2.3.4', dst='5.6.7.8') / TCP(sport=1234, dport=80), 1.0)
+        q = from_scapy(Ether() / IP(src='5.6.7.8', dst='1.2.3.4') / TCP(sport=80, dport=1234), 1.0)
+        self.assertEqual(flow_key(p), flow_key(q))
+        self.assertIsNone(flow_key(from_scapy(Ether() / ARP(), 1.0)))
@@ -0,0 +1,85 @@
+import time
+from unittest import mock
+from base_test import BaseTest
+from baseline import Baseline
+from decode import PacketRecord
+from detection_analyzer import DetectionAnalyzer
+from report import ReportSink
+from runstats import RunStats
+
+
+def session(request, response, sport=1234, start=0):
+    client = lambda t, flags, seq, payload=b'': PacketRecord(start + t, 'c', 's', 'TCP', '1.1.1.1', sport, '2.2.2.2', 7,
+                                                           flags, seq, payload)
+    server = lambda t, flags, seq, payload=b'': PacketRecord(start + t, 's', 'c', 'TCP', '2.2.2.2', 7, '1.1.1.1', sport,
+                                                           flags, seq, payload)
+    return [client(0, 0x02, 0), server(0.1, 0x12, 0), client(0.2, 0x18, 1, request),
+            server(0.3, 0x18, 1, response), client(0.4, 0x11, 1 + len(request)), server(0.5, 0x11, 1 + len(response))]
+
+
+def echo_analyzer():
+    analyzer = DetectionAnalyzer()
+    analyzer.sink = ReportSink()
+    analyzer.local.macs.add('s')
+    analyzer.baseline.addConvo(7, (b'hallo', b'hallo'))
+    return analyzer
+
+
+class VerdictCacheTest(BaseTest):
+    def setUp(self):
+        self.analyzer = echo_analyzer()
+
+    def spy(self):
+        return mock.patch.object(self.analyzer.baseline, 'match', wraps=self.analyzer.baseline.match)
+
+    def test_flag_repeat(self):
+        with self.spy() as match:
+            self.analyzer.analyze_session(session(b'give FLAG{0123}', b'FLAG{0123}'))
+            self.analyzer.analyze_session(session(b'give FLAG{4567}', b'FLAG{4567}', 1235))
+        self.assertEqual(1, match.call_count)
+        self.assertEqual((1, 1), (self.analyzer.verdicts.hits, self.analyzer.verdicts.misses))
+        self.assertEqual(2, self.analyzer.anomalies()[0].count)
+
+    def test_new_baseline(self):
+        self.analyzer.analyze_session(session(b'hallo', b'hallo'))
+        self.assertEqual(1, len(self.analyzer.verdicts))
+        self.analyzer.baseline = Baseline()
+        with self.spy() as match:
+            self.analyzer.analyze_session(session(b'hallo', b'hallo'))
+        self.assertEqual(1, match.call_count)
+        self.assertEqual(0, self.analyzer.verdicts.hits)
+
+    def test_disabled(self):
+        # --verdict-cache 0
+        self.analyzer.verdicts.size = 0
+        with self.spy() as match:
+            for sport in (1234, 1235):
+                self.analyzer.analyze_session(session(b'hallo', b'hallo', sport))
+        self.assertEqual(2, match.call_count)
+        self.assertEqual(0, self.analyzer.verdicts.hits)
+
+    def test_stats(self):
+        self.analyzer.stats = RunStats()
+        self.analyzer.run(session(b'hallo', b'hallo') + session(b'hallo', b'hallo', 1235, 1), 's')
+        counts = self.analyzer.stats.report()['counters']
+        self.assertEqual((1, 1), (counts['verdict_cache_hits'], counts['verdict_cache_misses']))
+
+
+class WorkersTest(BaseTest):
+    def test_idle_collects(self):
+        analyzer = echo_analyzer()
+        analyzer.workers = 2
+        analyzer.live = True
+        reported = []
+
+        def packets():
+            yield from session(b'give-me-flag!', b'FLAG{0123}')
+            for _ in range(50):
+                if analyzer.anomaly_count:
+                    break
+                time.sleep(0.05)
+                yield None
+            reported.append(analyzer.anomaly_count)
+
+        analyzer.run(packets(), 's')
+        self.assertEqual([1], reported)
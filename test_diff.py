@@ -0,0 +1,110 @@
+from base_test import BaseTest
+from diff import DifflibMatcher, MyersMatcher, AnchoredMatcher
+from template import Template
+from baseline import Baseline
+import diff
+import random
+import test_template
+
+
+class DiffTest(BaseTest):
+    def check_opcodes(self, a, b, opcodes):
+        # the opcodes have to turn a into b, covering both completely
+        result = b''
+        i = j = 0
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEqual((i, j), (i1, j1))
+            if tag == 'equal':
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            result += b[j1:j2]
+            i, j = i2, j2
+        self.assertEqual((len(a), len(b)), (i, j))
+        self.assertEqual(b, result)
+
+
+class MyersTest(DiffTest):
+    def diff(self, a, b, max_cost=None):
+        m = MyersMatcher(b, max_cost)
+        m.set_seq1(a)
+        return m
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for _ in range(500):
+            a = bytes(rnd.choice(b'abcd') for _ in range(rnd.randint(0, 40)))
+            b = bytearray(a)
+            for _ in range(rnd.randint(0, 5)):
+                pos = rnd.randint(0, len(b))
+                b[pos:pos + rnd.randint(0, 3)] = bytes(rnd.choice(b'abcde') for _ in range(rnd.randint(0, 3)))
+            b = bytes(b)
+            m = self.diff(a, b)
+            self.check_opcodes(a, b, m.get_opcodes())
+            d = DifflibMatcher(b)
+            d.set_seq1(a)
+            # a shortest edit script never matches less than difflib
+            self.assertGreaterEqual(m.ratio(), d.ratio())
+
+    def test_simple(self):
+        self.assertEqual([('equal', 0, 1, 0, 1), ('replace', 1, 2, 1, 2), ('equal', 2, 4, 2, 4)],
+                         self.diff(b'abcd', b'axcd').get_opcodes())
+        self.assertEqual([('insert', 0, 0, 0, 3)], self.diff(b'', b'abc').get_opcodes())
+        self.assertEqual([], self.diff(b'', b'').get_opcodes())
+        self.assertEqual(1.0, self.diff(b'', b'').ratio())
+
+    def test_fallback(self):
+        # too many edits, difflib takes over
+        m = self.diff(b'abcdefgh', b'hgfedcba', max_cost=2)
+        d = DifflibMatcher(b'hgfedcba')
+        d.set_seq1(b'abcdefgh')
+        self.assertEqual(d.get_opcodes(), m.get_opcodes())
+
+
+class AnchoredTest(DiffTest):
+    def setUp(self):
+        rnd = random.Random(2)
+        self.text = bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(50000))
+
+    def test_long(self):
+        other = self.text[:10000] + b'12345' + self.text[10000:30000] + self.text[30010:]
+        m = AnchoredMatcher(other, 'myers')
+        m.set_seq1(self.text)
+        opcodes = m.get_opcodes()
+        self.check_opcodes(self.text, other, opcodes)
+        self.assertEqual([('equal', 0, 10000, 0, 10000), ('insert', 10000, 10000, 10000, 10005),
+                          ('equal', 10000, 30000, 10005, 30005), ('delete', 30000, 30010, 30005, 30005),
+                          ('equal', 30010, 50000, 30005, 49995)], opcodes)
+
+    def test_unrelated(self):
+        other = bytes(reversed(self.text))
+        m = AnchoredMatcher(other)
+        m.set_seq1(self.text)
+        self.check_opcodes(self.text, other, m.get_opcodes())
+
+    def test_late_attack(self):
+        # the injection is far beyond the default max_text_len
+        config = dict(Baseline().config, max_text_len=100000, diff_backend='myers')
+        t = Template(b'POST / HTTP/1.1\r\n\r\n' + self.text, [], config)
+        t.update(b'POST / HTTP/1.1\r\n\r\n' + self.text[:40000] + b'x' + self.text[40001:])
+        self.assertEqual(1.0, t.similarity(b'POST / HTTP/1.1\r\n\r\n' + self.text[:40000] + b'y' + self.text[40001:]))
+        self.assertLess(t.similarity(b'POST / HTTP/1.1\r\n\r\n' + self.text[:45000] + b';cat /etc/passwd' + self.text[45000:]), 1.0)
+
+
+class MyersTemplateTest(test_template.TemplateTest):
+    # every template test again, on the myers engine
+    def setUp(self):
+        super().setUp()
+        self.default_backend = diff.DEFAULT_BACKEND
+        diff.DEFAULT_BACKEND = 'myers'
+
+    def tearDown(self):
+        diff.DEFAULT_BACKEND = self.default_backend
+
+
+class MyersConvoTemplateTest(test_template.ConvoTemplateTest):
+    def setUp(self):
+        super().setUp()
+        self.default_backend = diff.DEFAULT_BACKEND
+        diff.DEFAULT_BACKEND = 'myers'
+
+    def tearDown(self):
+        diff.DEFAULT_BACKEND = self.default_backend
@@ -0,0 +1,52 @@
+from base_test import BaseTest
+from decode import PacketRecord
+from flow import FlowTable
+
+
+def packet(time, client=True, flags=0x18, payload=b'', sport=1234):
+    if client:
+        return PacketRecord(time, 'c', 's', 'TCP', '1.1.1.1', sport, '2.2.2.2', 80, flags, 0, payload)
+    return PacketRecord(time, 's', 'c', 'TCP', '2.2.2.2', 80, '1.1.1.1', sport, flags, 0, payload)
+
+
+class FlowTableTest(BaseTest):
+    def setUp(self):
+        self.closed = []
+        self.table = FlowTable(self.closed.append, idle_timeout=10)
+
+    def test_fin_closes(self):
+        self.table.add(packet(0, flags=0x02))
+        self.table.add(packet(1, payload=b'GET'))
+        self.table.add(packet(2, client=False, flags=0x11))
+        self.assertEqual([], self.closed)
+        self.table.add(packet(3, flags=0x11))
+        self.assertEqual(1, len(self.closed))
+        self.assertEqual(4, len(self.closed[0].packets))
+        # the last ack of the teardown does not start a new flow
+        self.table.add(packet(4, client=False, flags=0x10))
+        self.assertEqual(0, len(self.table))
+
+    def test_rst_closes(self):
+        self.table.add(packet(0, payload=b'a'))
+        self.table.add(packet(1, client=False, flags=0x04))
+        self.assertEqual(1, len(self.closed))
+
+    def test_idle_timeout(self):
+        self.table.add(packet(0, payload=b'a'))
+        self.table.add(packet(5, payload=b'b', sport=4321))
+        self.table.add(packet(11, payload=b'c', sport=4321))
+        self.assertEqual(1, len(self.closed))
+        self.assertEqual(1234, self.closed[0].packets[0].sport)
+        self.table.flush()
+        self.assertEqual(2, len(self.closed))
+        self.assertEqual(2, len(self.closed[1].packets))
+
+    def test_idle_split_keeps_first(self):
+        first = packet(0, payload=b'a')
+        self.table.add(first)
+        self.table.add(packet(20, client=False, payload=b'b'))
+        self.table.add(packet(40, flags=0x02))
+        self.table.flush()
+        self.assertEqual([first, first], [f.packets.first for f in self.closed[:2]])
+        # a new connection on the same ports starts over
+        self.assertEqual(40, self.closed[2].packets.first.time)
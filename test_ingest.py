@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+from base_test import BaseTest
+from scapy.all import Ether, IP, TCP, Raw, wrpcap
+from ingest import read_pcaps, read_pcaps_parallel
+
+
+def packets(start, count, sport):
+    result = []
+    for i in range(count):
+        p = Ether() / IP(src='1.1.1.1', dst='2.2.2.2') / TCP(sport=sport, dport=80, flags='PA') / Raw(b'%d' % i)
+        p.time = start + i
+        result.append(p)
+    return result
+
+
+class ParallelReadTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, start, count, sport):
+        path = os.path.join(self.dir, name)
+        wrpcap(path, packets(start, count, sport))
+        return path
+
+    def check(self, files):
+        serial = list(read_pcaps(files, fast=True))
+        parallel = list(read_pcaps_parallel(files, fast=True, workers=2))
+        times = [r.time for r in parallel]
+        self.assertEqual(sorted(times), times)
+        self.assertEqual(sorted(serial, key=lambda r: r.time), parallel)
+        return serial, parallel
+
+    def test_rotated(self):
+        files = [self.write('a.pcap', 100, 5, 1001),
+                 self.write('b.pcap', 105, 5, 1002),
+                 self.write('c.pcap', 110, 5, 1003)]
+        serial, parallel = self.check(files)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(15, len(parallel))
+
+    def test_overlap(self):
+        # b starts before a ends, c is listed before the file it follows
+        files = [self.write('c.pcap', 120, 3, 1003),
+                 self.write('a.pcap', 100, 10, 1001),
+                 self.write('b.pcap', 104.5, 10, 1002)]
+        serial, parallel = self.check(files)
+        self.assertEqual(23, len(parallel))
+        self.assertEqual([1001, 1002], [r.sport for r in parallel[4:6]])
+
+    def test_unsorted(self):
+        path = self.write('a.pcap', 100, 4, 1001)
+        records = packets(100, 4, 1001)
+        records[1].time, records[2].time = 102, 101
+        wrpcap(path, records)
+        files = [path, self.write('b.pcap', 101.5, 2, 1002)]
+        serial, parallel = self.check(files)
+        self.assertEqual([100, 101, 101.5, 102, 102.5, 103], [r.time for r in parallel])
+
+    def test_directory(self):
+        self.write('a.pcap', 100, 3, 1001)
+        self.write('b.pcap', 103, 3, 1002)
+        self.assertEqual(list(read_pcaps([self.dir], fast=True)),
+                         list(read_pcaps([self.dir], fast=True, workers=2)))
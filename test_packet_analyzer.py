@@ -0,0 +1,95 @@
+from collections import Counter
+from base_test import BaseTest
+from decode import PacketRecord
+from baseline_analyzer import BaselineAnalyzer
+from packet_analyzer import PacketAnalyzer
+from runstats import RunStats
+from local import LocalHosts, LocalError
+
+
+def packet(seq, client=True, payload=b'', flags=0x18):
+    if client:
+        return PacketRecord(0, 'c', 's', 'TCP', '1.1.1.1', 1234, '2.2.2.2', 25, flags, seq, payload)
+    return PacketRecord(0, 's', 'c', 'TCP', '2.2.2.2', 25, '1.1.1.1', 1234, flags, seq, payload)
+
+
+class TurnsTest(BaseTest):
+    def setUp(self):
+        self.analyzer = PacketAnalyzer()
+        self.analyzer.local.macs.add('s')
+        self.analyzer.baseline.config['turn_based'] = True
+
+    def test_turns(self):
+        packets = [packet(0, flags=0x02), packet(0, False, flags=0x12),
+                   packet(1, False, b'220 ready\r\n'),
+                   packet(1, True, b'HELO '), packet(6, True, b'a\r\n'),
+                   packet(12, False, b'250 ok\r\n'),
+                   packet(9, True, b'QUIT\r\n'), packet(20, False, b'221 bye\r\n')]
+        self.assertEqual([(b'220 ready', b''), (b'250 ok', b'HELO a'), (b'221 bye', b'QUIT')],
+                         list(self.analyzer.packets_to_convo(packets)))
+
+    def test_reordered(self):
+        # the second half of the request is captured first, it stays in its turn
+        packets = [packet(6, True, b'a\r\n'), packet(1, True, b'HELO '), packet(1, False, b'250 ok\r\n')]
+        self.assertEqual([(b'250 ok', b'HELO a')], list(self.analyzer.packets_to_convo(packets)))
+
+
+class RunStatsTest(BaseTest):
+    def test_stats(self):
+        analyzer = BaselineAnalyzer()
+        analyzer.stats = RunStats()
+        packets = [packet(0, flags=0x02), packet(0, False, flags=0x12), packet(1, True, b'HELO a\r\n'),
+                   packet(1, False, b'250 ok\r\n'), packet(9, True, flags=0x11), packet(9, False, flags=0x11)]
+        analyzer.run(packets, 's')
+        report = analyzer.stats.report()
+        self.assertEqual((6, 1, 1), (report['packets'], report['sessions'], report['convos']))
+        self.assertEqual({'25'}, set(report['ports']))
+        self.assertEqual(1, report['ports']['25']['sessions'])
+        for stage in ('run', 'ingest', 'analysis', 'reassembly', 'matching', 'sessionize'):
+            self.assertIn(stage, report['stages'])
+
+
+class IdleSplitTest(BaseTest):
+    def test_direction_kept(self):
+        # the connection goes idle and our side speaks first when it continues
+        sessions = []
+        analyzer = BaselineAnalyzer()
+        analyzer.analyze_session = lambda packets, proto: sessions.append(analyzer.split_flow(packets))
+        packets = [packet(0, flags=0x02), packet(0, False, flags=0x12), packet(1, True, b'HELO a\r\n'),
+                   packet(1, False, b'250 ok\r\n'), packet(9, False, b'421 timeout\r\n'),
+                   packet(9, True, b'QUIT\r\n'), packet(22, False, flags=0x11), packet(15, True, flags=0x11)]
+        for i, p in enumerate(packets):
+            packets[i] = p._replace(time=i if i < 4 else 500 + i)
+        analyzer.run(packets, 's')
+        self.assertEqual(2, len(sessions))
+        sent, recv = sessions[1]
+        self.assertEqual([b'421 timeout\r\n', b''], [p.payload for p in sent])
+        self.assertEqual([b'QUIT\r\n', b''], [p.payload for p in recv])
+
+
+class LocalHostsTest(BaseTest):
+    def test_local(self):
+        local = LocalHosts(['02:42:AD:00:00:11', '10.0.0.1', '192.168.0.0/16'])
+        self.assertTrue(local.is_local('02:42:ad:00:00:11', '1.1.1.1'))
+        self.assertTrue(local.is_local(None, '10.0.0.1'))
+        self.assertTrue(local.is_local(None, '192.168.3.4'))
+        self.assertFalse(local.is_local('02:42:ad:00:00:12', '10.0.0.2'))
+        self.assertRaises(LocalError, local.add, 'eth0')
+
+    def test_detect(self):
+        # every packet goes through the same gateway mac, the host that gets connections wins
+        analyzer = BaselineAnalyzer()
+        packets = [packet(0, flags=0x02), packet(0, False, flags=0x12), packet(1, True, b'HELO a\r\n'),
+                   packet(1, False, b'250 ok\r\n'), packet(9, True, flags=0x11), packet(9, False, flags=0x11)]
+        packets = [p._replace(src_mac='gw', dst_mac='gw') for p in packets]
+        analyzer.run(packets)
+        self.assertEqual({'2.2.2.2'}, analyzer.local.ips)
+        self.assertEqual(1, len(analyzer.baseline.ports[25].templates))
+        self.assertEqual((b'250 ok', b'HELO a'), analyzer.baseline.ports[25].templates[0].convo())
+
+    def test_detect_several(self):
+        analyzer = PacketAnalyzer()
+        analyzer.servers = Counter({'2.2.2.2': 40, '2.2.2.3': 25, '3.3.3.3': 4})
+        with self.assertLogs(level='WARNING'):
+            analyzer.find_local()
+        self.assertEqual({'2.2.2.2', '2.2.2.3'}, analyzer.local.ips)
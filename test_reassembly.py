@@ -0,0 +1,53 @@
+from base_test import BaseTest
+from decode import PacketRecord
+import reassembly
+from reassembly import reassemble
+
+
+def segment(seq, payload=b'', flags=0x18):
+    return PacketRecord(0, 'c', 's', 'TCP', '1.1.1.1', 1234, '2.2.2.2', 80, flags, seq, payload)
+
+
+class ReassemblyTest(BaseTest):
+    def setUp(self):
+        reassembly.stats.clear()
+
+    def test_in_order(self):
+        packets = [segment(100, flags=0x02), segment(101, b'GET '), segment(105, b'/ HTTP'), segment(111, flags=0x11)]
+        self.assertEqual(b'GET / HTTP', reassemble(packets))
+        self.assertEqual(0, sum(reassembly.stats.values()))
+
+    def test_retransmission(self):
+        packets = [segment(100, flags=0x02), segment(101, b'GET '), segment(101, b'GET '), segment(105, b'/')]
+        self.assertEqual(b'GET /', reassemble(packets))
+        self.assertEqual(4, reassembly.stats['duplicate_bytes'])
+
+    def test_out_of_order(self):
+        packets = [segment(100, flags=0x02), segment(105, b'/ HTTP'), segment(101, b'GET ')]
+        self.assertEqual(b'GET / HTTP', reassemble(packets))
+        self.assertEqual(1, reassembly.stats['out_of_order'])
+
+    def test_overlap(self):
+        # the segment that starts earlier in the stream wins the overlapping part
+        packets = [segment(1, b'abcd'), segment(3, b'XXef'), segment(0, b'_a')]
+        self.assertEqual(b'_abcdef', reassemble(packets))
+        self.assertEqual(3, reassembly.stats['duplicate_bytes'])
+
+    def test_overlap_differs(self):
+        # a retransmit captured later but starting lower replaces the original bytes
+        packets = [segment(1, b'abcd'), segment(0, b'_XY'), segment(1, b'ZZ')]
+        self.assertEqual(b'_XYcd', reassemble(packets))
+        self.assertEqual(4, reassembly.stats['duplicate_bytes'])
+
+    def test_wraparound(self):
+        packets = [segment(2**32 - 2, flags=0x02), segment(2**32 - 1, b'ab'), segment(1, b'cd')]
+        self.assertEqual(b'abcd', reassemble(packets))
+
+    def test_gap(self):
+        packets = [segment(0, b'ab'), segment(4, b'ef')]
+        self.assertEqual(b'abef', reassemble(packets))
+        self.assertEqual(2, reassembly.stats['missing_bytes'])
+
+    def test_udp(self):
+        packets = [PacketRecord(0, 'c', 's', 'UDP', '1.1.1.1', 1234, '2.2.2.2', 53, None, None, p) for p in (b'b', b'a')]
+        self.assertEqual(b'ba', reassemble(packets))
@@ -0,0 +1,68 @@
+import io
+import json
+from anomaly import Anomaly
+from base_test import BaseTest
+from detection_analyzer import DetectionAnalyzer
+from report import JsonLinesSink, TextSink
+from util import printable
+
+
+class ReportTest(BaseTest):
+    def setUp(self):
+        self.anomaly = Anomaly(b'FLAG{0123}\x00\xff', b'give-me-flag!', 7, 'did not match', 0.9)
+
+    def test_text(self):
+        out = io.StringIO()
+        sink = TextSink(out, trunc_messages=4)
+        sink.write(self.anomaly)
+        text = out.getvalue()
+        self.assertIn("=== Anomaly on port:     7 ===\n", text)
+        self.assertIn("<<< recv\ngive\n...[snip]\n", text)
+        self.assertIn(">>> sent\nFLAG\n...[snip]\n", text)
+
+    def test_jsonl(self):
+        out = io.StringIO()
+        sink = JsonLinesSink(out)
+        sink.write(self.anomaly)
+        sink.write(self.anomaly)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        result = json.loads(lines[0])
+        self.assertEqual(self.anomaly.sent, result['sent'].encode('latin-1'))
+        self.assertEqual((7, 0.9), (result['port'], result['score']))
+
+    def test_printable(self):
+        self.assertEqual('ab.\n.', printable(b'ab\x00\n\xff'))
+
+    def test_streamed_once(self):
+        analyzer = DetectionAnalyzer()
+        out = io.StringIO()
+        analyzer.sink = JsonLinesSink(out)
+        for t, flag in enumerate((b'FLAG{01}', b'FLAG{02}', b'FLAG{03}')):
+            analyzer.check_result(7, (flag, b'give-me-flag!'), 'did not match', 1.0, origin=('10.0.0.{}'.format(t % 2), t, t + 0.5))
+        analyzer.check_result(7, (b'other', b'give-me-flag!'), 'did not match', 1.0)
+        analyzer.check_result(7, (b'hallo', b'hallo'), 'No anomalies detected', 0.0)
+        self.assertEqual(2, analyzer.anomaly_count)
+        self.assertEqual(2, len(out.getvalue().splitlines()))
+        flag = analyzer.anomalies()[0]
+        self.assertEqual((3, 0, 2.5), (flag.count, flag.first_seen, flag.last_seen))
+        self.assertEqual({'10.0.0.0', '10.0.0.1'}, flag.sources)
+        self.assertIsNone(flag.sent)
+
+        analyzer.sink.finish(analyzer.anomalies(), analyzer.anomaly_count)
+        totals = [json.loads(line) for line in out.getvalue().splitlines()[2:]]
+        self.assertEqual([('occurrences', 3), ('occurrences', 1)], [(t['type'], t['count']) for t in totals[:2]])
+        self.assertEqual(['10.0.0.0', '10.0.0.1'], totals[0]['sources'])
+        self.assertEqual({'type': 'summary', 'anomalies': 2, 'occurrences': 2}, totals[2])
+
+    def test_live_total(self):
+        # live runs forget old anomalies, the total still counts them
+        analyzer = DetectionAnalyzer()
+        out = io.StringIO()
+        analyzer.sink = TextSink(out)
+        analyzer.live = True
+        analyzer.reported.size = 2
+        for flag in (b'FLAG{01}', b'other', b'more'):
+            analyzer.check_result(7, (flag, b'give-me-flag!'), 'did not match', 1.0)
+        analyzer.post_analysis()
+        self.assertIn("Found 3 anomalies, the occurrences are of the 2 most recent only\n", out.getvalue())
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import tempfile
+from base_test import BaseTest
+
+DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'droids_demo')
+# what droids_demo/service_echo.py answers to give-me-flag!
+DEMO_FLAG = b'FLAG{ABCCIDIEIEJEEJEJJJBJGJIEJIEJBIJ}'
+sys.path.insert(0, DEMO)
+from service_wrap import Filter, MaxBytes, MaxLineLength, Replace, input_rules, output_rules  # noqa: E402
+
+
+def feed_bytewise(rules, data):
+    f = Filter(rules)
+    return b''.join(f.feed(data[i:i + 1]) for i in range(len(data))) + f.flush()
+
+
+class ServiceWrapTest(BaseTest):
+    def test_split_matches(self):
+        data = b'hallo\ngive-me-flag!\nfido\n'
+        self.assertEqual(b'hallo\nNO FLAG FOR YOUU\nfidodido\n', feed_bytewise(input_rules(), data))
+        self.assertEqual(b'x NO FLAG FOR YOUU\n', feed_bytewise(output_rules(), b'x FLAG{ABC123}\n'))
+        self.assertEqual(b'NO FLAG FOR YOUU\n', feed_bytewise(output_rules(), DEMO_FLAG + b'\n'))
+
+    def test_whole_line_command(self):
+        data = b'give-me-flag!\r\nsay give-me-flag!\ngive-me-flag!!\ngive-me-flag!'
+        self.assertEqual(b'NO FLAG FOR YOUU\nsay give-me-flag!\ngive-me-flag!!\nNO FLAG FOR YOUU',
+                         feed_bytewise(input_rules(), data))
+
+    def test_holds_only_possible_matches(self):
+        f = Filter(output_rules())
+        self.assertEqual(b'ok\n', f.feed(b'ok\n'))
+        self.assertEqual(b'', f.feed(b'FLAG{AB'))
+        self.assertTrue(f.held())
+        self.assertEqual(b'NO FLAG FOR YOUU\n', f.feed(b'C}\n'))
+        # a prompt without a newline is passed on at once, only a started flag is held
+        self.assertEqual(b'name? ', f.feed(b'name? '))
+        self.assertFalse(f.held())
+        self.assertEqual(b'x ', f.feed(b'x FL'))
+        self.assertEqual(b'FL', f.flush())
+        rule = Replace.literal(b'fido', b'fidodido')
+        self.assertEqual(b'a ', rule.feed(b'a fi'))
+        self.assertEqual(b'fi', rule.flush())
+        self.assertEqual(b'gigi', rule.feed(b'gigi'))
+
+    def test_limits(self):
+        rule = MaxLineLength(4)
+        self.assertEqual(b'ab', rule.feed(b'ab'))
+        self.assertEqual(b'cd\nab', rule.feed(b'cdefg\nab'))
+        self.assertEqual(b'c\r\nab', rule.feed(b'c\r\nab'))
+        rule = MaxBytes(5)
+        self.assertEqual(b'abc', rule.feed(b'abc'))
+        self.assertEqual(b'de', rule.feed(b'defg'))
+        self.assertEqual(b'', rule.feed(b'h'))
+
+    def test_binary(self):
+        data = bytes(range(256)) * 4
+        self.assertEqual(data, feed_bytewise(input_rules(), data))
+        self.assertEqual(data, feed_bytewise(output_rules(), data))
+
+    def wrap(self, *service, **streams):
+        wrapper = os.path.join(DEMO, 'service_wrap.py')
+        service = service or (sys.executable, '-u', os.path.join(DEMO, 'service_echo.py'))
+        return subprocess.run([sys.executable, wrapper, *service], timeout=20, **streams)
+
+    def test_wrap(self):
+        result = self.wrap(input=b'hi\ngive-me-flag!\n', capture_output=True)
+        self.assertEqual(b'hi\nNO FLAG FOR YOUU\n', result.stdout)
+        self.assertEqual(0, result.returncode)
+        # the flag the demo service prints if the command gets through
+        result = self.wrap(sys.executable, '-c', 'print("hi {}")'.format(DEMO_FLAG.decode()), capture_output=True)
+        self.assertEqual(b'hi NO FLAG FOR YOUU\n', result.stdout)
+
+    def test_files(self):
+        # epoll can't watch regular files, like a service run with < input.txt > output.txt
+        with tempfile.TemporaryFile() as stdin, tempfile.TemporaryFile() as stdout:
+            stdin.write(b'hi\ngive-me-flag!\n')
+            stdin.seek(0)
+            self.assertEqual(0, self.wrap(stdin=stdin, stdout=stdout).returncode)
+            stdout.seek(0)
+            self.assertEqual(b'hi\nNO FLAG FOR YOUU\n', stdout.read())
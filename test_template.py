@@ -1,5 +1,5 @@
 from base_test import BaseTest
-from template import Template, TemplateVariable, ConvoTemplate
+from template import Template, TemplateVariable, ConvoTemplate, TurnTemplate, Turns
 from unittest.mock import Mock
 from difflib import SequenceMatcher
 from baseline import Baseline
@@ -87,6 +87,26 @@ class TemplateTest(BaseTest):
         temp = Template('abcdefgh', [TemplateVariable(2,4,4,4)], self.c)
         self.assertEqual(0, temp.similarity("abFLAGgh"))
 
+    def test_quick_fits(self):
+        t = Template('abcdefgh', [TemplateVariable(2, 4, 0, 6)], self.c)
+        self.assertTrue(t.quick_fits(b'abgh'))
+        self.assertTrue(t.quick_fits(b'abxyxyxygh'))
+        self.assertFalse(t.quick_fits(b'abxyxyxyxgh'))
+        self.assertFalse(t.quick_fits(b'abFLAGgh'))
+        t = Template('a-b-c', [TemplateVariable(1, 1, 1, 3), TemplateVariable(3, 1, 1, 1)], self.c)
+        self.assertTrue(t.quick_fits(b'a---b-c'))
+        self.assertFalse(t.quick_fits(b'a-b--c'))
+        self.assertEqual([b'---', b'-'], t.get_scanner().match(b'a---b-c'))
+
+    def test_quick_fits_beyond_diff(self):
+        # The scanner accepts inputs that do fit but that difflib aligns with an insert away
+        # from the variables, which used to score below 1.0
+        t = Template(b'aac;b?a//;?a', [TemplateVariable(1, 1, 1, 1), TemplateVariable(12, 0, 0, 4, {b'?'})], self.c)
+        self.assertTrue(t.quick_fits(t.text))
+        comparison = t.compare(t.text)
+        self.assertAlmostEqual(0.895, t.score_difference(t.find_variables(t.text), t.text, comparison), places=3)
+        self.assertEqual(1.0, t.similarity(t.text))
+
     def test_show_template(self):
         t = Template(b'abcdefghijklmnopqrstuvwxyz',[TemplateVariable(1,4,1,4), TemplateVariable(9,1,1,4) ], self.c)
         self.assertEqual('a\x1b[32mbcde\x1b[0mfghi\x1b[32mj\x1b[0mklmnopqrstuvwxyz', t.show())
@@ -114,6 +134,17 @@ class TemplateTest(BaseTest):
         mock_var.__lt__ = lambda x,y: True
         return mock_var
 
+    def test_merge(self):
+        a = Template(b'GET /a HTTP/1.1', [], self.c)
+        a.update(b'GET /bbb HTTP/1.1')
+        b = Template(b'GET /c HTTP/1.1 id=12', [], self.c)
+        b.update(b'GET /c HTTP/1.1 id=345')
+        self.assertLess(a.similarity(b'GET /dd HTTP/1.1 id=678'), 1.0)
+        a.merge(b)
+        self.assertEqual(b'GET /a HTTP/1.1', a.text)
+        self.assertEqual(1.0, a.similarity(b'GET /dd HTTP/1.1 id=678'))
+        self.assertEqual(1.0, a.similarity(b'GET /ee HTTP/1.1'))
+
     def test_var_fit(self):
         self.assertTrue(Template("abc", [self.mock_var(fits=True)], self.c).fit_variable('good'))
         self.assertTrue(Template("abc", [self.mock_var(fits=False), self.mock_var(fits=True)], self.c).fit_variable('good'))
@@ -181,6 +212,27 @@ class ConvoTemplateTest(BaseTest):
         sent_mock.update.assert_called_once_with('a')
         recv_mock.update.assert_called_once_with('b')
 
+class TurnTemplateTest(BaseTest):
+    def setUp(self):
+        self.t = TurnTemplate([(b'220 ready', b''), (b'250 ok', b'HELO a'), (b'221 bye', b'QUIT')], Baseline().config)
+
+    def test_similarity(self):
+        self.assertEqual(1.0, self.t.similarity((b'220 ready', b''), (b'250 ok', b'HELO a'), (b'221 bye', b'QUIT')))
+        self.assertEqual(0.0, self.t.similarity((b'220 ready', b''), (b'250 ok', b'HELO a')))
+        self.assertLess(self.t.similarity((b'220 ready', b''), (b'250 ok', b'HELO a'), (b'221 bye', b'QUIT;id')), 1.0)
+
+    def test_early_exit(self):
+        last = Mock()
+        self.t.turns[2] = last
+        self.t.similarity((b'220 ready', b''), (b'500 what', b'DROP TABLE x'), (b'221 bye', b'QUIT'), floor=0.9)
+        last.similarity.assert_not_called()
+
+    def test_update(self):
+        self.t.update((b'220 ready', b''), (b'250 ok', b'HELO bb'), (b'221 bye', b'QUIT'))
+        self.assertEqual(1.0, self.t.similarity((b'220 ready', b''), (b'250 ok', b'HELO c'), (b'221 bye', b'QUIT')))
+        self.assertEqual(Turns([(b'220 ready', b''), (b'250 ok', b'HELO a'), (b'221 bye', b'QUIT')]), self.t.convo())
+
+
 class ScrubEqualsTest(BaseTest):
     def test_equals(self):
         self.assertTrue(scrubbed_equals(b"abc", b"abc"))
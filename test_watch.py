@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+from base_test import BaseTest
+from scapy.all import Ether, IP, TCP, Raw, wrpcap
+from test_detection_analyzer import echo_analyzer, session
+from watch import DirectoryWatcher, WatchError, read_from
+
+
+def pcap_bytes(count, start=100):
+    packets = []
+    for i in range(count):
+        p = Ether() / IP(src='1.1.1.1', dst='2.2.2.2') / TCP(sport=1234, dport=80, flags='PA') / Raw(b'%d' % i)
+        p.time = start + i
+        packets.append(p)
+    with tempfile.NamedTemporaryFile(suffix='.pcap') as f:
+        wrpcap(f.name, packets)
+        return f.read()
+
+
+class ReadFromTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_partial_record(self):
+        data = pcap_bytes(3)
+        path = self.write('a.pcap', data[:-5])
+        records = list(read_from(path, 0, fast=True))
+        self.assertEqual([100, 101], [r.time for r, _ in records])
+        offset = records[-1][1]
+        self.write('a.pcap', data)
+        records = list(read_from(path, offset, fast=True))
+        self.assertEqual([(102, len(data))], [(r.time, o) for r, o in records])
+        self.assertEqual([], list(read_from(path, len(data), fast=True)))
+
+    def test_short_header(self):
+        self.assertEqual([], list(read_from(self.write('a.pcap', pcap_bytes(1)[:10]), 0)))
+        self.assertRaises(WatchError, list, read_from(self.write('b.pcap', b'\x0a\x0d\x0d\x0a' + b'\0' * 40), 0))
+
+    def test_growing_files(self):
+        data = pcap_bytes(4)
+        self.write('a.pcap', data[:-3])
+        watcher = DirectoryWatcher(self.dir, fast=True)
+        self.assertEqual(3, len(list(watcher.poll())))
+        self.write('a.pcap', data)
+        self.write('b.pcap', pcap_bytes(2, 200))
+        self.assertEqual([103, 200, 201], [r.time for r in watcher.poll()])
+        self.assertEqual([], list(watcher.poll()))
+
+    def test_checkpoint(self):
+        data = pcap_bytes(3)
+        self.write('a.pcap', data)
+        self.write('b.pcap', data)
+        watcher = DirectoryWatcher(self.dir, fast=True)
+        self.assertEqual(6, len(list(watcher.poll())))
+        os.unlink(os.path.join(self.dir, 'a.pcap'))
+        self.write('b.pcap', data + pcap_bytes(1, 300)[24:])
+        resumed = DirectoryWatcher(self.dir, fast=True)
+        self.assertEqual({'a.pcap': len(data), 'b.pcap': len(data)}, resumed.offsets)
+        self.assertEqual([300], [r.time for r in resumed.poll()])
+        # files that were rotated away are forgotten
+        self.assertEqual(['b.pcap'], list(DirectoryWatcher(self.dir).offsets))
+
+
+class ResumeTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_session(self, name, records):
+        packets = []
+        for r in records:
+            p = Ether() / IP(src=r.src, dst=r.dst) / TCP(sport=r.sport, dport=r.dport, flags=r.flags, seq=r.seq)
+            p.time = r.time
+            packets.append(p / Raw(r.payload) if r.payload else p)
+        wrpcap(os.path.join(self.dir, name), packets)
+
+    def run_watch(self):
+        analyzer = echo_analyzer()
+        analyzer.local.ips.add('2.2.2.2')
+        watcher = DirectoryWatcher(self.dir, fast=True)
+        watcher.held = analyzer.held_packets
+
+        def packets():
+            yield from watcher.poll()
+            # killed, the open flows are not analyzed
+            raise SystemExit
+
+        self.assertRaises(SystemExit, analyzer.run, packets(), None)
+        return analyzer
+
+    def test_open_flow(self):
+        # a session that was reported, between the parts of one that is still open
+        opened = session(b'give-me-flag!', b'FLAG{0123}', 1235)
+        closed = session(b'give-me-flag!', b'FLAG{0123}', 1234, 1)
+        self.write_session('a.pcap', opened[:1] + closed + opened[1:4])
+        self.assertEqual(1, self.run_watch().anomaly_count)
+        self.write_session('a.pcap', opened[:1] + closed + opened[1:])
+        analyzer = self.run_watch()
+        self.assertEqual(1, analyzer.anomaly_count)
+        self.assertEqual(0, analyzer.anomalies()[0].first_seen)
+
+
+class InterruptTest(BaseTest):
+    def packets(self):
+        # a session that is still open when the run is stopped
+        yield from session(b'give-me-flag!', b'FLAG{0123}')[:4]
+        raise KeyboardInterrupt
+
+    def test_open_flows_analyzed(self):
+        analyzer = echo_analyzer()
+        analyzer.finish_on_interrupt = True
+        analyzer.run(self.packets(), 's')
+        self.assertEqual(1, analyzer.anomaly_count)
+
+    def test_raises_by_default(self):
+        self.assertRaises(KeyboardInterrupt, echo_analyzer().run, self.packets(), 's')
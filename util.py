@@ -1,5 +1,6 @@
-from scapy.all import TCP, IP, ICMP, UDP, ARP
 import os
+from hashlib import blake2b
+from collections import OrderedDict
 from string import printable as printable_chars
 import re
 
@@ -9,32 +10,45 @@ def dbg(*msg):
         print(*msg)
     
 
-# https://gist.github.com/MarkBaggett/d8933453f431c111169158ce7f4e2222
-# scapy helper for session analysis
-def full_duplex(p):
-    sess = "Other"
-    if 'Ether' in p:
-        if 'IP' in p:
-            if 'TCP' in p:
-                sess = str(sorted(["TCP", p[IP].src, p[TCP].sport, p[IP].dst, p[TCP].dport],key=str))
-            elif 'UDP' in p:
-                sess = str(sorted(["UDP", p[IP].src, p[UDP].sport, p[IP].dst, p[UDP].dport] ,key=str))
-            elif 'ICMP' in p:
-                sess = str(sorted(["ICMP", p[IP].src, p[IP].dst, p[ICMP].code, p[ICMP].type, p[ICMP].id] ,key=str))
-            else:
-                sess = str(sorted(["IP", p[IP].src, p[IP].dst, p[IP].proto] ,key=str))
-        elif 'ARP' in p:
-            sess = str(sorted(["ARP", p[ARP].psrc, p[ARP].pdst],key=str))
-        else:
-            sess = p.sprintf("Ethernet type=%04xr,Ether.type%")
-    return sess
+PRINTABLE_BYTES = printable_chars.encode()
+# every byte that isn't printable becomes a dot
+PRINTABLE_TABLE = bytes(x if x in PRINTABLE_BYTES else ord('.') for x in range(256))
+
 
 def printable(input):
-    return ''.join([chr(x) if chr(x) in printable_chars else '.' for x in input])
+    return input.translate(PRINTABLE_TABLE).decode('ascii')
 
 
 def is_printable(input):
-    return all(chr(x) in printable_chars for x in input)
+    return not input.translate(None, PRINTABLE_BYTES)
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
 
 class ConfigMixin:
     def get_config(self, name, default=None):
@@ -44,10 +58,22 @@ class ConfigMixin:
             return self.config[name]
         return default
 
+FLAG_PATTERN = re.compile(b'FLAG{[0-9A-F]+}')
+
+
+def scrub(text):
+    return FLAG_PATTERN.sub(b'FLAG{XXX}', text.strip())
+
+
 def scrubbed_equals(text, other):
-    flag_p = re.compile(b'FLAG{[0-9A-F]+}')
-    text = text.strip()
-    other = other.strip()
-    text = flag_p.sub(b'FLAG{XXX}', text)
-    other = flag_p.sub(b'FLAG{XXX}', other)
-    return text == other
\ No newline at end of file
+    return scrub(text) == scrub(other)
+
+
+def fingerprint(*texts):
+    # hash of the scrubbed texts, equal for conversations that only differ in their flags
+    h = blake2b(digest_size=16)
+    for text in texts:
+        text = scrub(text)
+        h.update(len(text).to_bytes(8, 'big'))
+        h.update(text)
+    return h.digest()
@@ -0,0 +1,135 @@
+from decode import decode_raw, decode_scapy, flow_key
+import json
+import logging
+import os
+import struct
+import time
+
+
+# magic: (byte order, timestamp resolution)
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+PCAP_HEADER_LEN = 24
+
+
+class WatchError(Exception):
+    pass
+
+
+def read_from(path, offset, fast=False):
+    # Yields (record, offset after the record) for every complete packet after offset.
+    # tcpdump may still be writing the file, so a partial record at the end is left for
+    # the next poll.
+    decode = decode_raw if fast else decode_scapy
+    with open(path, 'rb') as f:
+        header = f.read(PCAP_HEADER_LEN)
+        if len(header) < PCAP_HEADER_LEN:
+            return
+        if header[:4] not in PCAP_MAGICS:
+            raise WatchError("{} is not a pcap file, only pcap (not pcapng) can be watched".format(path))
+        endian, resolution = PCAP_MAGICS[header[:4]]
+        linktype = struct.unpack(endian + 'I', header[20:24])[0]
+        record_header = struct.Struct(endian + 'IIII')
+        offset = max(offset, PCAP_HEADER_LEN)
+        f.seek(offset)
+        while True:
+            hdr = f.read(record_header.size)
+            if len(hdr) < record_header.size:
+                return
+            sec, frac, caplen, _ = record_header.unpack(hdr)
+            data = f.read(caplen)
+            if len(data) < caplen:
+                return
+            offset += record_header.size + caplen
+            yield decode(data, sec + frac * resolution, linktype), offset
+
+
+class DirectoryWatcher:
+    # Follows a directory that tcpdump -G writes rotated pcaps to. The byte offset up to
+    # which every file was read is kept in a checkpoint file, so a restart only reads new
+    # traffic. Flows that were still open are lost if the run is killed, so the checkpoint
+    # also has the point to read them again from, see resume_point.
+    def __init__(self, directory, checkpoint=None, fast=False):
+        self.directory = directory
+        self.checkpoint = checkpoint or os.path.join(directory, '.droids_checkpoint')
+        self.fast = fast
+        self.offsets = {}
+        self.resume = {}
+        self.resume_flows = set()
+        # returns the records that are read but not analyzed yet, PacketAnalyzer.held_packets
+        self.held = None
+        # id(record) -> (record, file, offset of the record) of the records read since the
+        # last save, and of the held ones
+        self.positions = {}
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                data = json.load(f)
+            self.offsets = data['offsets']
+            self.resume = data.get('resume', {})
+            self.resume_flows = {(proto, tuple(a), tuple(b)) for proto, a, b in data.get('flows', [])}
+            logging.info("Resuming from checkpoint {} ({} files, {} open flows)".format(
+                self.checkpoint, len(self.offsets), len(self.resume_flows)))
+
+    def resume_point(self):
+        # A restart reads again from the first packet of the oldest held flow, all later
+        # files from their start, and only picks up the packets of the held flows until it
+        # gets to the offsets that were read before.
+        held = [self.positions[id(r)] for r in (self.held() if self.held else []) if id(r) in self.positions]
+        self.positions = {id(r): (r, name, start) for r, name, start in held}
+        if not held:
+            return {}, []
+        name, start = min((name, start) for _, name, start in held)
+        resume = {n: 0 for n in self.offsets if n > name}
+        resume[name] = start
+        flows = list(dict.fromkeys(flow_key(r) for r, _, _ in held))
+        return resume, flows
+
+    def save(self):
+        resume, flows = self.resume_point()
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': 1, 'offsets': self.offsets, 'resume': resume, 'flows': flows}, f)
+        os.replace(tmp, self.checkpoint)
+
+    def poll(self):
+        # yields the packets of new and grown files, oldest file first
+        names = sorted(n for n in os.listdir(self.directory) if not n.startswith('.'))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            read = self.offsets.get(name, 0)
+            offset = self.resume.pop(name, read)
+            if not os.path.isfile(path) or os.path.getsize(path) <= offset:
+                continue
+            logging.debug("Reading {} from offset {}".format(path, offset))
+            try:
+                for record, end in read_from(path, offset, self.fast):
+                    start, offset = offset, end
+                    if end <= read:
+                        # read before the restart, only the flows that were open then
+                        if flow_key(record) not in self.resume_flows:
+                            continue
+                    else:
+                        self.offsets[name] = end
+                    self.positions[id(record)] = (record, name, start)
+                    yield record
+            except WatchError as e:
+                logging.error(str(e))
+                self.offsets[name] = os.path.getsize(path)
+        self.resume.clear()
+        self.resume_flows.clear()
+        # forget files that were rotated away
+        self.offsets = {n: o for n, o in self.offsets.items() if n in names}
+        self.save()
+
+    def watch(self, interval=5):
+        # Never ends. Yields None after every poll, see PacketAnalyzer.run. Open flows are
+        # kept in the analyzer between polls, so a conversation that spans two rotated
+        # files is still analyzed once.
+        while True:
+            yield from self.poll()
+            yield None
+            time.sleep(interval)